@@ -4,6 +4,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from copy import deepcopy
 import cdmc.utils as utils
+import cdmc.augmentations as augmentations
 import cdmc.algorithms.modules as m
 from cdmc.algorithms.sac import SAC
 
@@ -12,8 +13,9 @@ class CURL(SAC):
 	def __init__(self, obs_shape, action_shape, args):
 		super().__init__(obs_shape, action_shape, args)
 		self.aux_update_freq = args.aux_update_freq
+		self.pipeline = augmentations.Pipeline(crop=obs_shape[-1], positives=True)
 
-		self.curl_head = m.CURLHead(self.critic.encoder).cuda()
+		self.curl_head = m.CURLHead(self.critic.encoder).to(self.device)
 
 		self.curl_optimizer = torch.optim.Adam(
 			self.curl_head.parameters(), lr=args.aux_lr, betas=(args.aux_beta, 0.999)
@@ -33,7 +35,7 @@ class CURL(SAC):
 			z_pos = self.critic_target.encoder(x_pos)
 		
 		logits = self.curl_head.compute_logits(z_a, z_pos)
-		labels = torch.arange(logits.shape[0]).long().cuda()
+		labels = torch.arange(logits.shape[0], device=logits.device)
 		curl_loss = F.cross_entropy(logits, labels)
 		
 		self.curl_optimizer.zero_grad()
@@ -43,15 +45,16 @@ class CURL(SAC):
 			L.log('train/aux_loss', curl_loss, step)
 
 	def update(self, replay_buffer, L, step):
-		obs, action, reward, next_obs, not_done, pos = replay_buffer.sample_curl()
+		obs, action, reward, next_obs, not_done, pos = replay_buffer.sample_pipeline(self.pipeline)
 
 		self.update_critic(obs, action, reward, next_obs, not_done, L, step)
 
-		if step % self.actor_update_freq == 0:
-			self.update_actor_and_alpha(obs, L, step)
+		with self.feature_cache():
+			if step % self.actor_update_freq == 0:
+				self.update_actor_and_alpha(obs, L, step)
 
-		if step % self.critic_target_update_freq == 0:
-			self.soft_update_critic_target()
+			if step % self.critic_target_update_freq == 0:
+				self.soft_update_critic_target()
 
-		if step % self.aux_update_freq == 0:
-			self.update_curl(obs, pos, L, step)
+			if step % self.aux_update_freq == 0:
+				self.update_curl(obs, pos, L, step)
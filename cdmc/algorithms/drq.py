@@ -4,21 +4,45 @@ import torch.nn as nn
 import torch.nn.functional as F
 from copy import deepcopy
 import cdmc.utils as utils
+import cdmc.augmentations as augmentations
 import cdmc.algorithms.modules as m
 from cdmc.algorithms.sac import SAC
 
 
-class DrQ(SAC): # [K=1, M=1]
+class DrQ(SAC): # [K=drq_K, M=drq_M]
 	def __init__(self, obs_shape, action_shape, args):
 		super().__init__(obs_shape, action_shape, args)
+		self.K = args.drq_K
+		self.M = args.drq_M
+		self.pipeline = augmentations.Pipeline(shift=4, obs_views=self.M, next_obs_views=self.K)
+
+	def update_critic(self, obs, action, reward, next_obs, not_done, L=None, step=None):
+		"""obs and next_obs hold M and K augmentations of the batch, stacked view-major"""
+		with torch.no_grad():
+			_, policy_action, log_pi, _ = self.actor(next_obs)
+			target_Qs = self.critic_target(next_obs, policy_action)
+			target_V = self.reduce_Q(target_Qs) - self.alpha.detach() * log_pi
+			target_V = target_V.view(self.K, -1, 1).mean(dim=0)
+			target_Q = reward + (not_done * self.discount * target_V)
+
+		current_Qs = self.critic(obs, action.repeat(self.M, 1))
+		critic_loss = self.M * self.critic_loss(current_Qs, target_Q.repeat(self.M, 1))
+		if L is not None:
+			L.log('train_critic/loss', critic_loss, step)
+
+		self.critic_optimizer.zero_grad()
+		critic_loss.backward()
+		self.critic_optimizer.step()
 
 	def update(self, replay_buffer, L, step):
-		obs, action, reward, next_obs, not_done = replay_buffer.sample_drq()
+		obs, action, reward, next_obs, not_done = replay_buffer.sample_pipeline(self.pipeline)
 
 		self.update_critic(obs, action, reward, next_obs, not_done, L, step)
 
-		if step % self.actor_update_freq == 0:
-			self.update_actor_and_alpha(obs, L, step)
+		with self.feature_cache():
+			if step % self.actor_update_freq == 0:
+				# the actor is updated on the first augmentation of obs
+				self.update_actor_and_alpha(obs[:len(action)], L, step)
 
-		if step % self.critic_target_update_freq == 0:
-			self.soft_update_critic_target()
+			if step % self.critic_target_update_freq == 0:
+				self.soft_update_critic_target()
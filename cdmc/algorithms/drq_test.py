@@ -0,0 +1,86 @@
+"""Tests of the DrQ critic update with K target and M current augmentations."""
+
+from copy import deepcopy
+from absl.testing import absltest
+from absl.testing import parameterized
+import torch
+from cdmc.arguments import parse_args
+from cdmc.algorithms.factory import make_agent
+from cdmc.algorithms.sac import SAC
+
+_OBS_SHAPE, _ACTION_SHAPE, _BATCH_SIZE = (9, 84, 84), (6,), 4
+
+
+class _Logger(object):
+	def __init__(self):
+		self.values = {}
+
+	def log(self, key, value, step):
+		self.values[key] = value.item() if isinstance(value, torch.Tensor) else value
+
+
+def _make_agent(K, M):
+	args = parse_args([
+		'--algorithm', 'drq', '--seed', '0', '--device', 'cpu',
+		'--train_context_file', 'none', '--test_context_file', 'none',
+		'--hidden_dim', '32', '--num_shared_layers', '2', '--num_filters', '8',
+		'--projection_dim', '16', '--drq_K', str(K), '--drq_M', str(M)
+	])
+	torch.manual_seed(0)
+	return make_agent(_OBS_SHAPE, _ACTION_SHAPE, args)
+
+
+def _batch(K, M, seed=0):
+	"""M views of obs and K views of next_obs of a batch, stacked view-major, with distinct rewards per sample"""
+	generator = torch.Generator().manual_seed(seed)
+	obs = torch.randint(0, 256, (M*_BATCH_SIZE, *_OBS_SHAPE), generator=generator).float()
+	next_obs = torch.randint(0, 256, (K*_BATCH_SIZE, *_OBS_SHAPE), generator=generator).float()
+	action = torch.rand(_BATCH_SIZE, *_ACTION_SHAPE, generator=generator) * 2 - 1
+	reward = torch.arange(_BATCH_SIZE, dtype=torch.float32)[:, None]
+	not_done = torch.tensor([[1.], [0.], [1.], [1.]])
+	return obs, action, reward, next_obs, not_done
+
+
+class DrQTest(parameterized.TestCase):
+
+	def testSingleAugmentationMatchesSAC(self):
+		agent = _make_agent(1, 1)
+		sac_agent = deepcopy(agent)
+		batch = _batch(1, 1)
+		L, sac_L = _Logger(), _Logger()
+		torch.manual_seed(1)
+		agent.update_critic(*batch, L=L, step=1)
+		torch.manual_seed(1)
+		SAC.update_critic(sac_agent, *batch, L=sac_L, step=1)
+		self.assertEqual(L.values['train_critic/loss'], sac_L.values['train_critic/loss'])
+		for (name, a), b in zip(agent.critic.named_parameters(), sac_agent.critic.parameters()):
+			self.assertTrue(torch.equal(a, b), f'critic parameter {name} differs from SAC')
+
+	@parameterized.parameters((2, 1), (1, 3), (2, 3))
+	def testViewsArePairedWithTheirSamples(self, K, M):
+		agent = _make_agent(K, M)
+		obs, action, reward, next_obs, not_done = batch = _batch(K, M)
+
+		# per sample and view, the target averaged over the K views of next_obs of that sample
+		reference = deepcopy(agent)
+		torch.manual_seed(1)
+		with torch.no_grad():
+			_, policy_action, log_pi, _ = reference.actor(next_obs)
+			target_V = reference.reduce_Q(reference.critic_target(next_obs, policy_action)) - reference.alpha * log_pi
+			expected_loss = 0
+			for i in range(_BATCH_SIZE):
+				V = sum(target_V[k*_BATCH_SIZE + i] for k in range(K)) / K
+				target_Q = reward[i] + not_done[i] * reference.discount * V
+				for m in range(M):
+					current_Qs = reference.critic(obs[m*_BATCH_SIZE + i:m*_BATCH_SIZE + i + 1], action[i:i+1])
+					# the loss of a view is the mean over the batch, summed over views
+					expected_loss += reference.critic_loss(current_Qs, target_Q[None]).item() / _BATCH_SIZE
+
+		L = _Logger()
+		torch.manual_seed(1)
+		agent.update_critic(*batch, L=L, step=1)
+		self.assertAlmostEqual(L.values['train_critic/loss'], expected_loss, delta=1e-4 * abs(expected_loss))
+
+
+if __name__ == '__main__':
+	absltest.main()
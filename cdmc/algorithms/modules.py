@@ -4,6 +4,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import math
 from functools import partial
+from contextlib import contextmanager
 
 
 def _get_out_shape_cuda(in_shape, layers):
@@ -141,9 +142,29 @@ class SharedCNN(nn.Module):
 		self.layers = nn.Sequential(*self.layers)
 		self.out_shape = _get_out_shape(obs_shape, self.layers)
 		self.apply(weight_init)
+		self._cache = None
+
+	@contextmanager
+	def cache_features(self):
+		"""Reuses the output for an input tensor within the context, which must not change the parameters
+
+		Outputs computed without grad are only reused without grad.
+		"""
+		self._cache = []
+		try:
+			yield
+		finally:
+			self._cache = None
 
 	def forward(self, x):
-		return self.layers(x)
+		if self._cache is None:
+			return self.layers(x)
+		for _x, out in self._cache:
+			if _x is x and (out.requires_grad or not torch.is_grad_enabled()):
+				return out
+		out = self.layers(x)
+		self._cache.append((x, out))
+		return out
 
 
 class HeadCNN(nn.Module):
@@ -218,6 +239,7 @@ class Actor(nn.Module):
 
 
 class QFunction(nn.Module):
+	"""Single Q-head of critics saved before EnsembleQFunction, kept so that they can be unpickled and migrated"""
 	def __init__(self, obs_dim, action_dim, hidden_dim):
 		super().__init__()
 		self.trunk = nn.Sequential(
@@ -232,20 +254,85 @@ class QFunction(nn.Module):
 		return self.trunk(torch.cat([obs, action], dim=1))
 
 
+class EnsembleLinear(nn.Module):
+	"""num_members independent linear layers, evaluated as one batched matmul on (num_members, B, in_dim) inputs"""
+	def __init__(self, in_dim, out_dim, num_members):
+		super().__init__()
+		self.weight = nn.Parameter(torch.empty(num_members, in_dim, out_dim))
+		self.bias = nn.Parameter(torch.zeros(num_members, 1, out_dim))
+		for w in self.weight.data:
+			# same init as weight_init for nn.Linear, whose weight is stored transposed
+			w.copy_(nn.init.orthogonal_(torch.empty(out_dim, in_dim)).T)
+
+	def forward(self, x):
+		return torch.baddbmm(self.bias, x, self.weight)
+
+
+class EnsembleQFunction(nn.Module):
+	def __init__(self, obs_dim, action_dim, hidden_dim, num_qs=2):
+		super().__init__()
+		self.num_qs = num_qs
+		self.trunk = nn.Sequential(
+			EnsembleLinear(obs_dim + action_dim, hidden_dim, num_qs), nn.ReLU(),
+			EnsembleLinear(hidden_dim, hidden_dim, num_qs), nn.ReLU(),
+			EnsembleLinear(hidden_dim, 1, num_qs)
+		)
+
+	def forward(self, obs, action):
+		"""Returns the Q-values of all heads as a (num_qs, B, 1) tensor"""
+		assert obs.size(0) == action.size(0)
+		x = torch.cat([obs, action], dim=1)
+		return self.trunk(x.expand(self.num_qs, *x.shape))
+
+
+def _stack_q_heads(state_dict, prefix, heads=('Q1', 'Q2')):
+	"""Replaces the QFunction heads of a Critic state_dict saved before EnsembleQFunction by the stacked Q, in place"""
+	if f'{prefix}{heads[0]}.trunk.0.weight' not in state_dict:
+		return
+	for i in (0, 2, 4):
+		weights = [state_dict.pop(f'{prefix}{head}.trunk.{i}.weight') for head in heads]
+		biases = [state_dict.pop(f'{prefix}{head}.trunk.{i}.bias') for head in heads]
+		# nn.Linear stores (out_dim, in_dim) weights, EnsembleLinear (num_members, in_dim, out_dim)
+		state_dict[f'{prefix}Q.trunk.{i}.weight'] = torch.stack([w.t() for w in weights])
+		state_dict[f'{prefix}Q.trunk.{i}.bias'] = torch.stack(biases).unsqueeze(1)
+
+
 class Critic(nn.Module):
-	def __init__(self, encoder, action_shape, hidden_dim):
+	def __init__(self, encoder, action_shape, hidden_dim, num_qs=2):
 		super().__init__()
 		self.encoder = encoder
-		self.Q1 = QFunction(
-			self.encoder.out_dim, action_shape[0], hidden_dim
-		)
-		self.Q2 = QFunction(
-			self.encoder.out_dim, action_shape[0], hidden_dim
+		self.Q = EnsembleQFunction(
+			self.encoder.out_dim, action_shape[0], hidden_dim, num_qs
 		)
 
 	def forward(self, x, action, detach=False):
+		"""Returns the Q-values of all heads as a (num_qs, B, 1) tensor, which unpacks into one (B, 1) tensor per head"""
 		x = self.encoder(x, detach)
-		return self.Q1(x, action), self.Q2(x, action)
+		return self.Q(x, action)
+
+	def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+		# state_dicts saved before the ensemble hold Q1 and Q2, which are loaded into the stacked Q
+		_stack_q_heads(state_dict, prefix)
+		super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+	def __setstate__(self, state):
+		"""Unpickles a critic, replacing the Q1 and Q2 heads of critics pickled before the ensemble by Q
+
+		Optimizers pickled along with such a critic still hold the parameters of Q1 and Q2.
+		"""
+		super().__setstate__(state)
+		if 'Q' in self._modules:
+			return
+		heads = [self._modules.pop('Q1'), self._modules.pop('Q2')]
+		state_dict = {}
+		for name, head in zip(['Q1', 'Q2'], heads):
+			state_dict.update((f'{name}.{k}', v) for k, v in head.state_dict().items())
+		_stack_q_heads(state_dict, '')
+		weight = state_dict['Q.trunk.0.weight']
+		# EnsembleQFunction only uses obs_dim + action_dim, the input size of the heads
+		self.Q = EnsembleQFunction(weight.size(1), 0, weight.size(2), num_qs=len(heads)).to(weight.device)
+		self.Q.load_state_dict({k[len('Q.'):]: v for k, v in state_dict.items()})
+		self.Q.requires_grad_(next(heads[0].parameters()).requires_grad)
 
 
 class CURLHead(nn.Module):
@@ -0,0 +1,82 @@
+"""Tests of the network modules."""
+
+import pickle
+from absl.testing import absltest
+import torch
+import torch.nn as nn
+import cdmc.algorithms.modules as m
+
+_FEATURE_DIM, _ACTION_DIM, _HIDDEN_DIM = 12, 3, 16
+
+
+class _IdentityEncoder(nn.Module):
+	out_dim = _FEATURE_DIM
+
+	def forward(self, x, detach=False):
+		return x
+
+
+class _QHeadsCritic(nn.Module):
+	"""Critic as it was before EnsembleQFunction, with one QFunction per head"""
+	def __init__(self):
+		super().__init__()
+		self.encoder = _IdentityEncoder()
+		self.Q1 = m.QFunction(_FEATURE_DIM, _ACTION_DIM, _HIDDEN_DIM)
+		self.Q2 = m.QFunction(_FEATURE_DIM, _ACTION_DIM, _HIDDEN_DIM)
+
+	def forward(self, x, action, detach=False):
+		x = self.encoder(x, detach)
+		return self.Q1(x, action), self.Q2(x, action)
+
+
+def _inputs(seed=0):
+	generator = torch.Generator().manual_seed(seed)
+	return torch.randn(8, _FEATURE_DIM, generator=generator), torch.randn(8, _ACTION_DIM, generator=generator)
+
+
+class CriticTest(absltest.TestCase):
+
+	def _assert_same_q_values(self, critic, old_critic):
+		x, action = _inputs()
+		q1, q2 = critic(x, action)
+		old_q1, old_q2 = old_critic(x, action)
+		torch.testing.assert_close(q1, old_q1)
+		torch.testing.assert_close(q2, old_q2)
+
+	def testLoadsStateDictWithQHeads(self):
+		torch.manual_seed(0)
+		old_critic = _QHeadsCritic()
+		critic = m.Critic(_IdentityEncoder(), (_ACTION_DIM,), _HIDDEN_DIM)
+		critic.load_state_dict(old_critic.state_dict())
+		self._assert_same_q_values(critic, old_critic)
+
+	def testLoadsNestedStateDictWithQHeads(self):
+		torch.manual_seed(0)
+		old_critic = _QHeadsCritic()
+		model = nn.ModuleDict({'critic': m.Critic(_IdentityEncoder(), (_ACTION_DIM,), _HIDDEN_DIM)})
+		model.load_state_dict({f'critic.{k}': v for k, v in old_critic.state_dict().items()})
+		self._assert_same_q_values(model['critic'], old_critic)
+
+	def testUnpicklesCriticWithQHeads(self):
+		torch.manual_seed(0)
+		old_critic = _QHeadsCritic()
+		# a critic as pickled before the ensemble, with Q1 and Q2 modules and no Q
+		critic = m.Critic(_IdentityEncoder(), (_ACTION_DIM,), _HIDDEN_DIM)
+		del critic.Q
+		critic.Q1, critic.Q2 = old_critic.Q1, old_critic.Q2
+
+		critic = pickle.loads(pickle.dumps(critic))
+		self.assertEqual(set(critic._modules), {'encoder', 'Q'})
+		self.assertLen(list(critic.parameters()), 6)
+		self._assert_same_q_values(critic, old_critic)
+
+	def testStateDictRoundTrip(self):
+		critic = m.Critic(_IdentityEncoder(), (_ACTION_DIM,), _HIDDEN_DIM, num_qs=3)
+		loaded = m.Critic(_IdentityEncoder(), (_ACTION_DIM,), _HIDDEN_DIM, num_qs=3)
+		loaded.load_state_dict(critic.state_dict())
+		x, action = _inputs()
+		torch.testing.assert_close(loaded(x, action), critic(x, action))
+
+
+if __name__ == '__main__':
+	absltest.main()
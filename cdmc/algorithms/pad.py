@@ -16,13 +16,13 @@ class PAD(SAC):
 		self.aux_beta = args.aux_beta
 
 		shared_cnn = self.critic.encoder.shared_cnn
-		aux_cnn = m.HeadCNN(shared_cnn.out_shape, args.num_head_layers, args.num_filters).cuda()
+		aux_cnn = m.HeadCNN(shared_cnn.out_shape, args.num_head_layers, args.num_filters).to(self.device)
 		aux_encoder = m.Encoder(
 			shared_cnn,
 			aux_cnn,
 			m.RLProjection(aux_cnn.out_shape, args.projection_dim)
 		)
-		self.pad_head = m.InverseDynamics(aux_encoder, action_shape, args.hidden_dim).cuda()
+		self.pad_head = m.InverseDynamics(aux_encoder, action_shape, args.hidden_dim).to(self.device)
 		self.init_pad_optimizer()
 		self.train()
 
@@ -49,15 +49,16 @@ class PAD(SAC):
 			L.log('train/aux_loss', pad_loss, step)
 
 	def update(self, replay_buffer, L, step):
-		obs, action, reward, next_obs, not_done = replay_buffer.sample()
+		obs, action, reward, next_obs, not_done = replay_buffer.sample_pipeline(self.pipeline)
 
 		self.update_critic(obs, action, reward, next_obs, not_done, L, step)
 
-		if step % self.actor_update_freq == 0:
-			self.update_actor_and_alpha(obs, L, step)
+		with self.feature_cache():
+			if step % self.actor_update_freq == 0:
+				self.update_actor_and_alpha(obs, L, step)
 
-		if step % self.critic_target_update_freq == 0:
-			self.soft_update_critic_target()
+			if step % self.critic_target_update_freq == 0:
+				self.soft_update_critic_target()
 
-		if step % self.aux_update_freq == 0:
-			self.update_inverse_dynamics(obs, next_obs, action, L, step)
+			if step % self.aux_update_freq == 0:
+				self.update_inverse_dynamics(obs, next_obs, action, L, step)
@@ -3,7 +3,9 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from copy import deepcopy
+from contextlib import nullcontext
 import cdmc.utils as utils
+import cdmc.augmentations as augmentations
 import cdmc.algorithms.modules as m
 
 
@@ -14,9 +16,13 @@ class SAC(object):
 		self.encoder_tau = args.encoder_tau
 		self.actor_update_freq = args.actor_update_freq
 		self.critic_target_update_freq = args.critic_target_update_freq
+		self.device = torch.device(args.device)
+		self.pipeline = augmentations.Pipeline(crop=obs_shape[-1])
+		self.reuse_features = True
+		self.q_reduction = args.q_reduction
 
-		shared_cnn = m.SharedCNN(obs_shape, args.num_shared_layers, args.num_filters).cuda()
-		head_cnn = m.HeadCNN(shared_cnn.out_shape, args.num_head_layers, args.num_filters).cuda()
+		shared_cnn = m.SharedCNN(obs_shape, args.num_shared_layers, args.num_filters).to(self.device)
+		head_cnn = m.HeadCNN(shared_cnn.out_shape, args.num_head_layers, args.num_filters).to(self.device)
 		actor_encoder = m.Encoder(
 			shared_cnn,
 			head_cnn,
@@ -28,11 +34,12 @@ class SAC(object):
 			m.RLProjection(head_cnn.out_shape, args.projection_dim)
 		)
 
-		self.actor = m.Actor(actor_encoder, action_shape, args.hidden_dim, args.actor_log_std_min, args.actor_log_std_max).cuda()
-		self.critic = m.Critic(critic_encoder, action_shape, args.hidden_dim).cuda()
+		self.actor = m.Actor(actor_encoder, action_shape, args.hidden_dim, args.actor_log_std_min, args.actor_log_std_max).to(self.device)
+		self.critic = m.Critic(critic_encoder, action_shape, args.hidden_dim, args.num_qs).to(self.device)
 		self.critic_target = deepcopy(self.critic)
+		self._init_target_updates()
 
-		self.log_alpha = torch.tensor(np.log(args.init_temperature)).cuda()
+		self.log_alpha = torch.tensor(np.log(args.init_temperature), device=self.device)
 		self.log_alpha.requires_grad = True
 		self.target_entropy = -np.prod(action_shape)
 
@@ -49,6 +56,17 @@ class SAC(object):
 		self.train()
 		self.critic_target.train()
 
+	def _init_target_updates(self):
+		self.critic_target_update = utils.SoftUpdate(
+			(self.critic.Q, self.critic_target.Q, self.critic_tau),
+			(self.critic.encoder, self.critic_target.encoder, self.encoder_tau)
+		)
+
+	def __setstate__(self, state):
+		"""Unpickles an agent, rebuilding its fused target updates, which agents pickled before they were added lack"""
+		self.__dict__.update(state)
+		self._init_target_updates()
+
 	def train(self, training=True):
 		self.training = training
 		self.actor.train(training)
@@ -66,7 +84,7 @@ class SAC(object):
 			_obs = np.array(obs)
 		else:
 			_obs = obs
-		_obs = torch.FloatTensor(_obs).cuda()
+		_obs = torch.as_tensor(_obs, dtype=torch.float32, device=self.device)
 		_obs = _obs.unsqueeze(0)
 		return _obs
 
@@ -76,23 +94,39 @@ class SAC(object):
 			mu, _, _, _ = self.actor(_obs, compute_pi=False, compute_log_pi=False)
 		return mu.cpu().data.numpy().flatten()
 
+	def select_actions(self, obses):
+		"""select_action for a list of observations in one actor forward, returns an (N, action_dim) array"""
+		_obs = torch.as_tensor(np.stack([np.asarray(obs) for obs in obses]), dtype=torch.float32, device=self.device)
+		with torch.no_grad():
+			mu, _, _, _ = self.actor(_obs, compute_pi=False, compute_log_pi=False)
+		return mu.cpu().data.numpy()
+
 	def sample_action(self, obs):
 		_obs = self._obs_to_input(obs)
 		with torch.no_grad():
 			mu, pi, _, _ = self.actor(_obs, compute_log_pi=False)
 		return pi.cpu().data.numpy().flatten()
 
+	def reduce_Q(self, Qs):
+		"""Reduces the (num_qs, B, 1) Q-values of the critic heads to one estimate per sample"""
+		if self.q_reduction == 'mean':
+			return Qs.mean(dim=0)
+		return Qs.min(dim=0)[0]
+
+	@staticmethod
+	def critic_loss(current_Qs, target_Q):
+		"""Sum over critic heads of the mean squared error to target_Q"""
+		return F.mse_loss(current_Qs, target_Q.expand_as(current_Qs)) * current_Qs.size(0)
+
 	def update_critic(self, obs, action, reward, next_obs, not_done, L=None, step=None):
 		with torch.no_grad():
 			_, policy_action, log_pi, _ = self.actor(next_obs)
-			target_Q1, target_Q2 = self.critic_target(next_obs, policy_action)
-			target_V = torch.min(target_Q1,
-								 target_Q2) - self.alpha.detach() * log_pi
+			target_Qs = self.critic_target(next_obs, policy_action)
+			target_V = self.reduce_Q(target_Qs) - self.alpha.detach() * log_pi
 			target_Q = reward + (not_done * self.discount * target_V)
 
-		current_Q1, current_Q2 = self.critic(obs, action)
-		critic_loss = F.mse_loss(current_Q1,
-								 target_Q) + F.mse_loss(current_Q2, target_Q)
+		current_Qs = self.critic(obs, action)
+		critic_loss = self.critic_loss(current_Qs, target_Q)
 		if L is not None:
 			L.log('train_critic/loss', critic_loss, step)
 
@@ -102,9 +136,7 @@ class SAC(object):
 
 	def update_actor_and_alpha(self, obs, L=None, step=None, update_alpha=True):
 		_, pi, log_pi, log_std = self.actor(obs, detach=True)
-		actor_Q1, actor_Q2 = self.critic(obs, pi, detach=True)
-
-		actor_Q = torch.min(actor_Q1, actor_Q2)
+		actor_Q = self.reduce_Q(self.critic(obs, pi, detach=True))
 		actor_loss = (self.alpha.detach() * log_pi - actor_Q).mean()
 
 		if L is not None:
@@ -128,24 +160,28 @@ class SAC(object):
 			self.log_alpha_optimizer.step()
 
 	def soft_update_critic_target(self):
-		utils.soft_update_params(
-			self.critic.Q1, self.critic_target.Q1, self.critic_tau
-		)
-		utils.soft_update_params(
-			self.critic.Q2, self.critic_target.Q2, self.critic_tau
-		)
-		utils.soft_update_params(
-			self.critic.encoder, self.critic_target.encoder,
-			self.encoder_tau
-		)
+		self.critic_target_update()
+
+	def feature_cache(self):
+		"""Reuses shared conv features of a batch across the updates that follow the critic update
+
+		The features of the critic pass itself are not reused: the critic step changes the weights of
+		the shared conv layers, so the actor and auxiliary updates must recompute them on the same obs
+		for updates to stay identical. Within the cache, the actor, target and auxiliary updates share
+		one conv pass of obs. Only the auxiliary update, which comes last, steps the shared weights.
+		"""
+		if not self.reuse_features:
+			return nullcontext()
+		return self.critic.encoder.shared_cnn.cache_features()
 
 	def update(self, replay_buffer, L, step):
-		obs, action, reward, next_obs, not_done = replay_buffer.sample()
+		obs, action, reward, next_obs, not_done = replay_buffer.sample_pipeline(self.pipeline)
 
 		self.update_critic(obs, action, reward, next_obs, not_done, L, step)
 
-		if step % self.actor_update_freq == 0:
-			self.update_actor_and_alpha(obs, L, step)
+		with self.feature_cache():
+			if step % self.actor_update_freq == 0:
+				self.update_actor_and_alpha(obs, L, step)
 
-		if step % self.critic_target_update_freq == 0:
-			self.soft_update_critic_target()
+			if step % self.critic_target_update_freq == 0:
+				self.soft_update_critic_target()
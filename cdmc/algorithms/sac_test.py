@@ -0,0 +1,108 @@
+"""Tests of the SAC agent updates."""
+
+import os
+import pickle
+import tempfile
+from collections import deque
+from copy import deepcopy
+from absl.testing import absltest
+from absl.testing import parameterized
+import mock
+import numpy as np
+import torch
+import cdmc.utils as utils
+import cdmc.augmentations as augmentations
+from cdmc.arguments import parse_args
+from cdmc.algorithms.factory import make_agent
+
+_ACTION_SHAPE = (6,)
+
+
+def _make_agent(algorithm):
+	"""Small agent of algorithm and a replay buffer of random transitions for it"""
+	args = parse_args([
+		'--algorithm', algorithm, '--seed', '0', '--device', 'cpu',
+		'--train_context_file', 'none', '--test_context_file', 'none',
+		'--hidden_dim', '32', '--num_shared_layers', '2', '--num_filters', '8',
+		'--projection_dim', '16', '--batch_size', '8',
+		'--soda_batch_size', '8', '--soda_overlay', 'places365_packed'
+	])
+	size, frame_stack = args.image_size, args.frame_stack
+	buffer = utils.ReplayBuffer((3*frame_stack, size, size), _ACTION_SHAPE, 100, args.batch_size, device='cpu')
+	rng = np.random.RandomState(0)
+	frames = deque([rng.randint(0, 256, size=(3, size, size), dtype=np.uint8)]*frame_stack, maxlen=frame_stack)
+	obs = utils.LazyFrames(list(frames))
+	for _ in range(100):
+		frames.append(rng.randint(0, 256, size=(3, size, size), dtype=np.uint8))
+		next_obs = utils.LazyFrames(list(frames))
+		buffer.add(obs, rng.uniform(-1, 1, size=_ACTION_SHAPE), rng.rand(), next_obs, False)
+		obs = next_obs
+	utils.set_seed_everywhere(0)
+	crop = args.image_crop_size
+	return make_agent((3*frame_stack, crop, crop), _ACTION_SHAPE, args), buffer
+
+
+class ReuseFeaturesTest(parameterized.TestCase):
+
+	def setUp(self):
+		super().setUp()
+		# SODA overlays images of a small bank in place of Places
+		images = np.random.RandomState(0).randint(0, 256, size=(16, 3, 96, 96), dtype=np.uint8)
+		tempdir = tempfile.TemporaryDirectory()
+		self.addCleanup(tempdir.cleanup)
+		path = os.path.join(tempdir.name, 'train.npy')
+		np.save(path, images)
+		places_bank = mock.patch.object(augmentations, 'places_bank', augmentations.PlacesBank(path))
+		places_bank.start()
+		self.addCleanup(places_bank.stop)
+
+	@parameterized.parameters('sac', 'rad', 'curl', 'pad', 'soda', 'drq', 'svea')
+	def testReusedFeaturesGiveIdenticalParameters(self, algorithm):
+		agent, buffer = _make_agent(algorithm)
+		agents = {}
+		for reuse_features in [False, True]:
+			agents[reuse_features] = deepcopy(agent)
+			agents[reuse_features].reuse_features = reuse_features
+			utils.set_seed_everywhere(1)
+			# actor and critic target are updated every other step
+			for step in range(1, 5):
+				agents[reuse_features].update(buffer, None, step)
+		modules = ['critic', 'critic_target', 'actor']
+		if algorithm == 'soda':
+			modules += ['predictor', 'predictor_target']
+		for module in modules:
+			params = zip(getattr(agents[False], module).named_parameters(), getattr(agents[True], module).parameters())
+			for (name, a), b in params:
+				self.assertTrue(torch.equal(a, b), f'{module} parameter {name} differs when reusing features')
+
+
+class TargetUpdateTest(parameterized.TestCase):
+
+	@parameterized.parameters('sac', 'soda')
+	def testUnpickledAgentRebuildsTargetUpdates(self, algorithm):
+		agent, _ = _make_agent(algorithm)
+		# agents pickled before the fused target updates were added lack them
+		del agent.critic_target_update
+		pairs = [(agent.critic.Q, agent.critic_target.Q, agent.critic_tau), (agent.critic.encoder, agent.critic_target.encoder, agent.encoder_tau)]
+		if algorithm == 'soda':
+			del agent.predictor_target_update
+			pairs.append((agent.predictor, agent.predictor_target, agent.soda_tau))
+		agent, pairs = pickle.loads(pickle.dumps((agent, pairs)))
+
+		expected = []
+		with torch.no_grad():
+			for net, target_net, tau in pairs:
+				for p, tp in zip(net.parameters(), target_net.parameters()):
+					p.add_(torch.randn_like(p))
+			for net, target_net, tau in pairs:
+				for p, tp in zip(net.parameters(), target_net.parameters()):
+					expected.append((tp, tau * p + (1 - tau) * tp))
+		agent.soft_update_critic_target()
+		if algorithm == 'soda':
+			agent.predictor_target_update()
+		for tp, expected_tp in expected:
+			torch.testing.assert_close(tp, expected_tp)
+
+
+if __name__ == '__main__':
+	absltest.main()
@@ -15,6 +15,7 @@ class SODA(SAC):
 		self.aux_update_freq = args.aux_update_freq
 		self.soda_batch_size = args.soda_batch_size
 		self.soda_tau = args.soda_tau
+		self.soda_pipeline = augmentations.Pipeline(crop=obs_shape[-1], positives=True, overlay=args.soda_overlay)
 
 		shared_cnn = self.critic.encoder.shared_cnn
 		aux_cnn = self.critic.encoder.head_cnn
@@ -24,14 +25,20 @@ class SODA(SAC):
 			m.SODAMLP(aux_cnn.out_shape[0], args.projection_dim, args.projection_dim)
 		)
 
-		self.predictor = m.SODAPredictor(soda_encoder, args.projection_dim).cuda()
+		self.predictor = m.SODAPredictor(soda_encoder, args.projection_dim).to(self.device)
 		self.predictor_target = deepcopy(self.predictor)
+		self._init_target_updates()
 
 		self.soda_optimizer = torch.optim.Adam(
 			self.predictor.parameters(), lr=args.aux_lr, betas=(args.aux_beta, 0.999)
 		)
 		self.train()
 
+	def _init_target_updates(self):
+		super()._init_target_updates()
+		if hasattr(self, 'predictor_target'):
+			self.predictor_target_update = utils.SoftUpdate((self.predictor, self.predictor_target, self.soda_tau))
+
 	def train(self, training=True):
 		super().train(training)
 		if hasattr(self, 'soda_predictor'):
@@ -47,14 +54,7 @@ class SODA(SAC):
 		return F.mse_loss(h0, h1)
 
 	def update_soda(self, replay_buffer, L=None, step=None):
-		x = replay_buffer.sample_soda(self.soda_batch_size)
-		assert x.size(-1) == 100
-
-		aug_x = x.clone()
-
-		x = augmentations.random_crop(x)
-		aug_x = augmentations.random_crop(aug_x)
-		aug_x = augmentations.random_overlay(aug_x)
+		x, aug_x = replay_buffer.sample_soda(self.soda_batch_size, self.soda_pipeline)
 
 		soda_loss = self.compute_soda_loss(aug_x, x)
 		
@@ -64,21 +64,19 @@ class SODA(SAC):
 		if L is not None:
 			L.log('train/aux_loss', soda_loss, step)
 
-		utils.soft_update_params(
-			self.predictor, self.predictor_target,
-			self.soda_tau
-		)
+		self.predictor_target_update()
 
 	def update(self, replay_buffer, L, step):
-		obs, action, reward, next_obs, not_done = replay_buffer.sample()
+		obs, action, reward, next_obs, not_done = replay_buffer.sample_pipeline(self.pipeline)
 
 		self.update_critic(obs, action, reward, next_obs, not_done, L, step)
 
-		if step % self.actor_update_freq == 0:
-			self.update_actor_and_alpha(obs, L, step)
+		with self.feature_cache():
+			if step % self.actor_update_freq == 0:
+				self.update_actor_and_alpha(obs, L, step)
 
-		if step % self.critic_target_update_freq == 0:
-			self.soft_update_critic_target()
+			if step % self.critic_target_update_freq == 0:
+				self.soft_update_critic_target()
 
-		if step % self.aux_update_freq == 0:
-			self.update_soda(replay_buffer, L, step)
+			if step % self.aux_update_freq == 0:
+				self.update_soda(replay_buffer, L, step)
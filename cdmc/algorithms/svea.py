@@ -14,13 +14,13 @@ class SVEA(SAC):
 		super().__init__(obs_shape, action_shape, args)
 		self.svea_alpha = args.svea_alpha
 		self.svea_beta = args.svea_beta
+		self.pipeline = augmentations.Pipeline(shift=4)
 
 	def update_critic(self, obs, action, reward, next_obs, not_done, L=None, step=None):
 		with torch.no_grad():
 			_, policy_action, log_pi, _ = self.actor(next_obs)
-			target_Q1, target_Q2 = self.critic_target(next_obs, policy_action)
-			target_V = torch.min(target_Q1,
-								 target_Q2) - self.alpha.detach() * log_pi
+			target_Qs = self.critic_target(next_obs, policy_action)
+			target_V = self.reduce_Q(target_Qs) - self.alpha.detach() * log_pi
 			target_Q = reward + (not_done * self.discount * target_V)
 
 		if self.svea_alpha == self.svea_beta:
@@ -28,18 +28,15 @@ class SVEA(SAC):
 			action = utils.cat(action, action)
 			target_Q = utils.cat(target_Q, target_Q)
 
-			current_Q1, current_Q2 = self.critic(obs, action)
-			critic_loss = (self.svea_alpha + self.svea_beta) * \
-				(F.mse_loss(current_Q1, target_Q) + F.mse_loss(current_Q2, target_Q))
+			current_Qs = self.critic(obs, action)
+			critic_loss = (self.svea_alpha + self.svea_beta) * self.critic_loss(current_Qs, target_Q)
 		else:
-			current_Q1, current_Q2 = self.critic(obs, action)
-			critic_loss = self.svea_alpha * \
-				(F.mse_loss(current_Q1, target_Q) + F.mse_loss(current_Q2, target_Q))
+			current_Qs = self.critic(obs, action)
+			critic_loss = self.svea_alpha * self.critic_loss(current_Qs, target_Q)
 
 			obs_aug = augmentations.random_conv(obs.clone())
-			current_Q1_aug, current_Q2_aug = self.critic(obs_aug, action)
-			critic_loss += self.svea_beta * \
-				(F.mse_loss(current_Q1_aug, target_Q) + F.mse_loss(current_Q2_aug, target_Q))
+			current_Qs_aug = self.critic(obs_aug, action)
+			critic_loss += self.svea_beta * self.critic_loss(current_Qs_aug, target_Q)
 
 		if L is not None:
 			L.log('train_critic/loss', critic_loss, step)
@@ -49,12 +46,13 @@ class SVEA(SAC):
 		self.critic_optimizer.step()
 
 	def update(self, replay_buffer, L, step):
-		obs, action, reward, next_obs, not_done = replay_buffer.sample_svea()
+		obs, action, reward, next_obs, not_done = replay_buffer.sample_pipeline(self.pipeline)
 
 		self.update_critic(obs, action, reward, next_obs, not_done, L, step)
 
-		if step % self.actor_update_freq == 0:
-			self.update_actor_and_alpha(obs, L, step)
+		with self.feature_cache():
+			if step % self.actor_update_freq == 0:
+				self.update_actor_and_alpha(obs, L, step)
 
-		if step % self.critic_target_update_freq == 0:
-			self.soft_update_critic_target()
+			if step % self.critic_target_update_freq == 0:
+				self.soft_update_critic_target()
@@ -1,8 +1,9 @@
 import argparse
 import numpy as np
+from cdmc.env.rendering import BACKENDS
 
 
-def parse_args():
+def parse_args(argv=None):
 	parser = argparse.ArgumentParser()
 
 	# environment
@@ -13,6 +14,8 @@ def parse_args():
 	parser.add_argument('--episode_length', default=1000, type=int)
 	parser.add_argument('--train_context_file', default=None, type=str)
 	parser.add_argument('--test_context_file', default=None, type=str)
+	parser.add_argument('--video_cache_mb', default=2048, type=int)
+	parser.add_argument('--render_backend', default=None, type=str, choices=BACKENDS)
 	
 	# agent
 	parser.add_argument('--algorithm', default='sac', type=str)
@@ -21,6 +24,10 @@ def parse_args():
 	parser.add_argument('--init_steps', default=1000, type=int)
 	parser.add_argument('--batch_size', default=128, type=int)
 	parser.add_argument('--hidden_dim', default=1024, type=int)
+	parser.add_argument('--replay_capacity', default=None, type=str)
+	parser.add_argument('--replay_memory_gb', default=None, type=float)
+	parser.add_argument('--replay_storage', default='memory', type=str, choices=['memory', 'disk'])
+	parser.add_argument('--prefetch_batches', default=2, type=int)
 
 	# actor
 	parser.add_argument('--actor_lr', default=1e-3, type=float)
@@ -34,6 +41,8 @@ def parse_args():
 	parser.add_argument('--critic_beta', default=0.9, type=float)
 	parser.add_argument('--critic_tau', default=0.01, type=float)
 	parser.add_argument('--critic_target_update_freq', default=2, type=int)
+	parser.add_argument('--num_qs', default=2, type=int)
+	parser.add_argument('--q_reduction', default='min', type=str, choices=['min', 'mean'])
 
 	# architecture
 	parser.add_argument('--num_shared_layers', default=11, type=int)
@@ -55,6 +64,11 @@ def parse_args():
 	# soda
 	parser.add_argument('--soda_batch_size', default=256, type=int)
 	parser.add_argument('--soda_tau', default=0.005, type=float)
+	parser.add_argument('--soda_overlay', default='places365_standard', type=str, choices=['places365_standard', 'places365_packed'])
+
+	# drq
+	parser.add_argument('--drq_K', default=1, type=int)
+	parser.add_argument('--drq_M', default=1, type=int)
 
 	# svea
 	parser.add_argument('--svea_alpha', default=0.5, type=float)
@@ -64,13 +78,17 @@ def parse_args():
 	parser.add_argument('--save_freq', default='100k', type=str)
 	parser.add_argument('--eval_freq', default='25k', type=str)
 	parser.add_argument('--eval_episodes', default=30, type=int)
+	parser.add_argument('--eval_envs', default=10, type=int)
+	parser.add_argument('--eval_in_flight', default=1, type=int)
 
 	# misc
 	parser.add_argument('--seed', default=None, type=int)
+	parser.add_argument('--device', default='cuda', type=str)
 	parser.add_argument('--log_dir', default='logs', type=str)
 	parser.add_argument('--save_video', default=False, action='store_true')
+	parser.add_argument('--resume', default=False, action='store_true')
 
-	args = parser.parse_args()
+	args = parser.parse_args(argv)
 
 	assert args.algorithm in {'sac', 'rad', 'curl', 'pad', 'soda', 'drq', 'svea'}, f'specified algorithm "{args.algorithm}" is not supported'
 
@@ -83,6 +101,11 @@ def parse_args():
 	args.train_steps = int(args.train_steps.replace('k', '000'))
 	args.save_freq = int(args.save_freq.replace('k', '000'))
 	args.eval_freq = int(args.eval_freq.replace('k', '000'))
+	if args.replay_capacity is None:
+		# one transition per step plus one slot for the first frame of each episode
+		args.replay_capacity = args.train_steps + args.train_steps // (args.episode_length // args.action_repeat) + 1
+	else:
+		args.replay_capacity = int(args.replay_capacity.replace('k', '000'))
 
 	if args.algorithm in {'rad', 'curl', 'pad', 'soda'}:
 		args.image_size = 100
@@ -3,13 +3,13 @@ import torch
 import torch.nn.functional as F
 import torchvision.transforms as TF
 import torchvision.datasets as datasets
-import kornia
 import cdmc.utils as utils
 import os
 
 
 places_dataloader = None
 places_iter = None
+places_bank = None
 
 
 def _load_places(batch_size=256, image_size=84, num_workers=16, use_val=False):
@@ -37,7 +37,7 @@ def _load_places(batch_size=256, image_size=84, num_workers=16, use_val=False):
 	print('Loaded dataset from', data_dir)
 
 
-def _get_places_batch(batch_size):
+def _get_places_batch(batch_size, device):
 	global places_iter
 	try:
 		imgs, _ = next(places_iter)
@@ -47,7 +47,42 @@ def _get_places_batch(batch_size):
 	except StopIteration:
 		places_iter = iter(places_dataloader)
 		imgs, _ = next(places_iter)
-	return imgs.cuda()
+	return imgs.to(device)
+
+
+class PlacesBank(object):
+	"""Memory-mapped bank of Places images packed by pack_places.py, sampled without worker processes
+
+	Images are stored as a (N, 3, S, S) uint8 .npy file. Batches are drawn uniformly at random and
+	randomly cropped to the requested size and horizontally flipped, in place of the random
+	resized crops and flips of the ImageFolder pipeline.
+	"""
+	def __init__(self, path):
+		self.path = path
+		self.images = np.load(path, mmap_mode='r')
+
+	def sample(self, batch_size, image_size, device):
+		assert image_size <= self.images.shape[-1], \
+			f'cannot sample {image_size}px images from a bank of {self.images.shape[-1]}px images'
+		idxs = np.sort(np.random.randint(0, len(self.images), size=batch_size))
+		imgs = torch.as_tensor(self.images[idxs]).to(device)
+		imgs = random_crop(imgs, size=image_size)
+		flip = torch.rand(batch_size, device=device) < 0.5
+		imgs = torch.where(flip[:, None, None, None], imgs.flip(-1), imgs)
+		return imgs.float() / 255.
+
+
+def _load_places_bank(use_val=False):
+	global places_bank
+	partition = 'val' if use_val else 'train'
+	for data_dir in utils.load_config('datasets'):
+		fp = os.path.join(data_dir, 'places365_packed', f'{partition}.npy')
+		if os.path.exists(fp):
+			places_bank = PlacesBank(fp)
+			break
+	if places_bank is None:
+		raise FileNotFoundError('failed to find packed places365 data at any of the specified paths, see pack_places.py')
+	print(f'Loaded {len(places_bank.images)} packed images from', fp)
 
 
 def random_overlay(x, dataset='places365_standard'):
@@ -58,23 +93,30 @@ def random_overlay(x, dataset='places365_standard'):
 	if dataset == 'places365_standard':
 		if places_dataloader is None:
 			_load_places(batch_size=x.size(0), image_size=x.size(-1))
-		imgs = _get_places_batch(batch_size=x.size(0)).repeat(1, x.size(1)//3, 1, 1)
+		imgs = _get_places_batch(batch_size=x.size(0), device=x.device).repeat(1, x.size(1)//3, 1, 1)
+	elif dataset == 'places365_packed':
+		if places_bank is None:
+			_load_places_bank()
+		imgs = places_bank.sample(x.size(0), x.size(-1), x.device).repeat(1, x.size(1)//3, 1, 1)
 	else:
 		raise NotImplementedError(f'overlay has not been implemented for dataset "{dataset}"')
 
 	return ((1-alpha)*(x/255.) + (alpha)*imgs)*255.
 
 
-def random_conv(x):
-	"""Applies a random conv2d, deviates slightly from https://arxiv.org/abs/1910.05396"""
+def random_conv(x, generator=None):
+	"""Applies a random conv2d, deviates slightly from https://arxiv.org/abs/1910.05396
+
+	Each sample gets its own kernel, shared by its stacked frames. All samples are convolved in a
+	single grouped conv2d, with samples as groups and frames along the batch dimension. Kernels are
+	drawn with generator if specified, which must be on the same device as x.
+	"""
 	n, c, h, w = x.shape
-	for i in range(n):
-		weights = torch.randn(3, 3, 3, 3).to(x.device)
-		temp_x = x[i:i+1].reshape(-1, 3, h, w)/255.
-		temp_x = F.pad(temp_x, pad=[1]*4, mode='replicate')
-		out = torch.sigmoid(F.conv2d(temp_x, weights))*255.
-		total_out = out if i == 0 else torch.cat([total_out, out], axis=0)
-	return total_out.reshape(n, c, h, w)
+	weights = torch.randn(n*3, 3, 3, 3, device=x.device, generator=generator)
+	temp_x = x.reshape(n, -1, 3, h, w).transpose(0, 1).reshape(-1, n*3, h, w)/255.
+	temp_x = F.pad(temp_x, pad=[1]*4, mode='replicate')
+	out = torch.sigmoid(F.conv2d(temp_x, weights, groups=n))*255.
+	return out.reshape(-1, n, 3, h, w).transpose(0, 1).reshape(n, c, h, w)
 
 
 def batch_from_obs(obs, batch_size=32):
@@ -89,32 +131,54 @@ def batch_from_obs(obs, batch_size=32):
 	return np.repeat(obs, repeats=batch_size, axis=0)
 
 
-def prepare_pad_batch(obs, next_obs, action, batch_size=32):
+def prepare_pad_batch(obs, next_obs, action, batch_size=32, device='cuda'):
 	"""Prepare batch for self-supervised policy adaptation at test-time"""
-	batch_obs = batch_from_obs(torch.from_numpy(obs).cuda(), batch_size)
-	batch_next_obs = batch_from_obs(torch.from_numpy(next_obs).cuda(), batch_size)
-	batch_action = torch.from_numpy(action).cuda().unsqueeze(0).repeat(batch_size, 1)
+	batch_obs = batch_from_obs(torch.as_tensor(np.asarray(obs), dtype=torch.float32, device=device), batch_size)
+	batch_next_obs = batch_from_obs(torch.as_tensor(np.asarray(next_obs), dtype=torch.float32, device=device), batch_size)
+	batch_action = torch.as_tensor(action, dtype=torch.float32, device=device).unsqueeze(0).repeat(batch_size, 1)
 
-	return random_crop_cuda(batch_obs), random_crop_cuda(batch_next_obs), batch_action
+	return random_crop(batch_obs), random_crop(batch_next_obs), batch_action
 
 
 def identity(x):
 	return x
 
 
-def random_shift(imgs, pad=4):
-	"""Vectorized random shift, imgs: (B,C,H,W), pad: #pixels"""
-	_,_,h,w = imgs.shape
-	imgs = F.pad(imgs, (pad, pad, pad, pad), mode='replicate')
-	return kornia.augmentation.RandomCrop((h, w))(imgs)
+def _window_indices(m, in_size, size, low, high, device, generator=None):
+	"""Indices along one image axis of m windows of size pixels, offset by random integers in [low, high)
+
+	Indices outside the image are clamped, which is equivalent to replicate padding.
+	"""
+	offsets = torch.randint(low, high, (m, 1), device=device, generator=generator)
+	return (offsets + torch.arange(size, device=device)).clamp_(0, in_size - 1)
+
+
+def _gather_windows(x, rows, cols, src=None):
+	"""Gathers the (rows, cols) window of every image x[src] in one indexing operation"""
+	if src is None:
+		src = torch.arange(x.size(0), device=x.device)
+	channels = torch.arange(x.size(1), device=x.device)
+	return x[src[:, None, None, None], channels[None, :, None, None], rows[:, None, :, None], cols[:, None, None, :]]
+
+
+def random_shift(imgs, pad=4, generator=None):
+	"""Vectorized random shift, imgs: (B,C,H,W), pad: #pixels
+
+	Every image is shifted by integers drawn uniformly from [-pad, pad] along each axis, with
+	replicate padding. generator must be on the same device as imgs.
+	"""
+	n, _, h, w = imgs.shape
+	rows = _window_indices(n, h, h, -pad, pad + 1, imgs.device, generator)
+	cols = _window_indices(n, w, w, -pad, pad + 1, imgs.device, generator)
+	return _gather_windows(imgs, rows, cols)
 
 
 def random_crop(x, size=84, w1=None, h1=None, return_w1_h1=False):
-	"""Vectorized CUDA implementation of random crop, imgs: (B,C,H,W), size: output size"""
+	"""Vectorized implementation of random crop, imgs: (B,C,H,W), size: output size"""
 	assert (w1 is None and h1 is None) or (w1 is not None and h1 is not None), \
 		'must either specify both w1 and h1 or neither of them'
-	assert isinstance(x, torch.Tensor) and x.is_cuda, \
-		'input must be CUDA tensor'
+	assert isinstance(x, torch.Tensor), \
+		'input must be a tensor'
 	
 	n = x.shape[0]
 	img_size = x.shape[-1]
@@ -131,7 +195,7 @@ def random_crop(x, size=84, w1=None, h1=None, return_w1_h1=False):
 		w1 = torch.LongTensor(n).random_(0, crop_max)
 		h1 = torch.LongTensor(n).random_(0, crop_max)
 
-	windows = view_as_windows_cuda(x, (1, size, size, 1))[..., 0,:,:, 0]
+	windows = view_as_windows(x, (1, size, size, 1))[..., 0,:,:, 0]
 	cropped = windows[torch.arange(n), w1, h1]
 
 	if return_w1_h1:
@@ -140,8 +204,62 @@ def random_crop(x, size=84, w1=None, h1=None, return_w1_h1=False):
 	return cropped
 
 
-def view_as_windows_cuda(x, window_shape):
-	"""PyTorch CUDA-enabled implementation of view_as_windows"""
+class Pipeline(object):
+	"""Declarative augmentation of sampled image batches
+
+	crop: random crop to this size, shift: random shift by up to this many pixels with replicate
+	padding. Crops and shifts of all images in a batch are a single gather with one shared index
+	tensor, with shifts clamping indices instead of padding, and uint8 inputs are converted to
+	float after cropping. The first num_obs images (obs) are augmented obs_views times and the
+	rest (next_obs) next_obs_views times, independently and ordered view-major. If positives is
+	set, an independently cropped or shifted second view of the obs is made in the same gather,
+	and random_overlay with dataset overlay is applied to those views only.
+	"""
+	def __init__(self, crop=None, shift=None, positives=False, overlay=None, obs_views=1, next_obs_views=1):
+		assert crop is None or shift is None, 'cannot both crop and shift'
+		assert positives or overlay is None, 'overlay is only applied to positives'
+		self.crop = crop
+		self.shift = shift
+		self.positives = positives
+		self.overlay = overlay
+		self.obs_views = obs_views
+		self.next_obs_views = next_obs_views
+
+	def _indices(self, m, in_size, device):
+		"""Indices along one image axis of the output pixels of m crops or shifts"""
+		if self.crop is not None and self.crop < in_size:
+			return _window_indices(m, in_size, self.crop, 0, in_size - self.crop, device)
+		if self.shift:
+			return _window_indices(m, in_size, in_size, -self.shift, self.shift + 1, device)
+		return None
+
+	def _gather(self, x, src):
+		rows = self._indices(len(src), x.size(2), x.device)
+		cols = self._indices(len(src), x.size(3), x.device)
+		if rows is None:
+			return x[src]
+		return _gather_windows(x, rows, cols, src)
+
+	def __call__(self, x, num_obs=None):
+		"""Augments x (B,C,H,W), returns the augmented batch and, if positives is set, the positive views"""
+		idxs = torch.arange(x.size(0), device=x.device)
+		obs, next_obs = idxs[:num_obs], idxs[len(idxs[:num_obs]):]
+		src = [obs] * self.obs_views + [next_obs] * self.next_obs_views
+		n = sum(len(s) for s in src)
+		if self.positives:
+			src.append(obs)
+		out = self._gather(x, torch.cat(src)).float()
+		if not self.positives:
+			return out
+
+		out, pos = out[:n], out[n:]
+		if self.overlay is not None:
+			pos = random_overlay(pos, self.overlay)
+		return out, pos
+
+
+def view_as_windows(x, window_shape):
+	"""PyTorch implementation of view_as_windows, for tensors on any device"""
 	assert isinstance(window_shape, tuple) and len(window_shape) == len(x.shape), \
 		'window_shape must be a tuple with same number of dimensions as x'
 	
@@ -0,0 +1,184 @@
+"""Tests of the augmentations."""
+
+from absl.testing import absltest
+from absl.testing import parameterized
+import torch
+import torch.nn.functional as F
+import cdmc.augmentations as augmentations
+
+
+def _random_conv_loop(x, generator=None):
+	"""random_conv as a loop over samples with one conv2d each, as before it was grouped
+
+	Kernels of all samples are drawn in one call, since separate calls consume the random stream differently.
+	"""
+	n, c, h, w = x.shape
+	weights = torch.randn(n*3, 3, 3, 3, device=x.device, generator=generator)
+	out = []
+	for i in range(n):
+		temp_x = F.pad(x[i:i+1].reshape(-1, 3, h, w)/255., pad=[1]*4, mode='replicate')
+		out.append(torch.sigmoid(F.conv2d(temp_x, weights[3*i:3*i+3]))*255.)
+	return torch.cat(out, axis=0).reshape(n, c, h, w)
+
+
+def _images(n, frames, size=32, seed=0):
+	generator = torch.Generator().manual_seed(seed)
+	return torch.randint(0, 256, (n, 3*frames, size, size), generator=generator).float()
+
+
+class RandomConvTest(parameterized.TestCase):
+
+	@parameterized.parameters((1, 1), (4, 3), (7, 2))
+	def testMatchesPerSampleLoop(self, n, frames):
+		x = _images(n, frames)
+		expected = _random_conv_loop(x, torch.Generator().manual_seed(1))
+		out = augmentations.random_conv(x, generator=torch.Generator().manual_seed(1))
+		self.assertEqual(out.shape, x.shape)
+		torch.testing.assert_close(out, expected, rtol=1e-5, atol=1e-3)
+
+	def testSeededGenerator(self):
+		x = _images(4, 3)
+		torch.manual_seed(0)
+		expected_draw = torch.randn(1)
+		torch.manual_seed(0)
+		a = augmentations.random_conv(x, generator=torch.Generator().manual_seed(1))
+		b = augmentations.random_conv(x, generator=torch.Generator().manual_seed(1))
+		c = augmentations.random_conv(x, generator=torch.Generator().manual_seed(2))
+		torch.testing.assert_close(a, b, rtol=0, atol=0)
+		self.assertFalse(torch.allclose(a, c))
+		# the global generator is left untouched
+		torch.testing.assert_close(torch.randn(1), expected_draw, rtol=0, atol=0)
+
+	def testGlobalSeed(self):
+		x = _images(4, 3)
+		torch.manual_seed(0)
+		a = augmentations.random_conv(x)
+		torch.manual_seed(0)
+		torch.testing.assert_close(augmentations.random_conv(x), a, rtol=0, atol=0)
+
+
+def _random_shift_kornia(imgs, pad=4):
+	"""random_shift as before the native implementation, replicate padding followed by kornia's RandomCrop"""
+	import kornia
+	_, _, h, w = imgs.shape
+	imgs = F.pad(imgs, (pad, pad, pad, pad), mode='replicate')
+	return kornia.augmentation.RandomCrop((h, w))(imgs)
+
+
+def _shifts(shift_fn, num_samples, pad):
+	"""(row, col) shifts applied by shift_fn, read off the center pixel of images with unique pixel values"""
+	size = 4*pad + 1
+	x = torch.arange(size*size, dtype=torch.float32).reshape(1, 1, size, size).repeat(num_samples, 1, 1, 1)
+	center = shift_fn(x, pad)[:, 0, size//2, size//2].long()
+	return center // size - size//2, center % size - size//2
+
+
+def _shift_counts(shift_fn, num_samples, pad):
+	drow, dcol = _shifts(shift_fn, num_samples, pad)
+	counts = torch.zeros(2*pad+1, 2*pad+1, dtype=torch.float64)
+	counts.index_put_((drow + pad, dcol + pad), torch.ones(num_samples, dtype=torch.float64), accumulate=True)
+	return counts.flatten()
+
+
+def _chi2_critical_value(df, z=3.09):
+	"""Upper quantile of the chi-square distribution with df degrees of freedom, by the Wilson-Hilferty approximation
+
+	The default z is the 99.9% quantile of the standard normal, so a correct sampler fails with probability 0.001.
+	"""
+	return df * (1 - 2 / (9*df) + z * (2 / (9*df))**0.5)**3
+
+
+class RandomShiftTest(parameterized.TestCase):
+
+	@parameterized.parameters(1, 4)
+	def testShiftsAreUniform(self, pad):
+		torch.manual_seed(0)
+		counts = _shift_counts(augmentations.random_shift, 50000, pad)
+		# chi-square goodness of fit against the uniform distribution over all shifts
+		expected = 50000 / len(counts)
+		chi2 = ((counts - expected)**2 / expected).sum().item()
+		self.assertLess(chi2, _chi2_critical_value(len(counts) - 1))
+
+	def testShiftDistributionMatchesKornia(self):
+		try:
+			import kornia
+		except ImportError:
+			self.skipTest('kornia is not installed')
+		torch.manual_seed(0)
+		native = _shift_counts(augmentations.random_shift, 50000, 4)
+		torch.manual_seed(0)
+		baseline = _shift_counts(_random_shift_kornia, 50000, 4)
+		# chi-square test of homogeneity of two samples of equal size
+		total = native + baseline
+		observed = total > 0
+		chi2 = ((native - baseline)[observed]**2 / total[observed]).sum().item()
+		self.assertLess(chi2, _chi2_critical_value(observed.sum().item() - 1))
+
+	def testShiftedImagesArePaddedCrops(self):
+		pad = 4
+		x = _images(16, 3, size=20)
+		generator = torch.Generator().manual_seed(0)
+		out = augmentations.random_shift(x, pad, generator=generator)
+		generator.manual_seed(0)
+		drow, dcol = _shifts(lambda x, pad: augmentations.random_shift(x, pad, generator=generator), 16, pad)
+		padded = F.pad(x, (pad, pad, pad, pad), mode='replicate')
+		for i in range(len(x)):
+			top, left = pad + drow[i].item(), pad + dcol[i].item()
+			torch.testing.assert_close(out[i], padded[i, :, top:top+20, left:left+20], rtol=0, atol=0)
+
+	def testSeededGenerator(self):
+		x = _images(16, 3)
+		outs = [augmentations.random_shift(x, 4, generator=torch.Generator().manual_seed(1)) for _ in range(2)]
+		torch.testing.assert_close(outs[0], outs[1], rtol=0, atol=0)
+
+
+def _offsets(seed, m, low, high):
+	"""Row and column offsets a Pipeline draws for m images after torch.manual_seed(seed)"""
+	torch.manual_seed(seed)
+	rows = torch.randint(low, high, (m, 1))
+	cols = torch.randint(low, high, (m, 1))
+	return rows[:, 0], cols[:, 0]
+
+
+class PipelineTest(absltest.TestCase):
+	"""Pipelines against random_crop and padded crops of the sample methods they replace"""
+
+	def _batch(self, n):
+		return _images(2*n, 3, size=100).to(torch.uint8)
+
+	def testCropMatchesRandomCrop(self):
+		x = self._batch(4)
+		torch.manual_seed(0)
+		out = augmentations.Pipeline(crop=84)(x, num_obs=4)
+		rows, cols = _offsets(0, 8, 0, 16)
+		expected = augmentations.random_crop(x.float(), 84, w1=rows, h1=cols)
+		self.assertEqual(out.dtype, torch.float32)
+		torch.testing.assert_close(out, expected, rtol=0, atol=0)
+
+	def testPositivesMatchRandomCropOfObs(self):
+		x = self._batch(4)
+		torch.manual_seed(0)
+		out, pos = augmentations.Pipeline(crop=84, positives=True)(x, num_obs=4)
+		# obs, next_obs and then the positives are cropped in one gather
+		rows, cols = _offsets(0, 12, 0, 16)
+		x = x.float()
+		torch.testing.assert_close(out, augmentations.random_crop(x, 84, w1=rows[:8], h1=cols[:8]), rtol=0, atol=0)
+		torch.testing.assert_close(pos, augmentations.random_crop(x[:4], 84, w1=rows[8:], h1=cols[8:]), rtol=0, atol=0)
+
+	def testShiftedViewsArePaddedCrops(self):
+		pad, n = 4, 4
+		x = self._batch(n)
+		torch.manual_seed(0)
+		out = augmentations.Pipeline(shift=pad, obs_views=2, next_obs_views=3)(x, num_obs=n)
+		# views are ordered view-major, obs views first
+		src = list(range(n)) * 2 + list(range(n, 2*n)) * 3
+		rows, cols = _offsets(0, len(src), -pad, pad + 1)
+		padded = F.pad(x.float(), (pad, pad, pad, pad), mode='replicate')
+		self.assertEqual(out.shape, (len(src), *x.shape[1:]))
+		for i, j in enumerate(src):
+			top, left = pad + rows[i].item(), pad + cols[i].item()
+			torch.testing.assert_close(out[i], padded[j, :, top:top+100, left:left+100], rtol=0, atol=0)
+
+
+if __name__ == '__main__':
+	absltest.main()
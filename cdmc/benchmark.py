@@ -0,0 +1,417 @@
+import argparse
+import time
+_start_time = time.time()
+import os
+import sys
+import subprocess
+import json
+import tracemalloc
+import numpy as np
+import torch
+import torch.nn.functional as F
+from collections import deque
+from copy import deepcopy
+import cdmc.utils as utils
+import cdmc.augmentations as augmentations
+import cdmc.env.rendering as rendering
+# dm_control sets up the rendering backend on import
+rendering.select_backend(rendering.parse_backend())
+from cdmc.arguments import parse_args as parse_train_args
+from cdmc.algorithms.factory import make_agent
+from cdmc.evaluation import evaluate_batch
+from cdmc.env.wrappers import make_env, do_green_screen
+from dm_control import suite
+from dm_control.mujoco import Camera
+
+
+def _timeit(fn, repeats):
+	"""Returns mean wall-clock seconds per call of fn"""
+	fn()
+	start = time.time()
+	for _ in range(repeats):
+		fn()
+	return (time.time() - start) / repeats
+
+
+def _make_context_env(args, **kwargs):
+	"""Makes an environment for the contexts in args.context_file"""
+	with open(args.context_file, 'r') as file:
+		contexts = json.load(file)
+	env = make_env(
+		domain_name=args.domain_name,
+		task_name=args.task_name,
+		seed=args.seed,
+		action_repeat=args.action_repeat,
+		image_size=args.image_size,
+		states=contexts['states'],
+		video_paths=contexts['video_paths'],
+		colors=[dict([(k, np.array(v)) for k,v in color_dict.items()]) for color_dict in contexts['colors']],
+		**kwargs
+	)
+	num_contexts = max(contexts['states'] if isinstance(contexts['states'], int) else len(contexts['states']), len(contexts['video_paths']), len(contexts['colors']), 1)
+	return env, num_contexts
+
+
+def _green_frames(n, size, seed=0):
+	"""Random frames with a green-screened region, mimicking rendered observations"""
+	rng = np.random.RandomState(seed)
+	x = rng.randint(0, 256, size=(n, 3, size, size)).astype(np.uint8)
+	x[:, 0, :size//2] = 51
+	x[:, 1, :size//2] = 204
+	x[:, 2, :size//2] = 51
+	bg = rng.randint(0, 256, size=(n, 3, size, size)).astype(np.uint8)
+	return x, bg
+
+
+def bench_greenscreen(args):
+	"""Chroma-key compositing throughput for single frames and frame stacks"""
+	for size in args.sizes:
+		x, bg = _green_frames(args.batch_size, size)
+		t_single = _timeit(lambda: do_green_screen(x[0], bg[0]), args.repeats)
+		t_batch = _timeit(lambda: do_green_screen(x, bg), args.repeats)
+		print(f'greenscreen | {size}px | single: {1/t_single:.1f} frames/s | batch of {args.batch_size}: {args.batch_size/t_batch:.1f} frames/s')
+
+
+def bench_reset(args):
+	"""Reset latency when remaking vs. reseeding the DMC environment"""
+	for reuse_env in [False, True]:
+		env, num_contexts = _make_context_env(args, reuse_env=reuse_env)
+		num_resets = num_contexts * args.rounds
+		start = time.time()
+		for _ in range(num_resets):
+			env.reset()
+		t = (time.time() - start) / num_resets
+		print(f'reset | reuse_env={reuse_env} | {1000*t:.1f} ms/reset over {num_resets} resets')
+
+
+def bench_reset_gl(args):
+	"""Reset latency with colour contexts when recompiling the model, with and without keeping the rendering contexts"""
+	for reuse_gl_context in [False, True]:
+		env, num_contexts = _make_context_env(args, reuse_gl_context=reuse_gl_context)
+		assert env._num_colors > 0, 'context file must contain colours'
+		# time the model reloads rather than the in-place recolouring of textures
+		env._recolor_physics = lambda setting_kwargs: False
+		num_resets = num_contexts * args.rounds
+		start = time.time()
+		for _ in range(num_resets):
+			env.reset()
+		t = (time.time() - start) / num_resets
+		print(f'reset_gl | reuse_gl_context={reuse_gl_context} | {1000*t:.1f} ms/reset over {num_resets} resets')
+
+
+def _fill_replay_buffer(buffer, num_transitions, frame_stack, size, episode_length=250, seed=0):
+	"""Adds transitions of synthetic episodes, stacking frames like the FrameStack wrapper"""
+	rng = np.random.RandomState(seed)
+	frames = deque([], maxlen=frame_stack)
+	for t in range(num_transitions):
+		if t % episode_length == 0:
+			frame = rng.randint(0, 256, size=(3, size, size), dtype=np.uint8)
+			for _ in range(frame_stack):
+				frames.append(frame)
+			obs = utils.LazyFrames(list(frames))
+		frames.append(rng.randint(0, 256, size=(3, size, size), dtype=np.uint8))
+		next_obs = utils.LazyFrames(list(frames))
+		buffer.add(obs, rng.uniform(-1, 1, size=(6,)), rng.rand(), next_obs, False)
+		obs = next_obs
+
+
+def bench_replay(args):
+	"""Memory footprint and host-side batch sampling throughput of the replay buffers"""
+	obs_shape = (3*args.frame_stack, args.image_size, args.image_size)
+	buffers = {
+		'lazy_frames': lambda: utils.LazyFrameReplayBuffer(obs_shape, (6,), args.replay_transitions, args.batch_size),
+		'frame_ring': lambda: utils.ReplayBuffer(obs_shape, (6,), args.replay_transitions, args.batch_size, prefill=False),
+	}
+	for name, make_buffer in buffers.items():
+		tracemalloc.start()
+		buffer = make_buffer()
+		_fill_replay_buffer(buffer, args.replay_transitions, args.frame_stack, args.image_size)
+		memory, _ = tracemalloc.get_traced_memory()
+		tracemalloc.stop()
+
+		def sample():
+			idxs = buffer._get_idxs()
+			buffer._encode_obses(idxs)
+			buffer.actions[idxs % buffer.capacity]
+		t = _timeit(sample, args.repeats)
+		print(f'replay | {name} | {args.replay_transitions} transitions at {args.image_size}px | {memory/1024**2:.0f} MB | {1/t:.1f} batches/s ({args.batch_size/t:.0f} samples/s)')
+		del buffer
+
+
+def _random_conv_loop(x):
+	"""Per-sample random_conv, used as a baseline"""
+	n, c, h, w = x.shape
+	out = []
+	for i in range(n):
+		weights = torch.randn(3, 3, 3, 3, device=x.device)
+		temp_x = F.pad(x[i:i+1].reshape(-1, 3, h, w)/255., pad=[1]*4, mode='replicate')
+		out.append(torch.sigmoid(F.conv2d(temp_x, weights))*255.)
+	return torch.cat(out, axis=0).reshape(n, c, h, w)
+
+
+def _timeit_device(fn, repeats, device):
+	"""_timeit for functions that launch asynchronous device work"""
+	def run():
+		fn()
+		if device.type == 'cuda':
+			torch.cuda.synchronize(device)
+	return _timeit(run, repeats)
+
+
+def bench_random_conv(args):
+	"""Throughput and output statistics of the per-sample loop and the grouped random_conv"""
+	device = torch.device(args.device)
+	for batch_size in args.aug_batch_sizes:
+		torch.manual_seed(args.seed)
+		x = torch.randint(0, 256, (batch_size, 3*args.frame_stack, args.image_size, args.image_size), device=device).float()
+		for name, fn in [('loop', _random_conv_loop), ('grouped', augmentations.random_conv)]:
+			torch.manual_seed(args.seed)
+			out = fn(x)
+			t = _timeit_device(lambda: fn(x), args.repeats, device)
+			print(f'random_conv | {name} | batch {batch_size} at {args.image_size}px on {device} | {1000*t:.1f} ms/batch | output mean {out.mean():.1f}, std {out.std():.1f}')
+
+
+def _random_shift_kornia(imgs, pad=4):
+	"""Replicate padding followed by kornia's RandomCrop, used as a baseline"""
+	import kornia
+	_,_,h,w = imgs.shape
+	imgs = F.pad(imgs, (pad, pad, pad, pad), mode='replicate')
+	return kornia.augmentation.RandomCrop((h, w))(imgs)
+
+
+def bench_random_shift(args):
+	"""Throughput of the kornia and native random_shift"""
+	device = torch.device(args.device)
+	pad = 4
+	for batch_size in args.aug_batch_sizes:
+		x = torch.randint(0, 256, (batch_size, 3*args.frame_stack, args.image_size, args.image_size), device=device).float()
+		for name, fn in [('kornia', _random_shift_kornia), ('native', augmentations.random_shift)]:
+			t = _timeit_device(lambda: fn(x, pad), args.repeats, device)
+			print(f'random_shift | {name} | batch {batch_size} at {args.image_size}px on {device} | {1000*t:.2f} ms/batch')
+
+
+def _make_update_agent(args, algorithm, extra_args=[]):
+	"""Agent with default training arguments, and a replay buffer of synthetic transitions for it"""
+	train_args = parse_train_args([
+		'--algorithm', algorithm, '--seed', str(args.seed), '--device', args.device,
+		'--train_context_file', args.context_file, '--test_context_file', args.context_file
+	] + extra_args)
+	obs_shape = (3*train_args.frame_stack, train_args.image_size, train_args.image_size)
+	buffer = utils.ReplayBuffer(obs_shape, (6,), args.replay_transitions, train_args.batch_size, device=args.device)
+	_fill_replay_buffer(buffer, args.replay_transitions, train_args.frame_stack, train_args.image_size)
+	cropped_obs_shape = (3*train_args.frame_stack, train_args.image_crop_size, train_args.image_crop_size)
+	return make_agent(cropped_obs_shape, (6,), train_args), buffer
+
+
+def _run_updates(agent, buffer, num_updates, seed, start_step=1):
+	utils.set_seed_everywhere(seed)
+	for step in range(start_step, start_step+num_updates):
+		agent.update(buffer, None, step)
+
+
+def bench_update(args):
+	"""Agent update throughput with and without reusing shared conv features"""
+	device = torch.device(args.device)
+	for algorithm in args.algorithms:
+		agent, buffer = _make_update_agent(args, algorithm)
+		for reuse_features in [False, True]:
+			_agent = deepcopy(agent)
+			_agent.reuse_features = reuse_features
+			t = _timeit_device(lambda: _run_updates(_agent, buffer, 2, args.seed), args.repeats, device) / 2
+			print(f'update | {algorithm} | reuse_features={reuse_features} | {1/t:.1f} updates/s on {device}')
+
+
+def _soft_update_loop(net, target_net, tau):
+	"""Per-parameter soft update, used as a baseline"""
+	for param, target_param in zip(net.parameters(), target_net.parameters()):
+		target_param.data.copy_(
+			tau * param.data + (1 - tau) * target_param.data
+		)
+
+
+def bench_soft_update(args):
+	"""Time per critic target update with the per-parameter loop and the fused multi-tensor update"""
+	device = torch.device(args.device)
+	for algorithm in args.algorithms:
+		agent, _ = _make_update_agent(args, algorithm)
+		critic, critic_target = agent.critic, agent.critic_target
+		def loop():
+			_soft_update_loop(critic.Q, critic_target.Q, agent.critic_tau)
+			_soft_update_loop(critic.encoder, critic_target.encoder, agent.encoder_tau)
+		for name, fn in [('loop', loop), ('fused', agent.soft_update_critic_target)]:
+			t = _timeit_device(fn, args.repeats, device)
+			print(f'soft_update | {algorithm} | {name} | {1000*t:.3f} ms/update on {device}')
+
+
+def bench_drq(args):
+	"""Throughput of one DrQ update with K=M=2 augmentations against two updates with K=M=1, each including one actor update"""
+	device = torch.device(args.device)
+	for K, M, updates in [(1, 1, 2), (2, 2, 1)]:
+		agent, buffer = _make_update_agent(args, 'drq', ['--drq_K', str(K), '--drq_M', str(M)])
+		t = _timeit_device(lambda: _run_updates(agent, buffer, updates, args.seed, start_step=2*agent.actor_update_freq-updates+1), args.repeats, device)
+		print(f'drq | K={K}, M={M} | {updates} update(s) in {1000*t:.1f} ms on {device}')
+
+
+def bench_evaluate(args):
+	"""Evaluation time playing episodes one at a time against in lockstep, compares the rewards of both"""
+	agent, _ = _make_update_agent(args, 'sac')
+	env, num_contexts = _make_context_env(args)
+	num_episodes = num_contexts * args.rounds
+	start = time.time()
+	sequential_rewards = []
+	for _ in range(num_episodes):
+		obs, done, episode_reward = env.reset(), False, 0
+		while not done:
+			with utils.eval_mode(agent):
+				action = agent.select_action(obs)
+			obs, reward, done, _ = env.step(action)
+			episode_reward += reward
+		sequential_rewards.append(episode_reward)
+	t_sequential = time.time() - start
+
+	envs = [_make_context_env(args)[0] for _ in range(args.eval_envs)]
+	start = time.time()
+	batch_rewards, context_rewards = evaluate_batch(envs, agent, num_episodes)
+	t_batch = time.time() - start
+	print(f'evaluate | sequential | {num_episodes} episodes in {t_sequential:.1f} s')
+	print(f'evaluate | lockstep on {args.eval_envs} envs | {num_episodes} episodes in {t_batch:.1f} s over {len(context_rewards)} contexts')
+	print(f'evaluate | max reward difference per episode: {np.abs(np.array(sequential_rewards) - batch_rewards).max():.6f}')
+
+
+def _physics(env):
+	"""The dm_control Physics underneath the wrappers of env"""
+	_env = env
+	while not hasattr(_env, '_env'):
+		_env = _env.env
+	return _env._env.physics
+
+
+def _render_uncached(physics, height, width, camera_id):
+	"""Physics.render as it was before cameras were cached, constructing a new Camera per frame"""
+	camera = Camera(physics=physics, height=height, width=width, camera_id=camera_id)
+	image = camera.render()
+	camera._scene.free()
+	return image
+
+
+def bench_render(args):
+	"""Rendering throughput with a new Camera per frame against the cached cameras of Physics.render and rendering into a preallocated array"""
+	env, _ = _make_context_env(args)
+	env.reset()
+	physics = _physics(env)
+	for size in args.sizes:
+		t_uncached = _timeit(lambda: _render_uncached(physics, size, size, 0), args.repeats)
+		t_cached = _timeit(lambda: physics.render(height=size, width=size, camera_id=0), args.repeats)
+		out = np.empty((3, size, size), dtype=np.uint8)
+		t_into = _timeit(lambda: physics.render(height=size, width=size, camera_id=0, out=out), args.repeats)
+		print(f'render | {size}px | new camera: {1/t_uncached:.1f} frames/s | cached camera: {1/t_cached:.1f} frames/s | channels-first into preallocated array: {1/t_into:.1f} frames/s')
+
+
+def bench_backend(args):
+	"""Startup time and rendering throughput of the rendering backend of this process"""
+	env, _ = _make_context_env(args, render_backend=args.render_backend)
+	env.reset()
+	t_startup = time.time() - _start_time
+	physics = _physics(env)
+	fps = []
+	for size in args.sizes:
+		t = _timeit(lambda: physics.render(height=size, width=size, camera_id=0), args.repeats)
+		fps.append(f'{size}px: {1/t:.1f} frames/s')
+	print(f'backend | {rendering.select_backend()} | startup: {t_startup:.2f} s | ' + ' | '.join(fps))
+
+
+def bench_backends(args):
+	"""Runs the backend benchmark in a separate process for each of args.backends, as a process can only use one"""
+	argv = sys.argv[2:]
+	for backend in args.backends:
+		env = {k: v for k, v in os.environ.items() if k not in {'MUJOCO_GL', 'PYOPENGL_PLATFORM'}}
+		result = subprocess.run(
+			[sys.executable, os.path.abspath(__file__), 'backend', '--render_backend', backend] + argv,
+			env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True
+		)
+		if result.returncode == 0:
+			print(result.stdout.strip().splitlines()[-1])
+		else:
+			print(f'backend | {backend} | failed: {result.stdout.strip().splitlines()[-1] if result.stdout.strip() else result.returncode}')
+
+
+def _suite_steps(domain_name, task_name, action_repeat, num_steps, fused, seed=0):
+	"""Steps a suite task with random actions repeated action_repeat times, returns seconds per step"""
+	env = suite.load(domain_name, task_name, task_kwargs={'random': seed})
+	spec = env.action_spec()
+	rng = np.random.RandomState(seed)
+	actions = rng.uniform(spec.minimum, spec.maximum, size=(num_steps, *spec.shape))
+	env.reset()
+	start = time.time()
+	for action in actions:
+		if fused:
+			done = env.step_repeat(action, action_repeat).last()
+		else:
+			for _ in range(action_repeat):
+				done = env.step(action).last()
+				if done:
+					break
+		if done:
+			env.reset()
+	return (time.time() - start) / num_steps
+
+
+def bench_action_repeat(args):
+	"""Environment steps/sec per suite domain when repeating actions step by step against the fused step_repeat"""
+	num_steps = args.repeats * 50
+	for domain_task in args.suite_tasks:
+		domain_name, task_name = domain_task.rsplit('_', 1)
+		t_loop = _suite_steps(domain_name, task_name, args.action_repeat, num_steps, fused=False, seed=args.seed)
+		t_fused = _suite_steps(domain_name, task_name, args.action_repeat, num_steps, fused=True, seed=args.seed)
+		print(f'action_repeat | {domain_task} | action_repeat={args.action_repeat} | step loop: {1/t_loop:.1f} steps/s | step_repeat: {1/t_fused:.1f} steps/s')
+
+
+BENCHMARKS = {
+	'greenscreen': bench_greenscreen,
+	'reset': bench_reset,
+	'reset_gl': bench_reset_gl,
+	'replay': bench_replay,
+	'random_conv': bench_random_conv,
+	'random_shift': bench_random_shift,
+	'update': bench_update,
+	'soft_update': bench_soft_update,
+	'drq': bench_drq,
+	'evaluate': bench_evaluate,
+	'render': bench_render,
+	'backend': bench_backend,
+	'backends': bench_backends,
+	'action_repeat': bench_action_repeat,
+}
+
+
+def parse_args():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()))
+	parser.add_argument('--sizes', default=[84, 100, 448], type=int, nargs='+')
+	parser.add_argument('--batch_size', default=32, type=int)
+	parser.add_argument('--repeats', default=20, type=int)
+	parser.add_argument('--rounds', default=2, type=int)
+	parser.add_argument('--replay_transitions', default=20000, type=int)
+	parser.add_argument('--aug_batch_sizes', default=[128, 256, 512], type=int, nargs='+')
+	parser.add_argument('--device', default='cuda', type=str)
+	parser.add_argument('--eval_envs', default=10, type=int)
+	parser.add_argument('--algorithms', default=['sac', 'rad', 'curl', 'pad', 'drq', 'svea'], type=str, nargs='+')
+	parser.add_argument('--render_backend', default=None, type=str, choices=rendering.BACKENDS)
+	parser.add_argument('--backends', default=list(rendering.BACKENDS), type=str, nargs='+', choices=rendering.BACKENDS)
+	parser.add_argument('--suite_tasks', default=['walker_walk', 'cheetah_run', 'cartpole_swingup', 'finger_spin', 'reacher_easy', 'ball_in_cup_catch'], type=str, nargs='+')
+
+	# environment
+	parser.add_argument('--domain_name', default='walker')
+	parser.add_argument('--task_name', default='walk')
+	parser.add_argument('--context_file', default='empty.json', type=str)
+	parser.add_argument('--frame_stack', default=3, type=int)
+	parser.add_argument('--action_repeat', default=4, type=int)
+	parser.add_argument('--image_size', default=84, type=int)
+	parser.add_argument('--seed', default=0, type=int)
+	return parser.parse_args()
+
+
+if __name__ == '__main__':
+	args = parse_args()
+	with rendering.display(rendering.select_backend(args.render_backend)) as disp:
+		BENCHMARKS[args.benchmark](args)
@@ -80,6 +80,12 @@ _INVALID_PHYSICS_STATE = (
     'Physics state is invalid. Warning(s) raised: {warning_names}')
 _OVERLAYS_NOT_SUPPORTED_FOR_DEPTH_OR_SEGMENTATION = (
     'Overlays are not supported with depth or segmentation rendering.')
+_OUT_NOT_SUPPORTED_FOR_DEPTH_OR_SEGMENTATION = (
+    '`out` is not supported with depth or segmentation rendering.')
+_INVALID_OUT_ARRAY = (
+    '`out` must be a uint8 array of shape {expected}, got a {dtype} array of '
+    'shape {shape}.')
+_NON_CONTIGUOUS_OUT_ARRAY = '`out` must be a C-contiguous array.'
 
 
 class Physics(_control.Physics):
@@ -106,12 +112,17 @@ class Physics(_control.Physics):
 
   _contexts = None
 
+  # If True, reloading the model keeps the OpenGL context and only rebuilds the
+  # MuJoCo rendering context if the render assets of the model have changed.
+  reuse_rendering_contexts = False
+
   def __new__(cls, *args, **kwargs):
     obj = super(Physics, cls).__new__(cls)
     # The lock is created in `__new__` rather than `__init__` because there are
     # a number of existing subclasses that override `__init__` without calling
     # the `__init__` method of the  superclass.
     obj._contexts_lock = threading.Lock()  # pylint: disable=protected-access
+    obj._cameras = {}  # pylint: disable=protected-access
     return obj
 
   def __init__(self, data):
@@ -165,7 +176,7 @@ class Physics(_control.Physics):
       mjlib.mj_step1(self.model.ptr, self.data.ptr)
 
   def render(self, height=240, width=320, camera_id=-1, overlays=(),
-             depth=False, segmentation=False, scene_option=None):
+             depth=False, segmentation=False, scene_option=None, out=None):
     """Returns a camera view as a NumPy array of pixel values.
 
     Args:
@@ -186,17 +197,68 @@ class Physics(_control.Physics):
       scene_option: An optional `wrapper.MjvOption` instance that can be used to
         render the scene with custom visualization options. If None then the
         default options will be used.
+      out: An optional (3, height, width) uint8 NumPy array. If given, the RGB
+        image is written to it in channels-first layout and `out` is returned,
+        see `Camera.render_into`. Only supported if `depth` and `segmentation`
+        are both False.
 
     Returns:
       The rendered RGB, depth or segmentation image.
+
+    Raises:
+      ValueError: If `out` is given with depth or segmentation rendering.
+    """
+    camera = self._cached_camera(height, width, camera_id)
+    if out is not None:
+      if depth or segmentation:
+        raise ValueError(_OUT_NOT_SUPPORTED_FOR_DEPTH_OR_SEGMENTATION)
+      return camera.render_into(
+          out, overlays=overlays, scene_option=scene_option)
+    # Each call returns its own image, as with a newly constructed `Camera`.
+    # pylint: disable=protected-access
+    if depth:
+      camera._depth_buffer = np.empty_like(camera._depth_buffer)
+    else:
+      camera._rgb_buffer = np.empty_like(camera._rgb_buffer)
+    # pylint: enable=protected-access
+    try:
+      return camera.render(
+          overlays=overlays, depth=depth, segmentation=segmentation,
+          scene_option=scene_option)
+    finally:
+      if segmentation:
+        camera.scene.flags[enums.mjtRndFlag.mjRND_SEGMENT] = False
+        camera.scene.flags[enums.mjtRndFlag.mjRND_IDCOLOR] = False
+
+  def _cached_camera(self, height, width, camera_id):
+    """Returns the `Camera` used by `render` for this viewport and camera.
+
+    Cameras, and the `MjvScene` each of them holds, are created on first use
+    and kept until the model is reloaded or this `Physics` instance is freed.
+
+    Args:
+      height: Viewport height (number of pixels).
+      width: Viewport width (number of pixels).
+      camera_id: Camera name or index, see `render`.
+
+    Returns:
+      A `Camera` instance.
     """
-    camera = Camera(
-        physics=self, height=height, width=width, camera_id=camera_id)
-    image = camera.render(
-        overlays=overlays, depth=depth, segmentation=segmentation,
-        scene_option=scene_option)
-    camera._scene.free()  # pylint: disable=protected-access
-    return image
+    if isinstance(camera_id, six.string_types):
+      camera_id = self.model.name2id(camera_id, 'camera')
+    key = (height, width, camera_id)
+    camera = self._cameras.get(key)
+    if camera is None:
+      camera = Camera(
+          physics=self, height=height, width=width, camera_id=camera_id)
+      self._cameras[key] = camera
+    return camera
+
+  def _free_cameras(self):
+    """Frees the scenes of the cameras cached by `render`."""
+    for camera in self._cameras.values():
+      camera._scene.free()  # pylint: disable=protected-access
+    self._cameras.clear()
 
   def get_state(self):
     """Returns the physics state.
@@ -304,6 +366,7 @@ class Physics(_control.Physics):
     # Note: `_contexts_lock` is normally created in `__new__`, but `__new__` is
     #       not invoked during unpickling.
     self._contexts_lock = threading.Lock()
+    self._cameras = {}
     self._reload_from_data(data)
 
   def _reload_from_model(self, model):
@@ -330,6 +393,7 @@ class Physics(_control.Physics):
     Args:
       data: Instance of `wrapper.MjData`.
     """
+    previous_model = self._data.model if getattr(self, '_data', None) else None
     self._data = data
 
     # Performance optimization: pre-allocate numpy arrays used when checking for
@@ -338,11 +402,21 @@ class Physics(_control.Physics):
     self._warnings_before = np.empty_like(self._warnings)
     self._new_warnings = np.empty(dtype=bool, shape=self._warnings.shape)
 
+    # Cached cameras hold scenes allocated for the previous model.
+    self._free_cameras()
+
     # Forcibly free any previous GL context in order to avoid problems with GL
     # implementations that do not support multiple contexts on a given device.
     with self._contexts_lock:
       if self._contexts:
-        self._free_rendering_contexts()
+        if (not self.reuse_rendering_contexts or
+            _offscreen_size(previous_model) != _offscreen_size(self.model)):
+          self._free_rendering_contexts()
+        elif not _same_render_assets(previous_model, self.model):
+          self._contexts.mujoco.free()
+          self._contexts = Contexts(
+              gl=self._contexts.gl,
+              mujoco=wrapper.MjrContext(self.model, self._contexts.gl))
 
     # Call kinematics update to enable rendering.
     try:
@@ -363,6 +437,7 @@ class Physics(_control.Physics):
     necessary. This `Physics` object MUST NOT be used after this function has
     been called.
     """
+    self._free_cameras()
     with self._contexts_lock:
       if self._contexts:
         self._free_rendering_contexts()
@@ -540,6 +615,44 @@ class Physics(_control.Physics):
     return self.data.time
 
 
+# Fields of `MjModel` that `mjr_makeContext` uploads to the GPU.
+_RENDER_ASSET_FIELDS = (
+    'tex_type', 'tex_height', 'tex_width', 'tex_adr', 'tex_rgb',
+    'mesh_vertadr', 'mesh_vertnum', 'mesh_texcoordadr', 'mesh_faceadr',
+    'mesh_facenum', 'mesh_vert', 'mesh_normal', 'mesh_texcoord', 'mesh_face',
+    'hfield_size', 'hfield_nrow', 'hfield_ncol', 'hfield_adr', 'hfield_data',
+    'skin_vertadr', 'skin_vertnum', 'skin_texcoordadr', 'skin_faceadr',
+    'skin_facenum', 'skin_texcoord', 'skin_face',
+)
+
+
+def _offscreen_size(model):
+  """Returns the offscreen framebuffer size the OpenGL context is made for."""
+  return model.vis.global_.offwidth, model.vis.global_.offheight
+
+
+def _same_render_assets(model, other_model):
+  """Returns True if a MuJoCo rendering context made for `model` can render `other_model`.
+
+  Args:
+    model: Instance of `wrapper.MjModel`.
+    other_model: Instance of `wrapper.MjModel`.
+
+  Returns:
+    True if both models have the same textures, meshes, height fields, skins and
+    rendering quality settings.
+  """
+  for field in ('shadowsize', 'offsamples', 'numslices', 'numstacks',
+                'numquads'):
+    if getattr(model.vis.quality, field) != getattr(other_model.vis.quality,
+                                                   field):
+      return False
+  for field in _RENDER_ASSET_FIELDS:
+    if not np.array_equal(getattr(model, field), getattr(other_model, field)):
+      return False
+  return True
+
+
 class Camera(object):
   """Mujoco scene camera.
 
@@ -760,6 +873,44 @@ class Camera(object):
     # The first row in the buffer is the bottom row of pixels in the image.
     return np.flipud(image)
 
+  def render_into(self, out, overlays=(), scene_option=None):
+    """Renders the RGB camera view into a channels-first array.
+
+    Pixels are read back into the camera's buffer, which is reused across
+    calls, and then flipped and transposed into `out` in a single copy.
+
+    Args:
+      out: A C-contiguous (3, height, width) uint8 numpy array, e.g. a slot of
+        a frame stack or replay buffer.
+      overlays: An optional sequence of `TextOverlay` instances to draw.
+      scene_option: A custom `wrapper.MjvOption` instance to use to render
+        the scene instead of the default.  If None, will use the default.
+
+    Returns:
+      `out`.
+
+    Raises:
+      ValueError: If `out` does not match the camera's viewport or is not
+        C-contiguous.
+    """
+    expected = (3, self._height, self._width)
+    if out.shape != expected or out.dtype != np.uint8:
+      raise ValueError(_INVALID_OUT_ARRAY.format(
+          expected=expected, dtype=out.dtype, shape=out.shape))
+    if not out.flags.c_contiguous:
+      raise ValueError(_NON_CONTIGUOUS_OUT_ARRAY)
+
+    # Update scene geometry.
+    self.update(scene_option=scene_option)
+
+    # Render scene and text overlays, read contents of the RGB buffer.
+    with self._physics.contexts.gl.make_current() as ctx:
+      ctx.call(self._render_on_gl_thread, depth=False, overlays=overlays)
+
+    # The first row in the buffer is the bottom row of pixels in the image.
+    np.copyto(out, self._rgb_buffer[::-1].transpose(2, 0, 1))
+    return out
+
   def select(self, cursor_position):
     """Returns bodies and geoms visible at given coordinates in the frame.
 
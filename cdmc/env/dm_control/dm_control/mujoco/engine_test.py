@@ -44,6 +44,30 @@ ASSETS = {
     'included.xml': assets.get_contents('sphere.xml')
 }
 
+TEXTURED_MODEL = """
+<mujoco>
+  <visual>
+    <global offwidth="{offwidth}" offheight="240"/>
+    <quality shadowsize="{shadowsize}"/>
+  </visual>
+  <asset>
+    <texture name="skybox" type="skybox" builtin="gradient" rgb1="{skybox}"
+             rgb2="0 0 0" width="64" height="64"/>
+    <texture name="grid" type="2d" builtin="checker" rgb1="{grid}"
+             rgb2=".2 .3 .4" width="64" height="64"/>
+    <material name="grid" texture="grid" texrepeat="2 2" rgba="{rgba}"/>
+  </asset>
+  <worldbody>
+    <light pos="0 0 3"/>
+    <geom type="plane" size="2 2 .1" material="grid"/>
+    <geom type="box" size=".2 .2 .2" pos="0 0 .2" rgba=".8 .2 .2 1"/>
+    <camera name="top" pos="0 -2 2" xyaxes="1 0 0 0 .7 .7"/>
+  </worldbody>
+</mujoco>
+"""
+TEXTURED_MODEL_KWARGS = dict(offwidth=320, shadowsize=4096, skybox='.4 .6 .8',
+                             grid='.1 .2 .3', rgba='1 1 1 1')
+
 
 class MujocoEngineTest(parameterized.TestCase):
 
@@ -241,6 +265,44 @@ class MujocoEngineTest(parameterized.TestCase):
                                         segmentation=True)
     self.assertEqual(segmentation.shape, (height, width, 2))
 
+  @parameterized.parameters((240, 320, -1), (64, 64, 'cart'), (48, 96, 0))
+  def testRenderIntoOutMatchesRender(self, height, width, camera_id):
+    out = np.zeros((3, height, width), dtype=np.uint8)
+    for qpos in ([0., 0.], [.5, -1.]):
+      with self._physics.reset_context():
+        self._physics.data.qpos[:] = qpos
+      image = self._physics.render(height, width, camera_id=camera_id)
+      result = self._physics.render(height, width, camera_id=camera_id, out=out)
+      self.assertIs(result, out)
+      np.testing.assert_array_equal(out, image.transpose(2, 0, 1))
+
+  def testRenderIntoSlotOfFrameStack(self):
+    frames = np.zeros((3, 3, 48, 64), dtype=np.uint8)
+    self._physics.render(48, 64, camera_id=0, out=frames[1])
+    np.testing.assert_array_equal(
+        frames[1], self._physics.render(48, 64, camera_id=0).transpose(2, 0, 1))
+    self.assertFalse(frames[0].any())
+    self.assertFalse(frames[2].any())
+
+  @parameterized.named_parameters(
+      ('wrong_dtype', np.zeros((3, 48, 64), dtype=np.float32)),
+      ('wrong_shape', np.zeros((48, 64, 3), dtype=np.uint8)),
+      ('wrong_size', np.zeros((3, 64, 48), dtype=np.uint8)),
+      ('non_contiguous', np.zeros((3, 48, 128), dtype=np.uint8)[:, :, ::2]))
+  def testExceptionIfInvalidOut(self, out):
+    with self.assertRaises(ValueError):
+      self._physics.render(48, 64, camera_id=0, out=out)
+    self.assertFalse(out.any())
+
+  def testExceptionIfOutAndDepthOrSegmentation(self):
+    out = np.zeros((3, 48, 64), dtype=np.uint8)
+    with self.assertRaisesWithLiteralMatch(
+        ValueError, engine._OUT_NOT_SUPPORTED_FOR_DEPTH_OR_SEGMENTATION):
+      self._physics.render(48, 64, depth=True, out=out)
+    with self.assertRaisesWithLiteralMatch(
+        ValueError, engine._OUT_NOT_SUPPORTED_FOR_DEPTH_OR_SEGMENTATION):
+      self._physics.render(48, 64, segmentation=True, out=out)
+
   def testExceptionIfBothDepthAndSegmentation(self):
     with self.assertRaisesWithLiteralMatch(
         ValueError, engine._BOTH_SEGMENTATION_AND_DEPTH_ENABLED):
@@ -308,6 +370,90 @@ class MujocoEngineTest(parameterized.TestCase):
     self.assertIsNone(self._physics.model.ptr)
     self.assertIsNone(self._physics.data.ptr)
 
+  @parameterized.parameters(
+      (240, 320, -1), (240, 320, 0), (64, 64, 'cart'), (48, 96, 'pole'))
+  def testCachedCameraRenderMatchesFreshCamera(self, height, width, camera_id):
+    for qpos in ([0., 0.], [.5, -1.]):
+      with self._physics.reset_context():
+        self._physics.data.qpos[:] = qpos
+      cached = self._physics.render(height, width, camera_id=camera_id)
+      fresh = engine.Camera(
+          self._physics, height, width, camera_id=camera_id).render()
+      np.testing.assert_array_equal(cached, fresh)
+    self.assertLen(self._physics._cameras, 1)
+
+  def testRenderCachesOneCameraPerViewport(self):
+    first = self._physics.render(48, 64, camera_id=0)
+    expected = first.copy()
+    self._physics.render(64, 48, camera_id=0)
+    self._physics.render(48, 64, camera_id='cart')
+    camera = self._physics._cameras[(48, 64, 0)]
+    second = self._physics.render(48, 64, camera_id=0)
+
+    self.assertLen(self._physics._cameras, 3)
+    self.assertIs(camera, self._physics._cameras[(48, 64, 0)])
+    self.assertEqual(second.shape, (48, 64, 3))
+    self.assertIsNot(first, second)
+    # Later renders do not write into images that were already returned.
+    np.testing.assert_array_equal(first, expected)
+    np.testing.assert_array_equal(
+        self._physics.render(64, 48, camera_id=0),
+        engine.Camera(self._physics, 64, 48, camera_id=0).render())
+
+  def testReloadFreesCachedCameras(self):
+    self._physics.render(64, 64, camera_id=0)
+    scene = self._physics._cameras[(64, 64, 0)].scene
+    with mock.patch.object(scene, 'free', wraps=scene.free) as mock_free_scene:
+      self._physics.reload_from_xml_string(MODEL_WITH_ASSETS, assets=ASSETS)
+    mock_free_scene.assert_called_once()
+    self.assertEmpty(self._physics._cameras)
+
+    np.testing.assert_array_equal(
+        self._physics.render(64, 64),
+        engine.Camera(self._physics, 64, 64).render())
+
+  def testFreeFreesCachedCameras(self):
+    self._physics.render(64, 64, camera_id=0)
+    scene = self._physics._cameras[(64, 64, 0)].scene
+    with mock.patch.object(scene, 'free', wraps=scene.free) as mock_free_scene:
+      self._physics.free()
+    mock_free_scene.assert_called_once()
+    self.assertEmpty(self._physics._cameras)
+
+  @parameterized.named_parameters(
+      ('same_model', {}, True, True),
+      ('changed_material', {'rgba': '.5 1 1 1'}, True, True),
+      ('changed_texture', {'grid': '.9 .2 .3'}, True, False),
+      ('changed_skybox', {'skybox': '.8 .6 .4'}, True, False),
+      ('changed_quality', {'shadowsize': 1024}, True, False),
+      ('changed_offscreen_size', {'offwidth': 256}, False, False))
+  def testReloadReusesRenderingContexts(self, changes, reuse_gl, reuse_mujoco):
+    xml = TEXTURED_MODEL.format(**TEXTURED_MODEL_KWARGS)
+    new_xml = TEXTURED_MODEL.format(**dict(TEXTURED_MODEL_KWARGS, **changes))
+    # Text overlays are drawn with the fonts uploaded to the MjrContext.
+    overlays = [engine.TextOverlay(title='Title', body='Body')]
+
+    physics = engine.Physics.from_xml_string(xml)
+    physics.reuse_rendering_contexts = True
+    physics.render(120, 160, camera_id='top', overlays=overlays)
+    contexts = physics.contexts
+    physics.reload_from_xml_string(new_xml)
+
+    self.assertEqual(reuse_gl, physics.contexts.gl is contexts.gl)
+    self.assertEqual(reuse_mujoco, physics.contexts.mujoco is contexts.mujoco)
+    np.testing.assert_array_equal(
+        physics.render(120, 160, camera_id='top', overlays=overlays),
+        engine.Physics.from_xml_string(new_xml).render(
+            120, 160, camera_id='top', overlays=overlays))
+
+  def testReloadFreesRenderingContextsByDefault(self):
+    xml = TEXTURED_MODEL.format(**TEXTURED_MODEL_KWARGS)
+    physics = engine.Physics.from_xml_string(xml)
+    contexts = physics.contexts
+    physics.reload_from_xml_string(xml)
+    self.assertIsNot(physics.contexts.gl, contexts.gl)
+    self.assertIsNot(physics.contexts.mujoco, contexts.mujoco)
+
   @parameterized.parameters(*enums.mjtWarning._fields[:-1])
   def testDivergenceException(self, warning_name):
     warning_enum = getattr(enums.mjtWarning, warning_name)
@@ -129,6 +129,53 @@ class Environment(dm_env.Environment):
     else:
       return dm_env.TimeStep(dm_env.StepType.MID, reward, 1.0, observation)
 
+  def step_repeat(self, action, num_repeats):
+    """Repeats `action` for `num_repeats` control steps and returns a `TimeStep`.
+
+    Equivalent to calling `step(action)` `num_repeats` times, or until the
+    episode ends, where the returned `TimeStep` is that of the last step with
+    the rewards of all steps summed. The control is applied once and the
+    observation is only computed for the last step, so `Task.before_step` must
+    not depend on being called before every step.
+
+    Args:
+      action: The action applied in every step.
+      num_repeats: Positive `int`, maximum number of control steps.
+
+    Returns:
+      A `TimeStep`.
+    """
+    if self._reset_next_step:
+      return self.reset()
+
+    self._task.before_step(action, self._physics)
+    reward = 0
+    for _ in range(num_repeats):
+      for _ in range(self._n_sub_steps):
+        self._physics.step()
+      self._task.after_step(self._physics)
+
+      reward += self._task.get_reward(self._physics) or 0
+
+      self._step_count += 1
+      if self._step_count >= self._step_limit:
+        discount = 1.0
+      else:
+        discount = self._task.get_termination(self._physics)
+      if discount is not None:
+        break
+
+    observation = self._task.get_observation(self._physics)
+    if self._flat_observation:
+      observation = flatten_observation(observation)
+
+    if discount is not None:
+      self._reset_next_step = True
+      return dm_env.TimeStep(
+          dm_env.StepType.LAST, reward, discount, observation)
+    else:
+      return dm_env.TimeStep(dm_env.StepType.MID, reward, 1.0, observation)
+
   def action_spec(self):
     """Returns the action specification for this environment."""
     return self._task.action_spec(self._physics)
@@ -24,6 +24,7 @@ from __future__ import print_function
 from absl.testing import absltest
 from absl.testing import parameterized
 
+from dm_control import suite
 from dm_control.rl import control
 from dm_env import specs
 
@@ -124,6 +125,75 @@ class EnvironmentTest(parameterized.TestCase):
     self.assertEqual(timestep.observation[control.FLAT_OBSERVATION_KEY].size,
                      1 + 7)
 
+  @parameterized.parameters(1, 2, 3)
+  def test_step_repeat_terminates_mid_repeat(self, terminal_step):
+    # Rewards 1, 2, 3, ... and a termination with discount 0 at terminal_step.
+    rewards = lambda: iter(range(1, 10))
+    terminations = lambda: iter([None] * (terminal_step - 1) + [0.0])
+
+    self._task.get_reward.side_effect = rewards()
+    self._task.get_termination.side_effect = terminations()
+    self._env.reset()
+    for _ in range(terminal_step):
+      expected = self._env.step([1])
+    expected_reward = sum(range(1, terminal_step + 1))
+
+    self._task.get_reward.side_effect = rewards()
+    self._task.get_termination.side_effect = terminations()
+    self._env.reset()
+    self._physics.step.reset_mock()
+    time_step = self._env.step_repeat([1], 3)
+
+    self.assertEqual(terminal_step, self._physics.step.call_count)
+    self.assertTrue(expected.last())
+    self.assertTrue(time_step.last())
+    self.assertEqual(expected_reward, time_step.reward)
+    self.assertEqual(expected.discount, time_step.discount)
+    self.assertTrue(self._env.step_repeat([1], 3).first())
+
+
+class StepRepeatTest(parameterized.TestCase):
+
+  def _load(self, time_limit):
+    return suite.load('walker', 'walk',
+                      task_kwargs={'random': 0, 'time_limit': time_limit})
+
+  @parameterized.parameters(
+      {'num_repeats': 1, 'time_limit': 0.5},
+      {'num_repeats': 4, 'time_limit': 0.5},
+      # 10 control steps per episode, the last repeat ends after 1 step.
+      {'num_repeats': 3, 'time_limit': 0.25})
+  def test_step_repeat_matches_repeated_steps(self, num_repeats, time_limit):
+    env, fused_env = self._load(time_limit), self._load(time_limit)
+    action_spec = env.action_spec()
+    random_state = np.random.RandomState(0)
+
+    time_step, fused_time_step = env.reset(), fused_env.reset()
+    num_episodes = 0
+    while num_episodes < 2:
+      action = random_state.uniform(action_spec.minimum, action_spec.maximum)
+      reward = 0
+      for _ in range(num_repeats):
+        time_step = env.step(action)
+        reward += time_step.reward
+        if time_step.last():
+          break
+      fused_time_step = fused_env.step_repeat(action, num_repeats)
+
+      self.assertEqual(time_step.step_type, fused_time_step.step_type)
+      self.assertEqual(reward, fused_time_step.reward)
+      self.assertEqual(time_step.discount, fused_time_step.discount)
+      for name, value in time_step.observation.items():
+        np.testing.assert_array_equal(value, fused_time_step.observation[name])
+      np.testing.assert_array_equal(env.physics.get_state(),
+                                    fused_env.physics.get_state())
+
+      if time_step.last():
+        num_episodes += 1
+        time_step, fused_time_step = env.reset(), fused_env.reset()
+        np.testing.assert_array_equal(env.physics.get_state(),
+                                      fused_env.physics.get_state())
+
 
 class ComputeNStepsTest(parameterized.TestCase):
 
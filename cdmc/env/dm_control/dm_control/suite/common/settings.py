@@ -1,4 +1,5 @@
 import os
+import functools
 import numpy as np
 from dm_control.suite import common
 import dm_control
@@ -12,35 +13,15 @@ _FILENAMES = [
     "./common/visual.xml",
 ]
 
-def get_model_and_assets_from_setting_kwargs(model_fname, task_name, setting_kwargs=None):
-    """"Returns a tuple containing the model XML string and a dict of assets."""
-    assets = {filename: resources.GetResource(os.path.join(_SUITE_DIR, filename))
-          for filename in _FILENAMES}
-    
-    if model_fname == "manipulator.xml":
-        use_peg = True
-        insert = False
-        if "ball" in task_name:
-            use_peg = False
-        if "insert" in task_name:
-            insert = True
-        model_xml, _ = dm_control.suite.manipulator.make_model(use_peg, insert)
-    elif model_fname == "stacker.xml":
-        num_boxes = 2
-        if "4" in task_name:
-            num_boxes = 4
-        model_xml, _ = dm_control.suite.stacker.make_model(num_boxes)
-    else:
-        model_xml = common.read_model(model_fname)
-
-    if setting_kwargs is None:
-        return model_xml, assets
-
-    # Convert XML to dicts
-    model = xmltodict.parse(model_xml)
-    materials = xmltodict.parse(assets['./common/materials.xml'])
-    skybox = xmltodict.parse(assets['./common/skybox.xml'])
+# Settings that only change material colours and builtin textures. These can be
+# written into an already compiled model instead of recompiling it from XML.
+IN_PLACE_SETTING_KEYS = frozenset([
+    'grid_rgb1', 'grid_rgb2', 'grid_markrgb', 'grid_texrepeat',
+    'self_rgb', 'skybox_rgb', 'skybox_rgb2', 'skybox_markrgb',
+])
 
+def _apply_setting_kwargs(materials, skybox, setting_kwargs):
+    """Edits the parsed materials and skybox assets in place according to setting_kwargs."""
     # Edit grid floor
     if 'grid_rgb1' in setting_kwargs:
         assert isinstance(setting_kwargs['grid_rgb1'], (list, tuple, np.ndarray))
@@ -87,9 +68,80 @@ def get_model_and_assets_from_setting_kwargs(model_fname, task_name, setting_kwa
         skybox['mujoco']['asset']['texture']['@markrgb'] = \
             f'{setting_kwargs["skybox_markrgb"][0]} {setting_kwargs["skybox_markrgb"][1]} {setting_kwargs["skybox_markrgb"][2]}'
 
+
+def get_model_and_assets_from_setting_kwargs(model_fname, task_name, setting_kwargs=None):
+    """"Returns a tuple containing the model XML string and a dict of assets."""
+    assets = {filename: resources.GetResource(os.path.join(_SUITE_DIR, filename))
+          for filename in _FILENAMES}
+    
+    if model_fname == "manipulator.xml":
+        use_peg = True
+        insert = False
+        if "ball" in task_name:
+            use_peg = False
+        if "insert" in task_name:
+            insert = True
+        model_xml, _ = dm_control.suite.manipulator.make_model(use_peg, insert)
+    elif model_fname == "stacker.xml":
+        num_boxes = 2
+        if "4" in task_name:
+            num_boxes = 4
+        model_xml, _ = dm_control.suite.stacker.make_model(num_boxes)
+    else:
+        model_xml = common.read_model(model_fname)
+
+    if setting_kwargs is None:
+        return model_xml, assets
+
+    # Convert XML to dicts
+    model = xmltodict.parse(model_xml)
+    materials = xmltodict.parse(assets['./common/materials.xml'])
+    skybox = xmltodict.parse(assets['./common/skybox.xml'])
+    _apply_setting_kwargs(materials, skybox, setting_kwargs)
+
     # Convert back to XML
     model_xml = xmltodict.unparse(model)
     assets['./common/materials.xml'] = xmltodict.unparse(materials)
     assets['./common/skybox.xml'] = xmltodict.unparse(skybox)
 
     return model_xml, assets
+
+
+def get_textures_and_materials_from_setting_kwargs(setting_kwargs):
+    """Returns the textures and materials that result from applying setting_kwargs.
+
+    Only covers the keys in `IN_PLACE_SETTING_KEYS`. Each texture is returned as
+    a standalone model XML string containing just that texture, which can be
+    passed to `get_texture_rgb`. Materials are returned as a dict mapping the
+    material name to its `mat_rgba` and `mat_texrepeat` values.
+    """
+    assert set(setting_kwargs) <= IN_PLACE_SETTING_KEYS
+    materials = xmltodict.parse(resources.GetResource(os.path.join(_SUITE_DIR, "./common/materials.xml")))
+    skybox = xmltodict.parse(resources.GetResource(os.path.join(_SUITE_DIR, "./common/skybox.xml")))
+    _apply_setting_kwargs(materials, skybox, setting_kwargs)
+
+    textures = {
+        'grid': xmltodict.unparse({'mujoco': {'asset': {'texture': materials['mujoco']['asset']['texture']}}}),
+        'skybox': xmltodict.unparse({'mujoco': {'asset': {'texture': skybox['mujoco']['asset']['texture']}}}),
+    }
+    grid, self_ = materials['mujoco']['asset']['material'][:2]
+    materials = {
+        'grid': {'texrepeat': [float(v) for v in grid['@texrepeat'].split()]},
+        'self': {'rgba': [float(v) for v in self_['@rgba'].split()]},
+    }
+    return textures, materials
+
+
+@functools.lru_cache(maxsize=16)
+def get_texture_rgb(texture_xml):
+    """Compiles a standalone texture XML string and returns its height, width and RGB data.
+
+    Builtin textures are generated by the MuJoCo compiler, so this gives exactly
+    the `tex_rgb` data a full model with the same texture would contain.
+    """
+    from dm_control.mujoco import wrapper
+    model = wrapper.MjModel.from_xml_string(texture_xml)
+    height, width = int(model.tex_height[0]), int(model.tex_width[0])
+    rgb = model.tex_rgb[model.tex_adr[0]:model.tex_adr[0] + height * width * 3].copy()
+    rgb.setflags(write=False)
+    return height, width, rgb
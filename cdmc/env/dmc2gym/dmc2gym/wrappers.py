@@ -1,6 +1,7 @@
 from gym import core, spaces
 import gym
 from dm_control import suite
+from dm_control.rl import control
 from dm_env import specs
 import dm_env
 import numpy as np
@@ -39,10 +40,11 @@ def _flatten_obs(obs):
 
 class ContextualDMCWrapper(gym.Wrapper):
     """Wrapper for initialising DMC with a set of physics states"""
-    def __init__(self, env, physics_states, env_kwargs, seed=0):
+    def __init__(self, env, physics_states, env_kwargs, seed=0, reuse_env=True):
         gym.Wrapper.__init__(self, env)
         self._max_episode_steps = env._max_episode_steps
         self._env_kwargs = env_kwargs
+        self._reuse_env = reuse_env
         self._before_reset_performed = False
 
         if isinstance(physics_states, int):
@@ -71,17 +73,28 @@ class ContextualDMCWrapper(gym.Wrapper):
         assert isinstance(_env, DMCWrapper), 'environment is not dmc2gym-wrapped'
 
         return _env
+
+    def _reseed(self, seed):
+        """Puts the wrapped environment in the state of a newly made environment with the given seed"""
+        if not self._reuse_env:
+            self.env = make(**self._env_kwargs, seed=seed)
+            return
+        # the step counters are reset by the reset that follows
+        dmc_env = self._get_dmc_wrapper()
+        dmc_env._env.task.random.seed(seed)
+        dmc_env.current_state = None
+        dmc_env.seed(seed)
     
     def before_reset(self):
         if not self._before_reset_performed:
             if self._unbounded_states:
                 current_seed = self._initial_seed + self._i
-                self.env = make(**self._env_kwargs, seed=current_seed)
+                self._reseed(current_seed)
             else:
                 if self._num_physics_states > 0:
                     # reset environment to reset timestep counters and other things
                     new_physics_seed, _ = self._physics_states[self._randomised_state_indices[self._i]]
-                    self.env = make(**self._env_kwargs, seed=new_physics_seed)
+                    self._reseed(new_physics_seed)
             self._before_reset_performed = True
 
     def reset(self):
@@ -199,6 +212,8 @@ class DMCWrapper(core.Env):
             )
         
         self.current_state = None
+        # if set, pixel observations are rendered into this (3, height, width) array instead of a new one
+        self.frame_out = None
 
         # set seed
         self.seed(seed=task_kwargs.get('random', 1))
@@ -207,14 +222,22 @@ class DMCWrapper(core.Env):
         return getattr(self._env, name)
 
     def _get_obs(self, time_step):
-        if self._from_pixels:
+        if self._from_pixels and self._channels_first:
+            out = self.frame_out
+            if out is None:
+                out = np.empty(self._observation_space.shape, dtype=np.uint8)
+            obs = self._env.physics.render(
+                height=self._height,
+                width=self._width,
+                camera_id=self._camera_id,
+                out=out
+            )
+        elif self._from_pixels:
             obs = self.render(
                 height=self._height,
                 width=self._width,
                 camera_id=self._camera_id
             )
-            if self._channels_first:
-                obs = obs.transpose(2, 0, 1).copy()
         else:
             obs = _flatten_obs(time_step.observation)
         return obs
@@ -252,12 +275,18 @@ class DMCWrapper(core.Env):
         reward = 0
         extra = {'internal_state': self._env.physics.get_state().copy()}
 
-        for _ in range(self._frame_skip):
-            time_step = self._env.step(action)
+        if isinstance(self._env, control.Environment):
+            # observations of all but the last repeat are not computed
+            time_step = self._env.step_repeat(action, self._frame_skip)
             reward += time_step.reward or 0
             done = time_step.last()
-            if done:
-                break
+        else:
+            for _ in range(self._frame_skip):
+                time_step = self._env.step(action)
+                reward += time_step.reward or 0
+                done = time_step.last()
+                if done:
+                    break
         obs = self._get_obs(time_step)
         self.current_state = _flatten_obs(time_step.observation)
         extra['discount'] = time_step.discount
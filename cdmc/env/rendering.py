@@ -0,0 +1,44 @@
+import os
+import sys
+import argparse
+from contextlib import nullcontext
+
+
+BACKENDS = ('glfw', 'egl', 'osmesa')
+HEADLESS_BACKENDS = ('egl', 'osmesa')
+
+
+def parse_backend(argv=None):
+	"""The --render_backend command line argument, or None if it is not given"""
+	parser = argparse.ArgumentParser(add_help=False)
+	parser.add_argument('--render_backend', default=None, type=str, choices=BACKENDS)
+	args, _ = parser.parse_known_args(argv)
+	return args.render_backend
+
+
+def select_backend(backend=None):
+	"""Sets the OpenGL backend dm_control renders with, returns it or None if dm_control chooses one itself
+
+	backend defaults to the MUJOCO_GL environment variable. dm_control loads MuJoCo and its GL bindings for
+	the backend when it is first imported, so a backend other than the one already in use must be selected
+	before that. The choice is kept in MUJOCO_GL, which is inherited by child processes.
+	"""
+	if backend is None:
+		backend = os.environ.get('MUJOCO_GL')
+	if backend is None:
+		return None
+	if backend not in BACKENDS:
+		raise ValueError(f'render backend must be one of {BACKENDS}, got "{backend}"')
+	_render = sys.modules.get('dm_control._render')
+	if _render is not None and _render.BACKEND != backend:
+		raise RuntimeError(f'dm_control already renders with {_render.BACKEND}, the {backend} backend must be selected before importing dm_control')
+	os.environ['MUJOCO_GL'] = backend
+	return backend
+
+
+def display(backend):
+	"""Context to render in: a virtual X display for GLFW, nothing for the headless backends"""
+	if backend in HEADLESS_BACKENDS:
+		return nullcontext()
+	from pyvirtualdisplay import Display
+	return Display()
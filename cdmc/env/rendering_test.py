@@ -0,0 +1,76 @@
+"""Tests of the rendering backend selection."""
+
+import os
+import sys
+import types
+import importlib
+from absl.testing import absltest
+from absl.testing import parameterized
+import mock
+from cdmc.env import rendering
+
+
+class RenderingTest(parameterized.TestCase):
+
+	def setUp(self):
+		super().setUp()
+		# no backend is chosen, and dm_control has not set one up
+		environ = mock.patch.dict(os.environ)
+		environ.start()
+		self.addCleanup(environ.stop)
+		os.environ.pop('MUJOCO_GL', None)
+		modules = mock.patch.dict(sys.modules)
+		modules.start()
+		self.addCleanup(modules.stop)
+		sys.modules.pop('dm_control._render', None)
+
+	def _import_dm_control(self, backend):
+		sys.modules['dm_control._render'] = types.SimpleNamespace(BACKEND=backend)
+
+	def testParseBackend(self):
+		self.assertEqual(rendering.parse_backend(['--seed', '0', '--render_backend', 'egl']), 'egl')
+		self.assertIsNone(rendering.parse_backend(['--seed', '0']))
+		with self.assertRaises(SystemExit):
+			rendering.parse_backend(['--render_backend', 'vulkan'])
+
+	def testNoBackend(self):
+		self.assertIsNone(rendering.select_backend())
+		self.assertNotIn('MUJOCO_GL', os.environ)
+
+	@parameterized.parameters(*rendering.BACKENDS)
+	def testSelectBackend(self, backend):
+		self.assertEqual(rendering.select_backend(backend), backend)
+		self.assertEqual(os.environ['MUJOCO_GL'], backend)
+
+	def testBackendFromEnvironment(self):
+		os.environ['MUJOCO_GL'] = 'osmesa'
+		self.assertEqual(rendering.select_backend(), 'osmesa')
+
+	def testInvalidBackend(self):
+		with self.assertRaises(ValueError):
+			rendering.select_backend('vulkan')
+		os.environ['MUJOCO_GL'] = 'vulkan'
+		with self.assertRaises(ValueError):
+			rendering.select_backend()
+
+	def testBackendOfImportedDmControl(self):
+		self._import_dm_control('egl')
+		self.assertEqual(rendering.select_backend('egl'), 'egl')
+		with self.assertRaises(RuntimeError):
+			rendering.select_backend('osmesa')
+		self.assertEqual(os.environ['MUJOCO_GL'], 'egl')
+
+	def testNoDisplayForHeadlessBackends(self):
+		for backend in rendering.HEADLESS_BACKENDS:
+			with rendering.display(backend) as disp:
+				self.assertIsNone(disp)
+
+	@parameterized.parameters('cdmc.train', 'cdmc.eval')
+	def testImportingScriptsSelectsNoBackend(self, module):
+		with mock.patch.object(sys, 'argv', ['script.py', '--render_backend', 'osmesa']):
+			importlib.reload(importlib.import_module(module))
+		self.assertNotIn('MUJOCO_GL', os.environ)
+
+
+if __name__ == '__main__':
+	absltest.main()
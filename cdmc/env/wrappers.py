@@ -8,7 +8,8 @@ import torch.nn.functional as F
 import torchvision.transforms.functional as TF
 import dmc2gym
 import cdmc.utils as utils
-from collections import deque
+import cdmc.env.rendering as rendering
+from collections import deque, OrderedDict
 import dm_control
 
 
@@ -24,9 +25,14 @@ def make_env(
 		states = [],
 		video_paths = [],
 		colors = [],
-		intensity=0.
+		intensity=0.,
+		reuse_env=True,
+		reuse_gl_context=True,
+		render_backend=None,
+		frame_ring_size=None
 	):
 	"""Make environment for experiments"""
+	rendering.select_backend(render_backend)
 	paths = []
 	env_kwargs = {
 		"domain_name":domain_name,
@@ -42,18 +48,56 @@ def make_env(
 		"background_dataset_paths":paths
 	}
 	env = dmc2gym.make(**env_kwargs, seed=seed)
-	env = dmc2gym.wrappers.ContextualDMCWrapper(env, states, env_kwargs, seed=seed)
+	env = dmc2gym.wrappers.ContextualDMCWrapper(env, states, env_kwargs, seed=seed, reuse_env=reuse_env)
 	if from_pixels:
 		env = VideoWrapper(env, video_paths, seed=seed)
-		env = FrameStack(env, frame_stack)
-		env = ColorWrapper(env, colors, seed=seed)
+		env = FrameStack(env, frame_stack, ring_size=frame_ring_size)
+		env = ColorWrapper(env, colors, seed=seed, reuse_gl_context=reuse_gl_context)
 
 	return env
 
 
+def set_context_index(env, i):
+	"""Makes the next reset of env use the contexts of its i-th episode, as if it had been reset i times since make_env"""
+	_env = env
+	while True:
+		if isinstance(_env, ColorWrapper) and _env._num_colors > 0:
+			_env._i = i % _env._num_colors
+		elif isinstance(_env, VideoWrapper) and _env._num_videos > 0:
+			_env._i = i % _env._num_videos
+		elif isinstance(_env, dmc2gym.wrappers.ContextualDMCWrapper):
+			if _env._unbounded_states:
+				_env._i = i
+			elif _env._num_physics_states > 0:
+				_env._i = i % _env._num_physics_states
+			_env._before_reset_performed = False
+		if not hasattr(_env, 'env'):
+			return
+		_env = _env.env
+
+
+def episode_context(env, i):
+	"""Indices of the physics state, video and colours used by the i-th episode of env, None for those that are not set"""
+	state = video = color = None
+	_env = env
+	while True:
+		if isinstance(_env, ColorWrapper) and _env._num_colors > 0:
+			color = int(_env._randomised_color_indices[i % _env._num_colors])
+		elif isinstance(_env, VideoWrapper) and _env._num_videos > 0:
+			video = int(_env._randomised_video_indices[i % _env._num_videos])
+		elif isinstance(_env, dmc2gym.wrappers.ContextualDMCWrapper):
+			if _env._unbounded_states:
+				state = i
+			elif _env._num_physics_states > 0:
+				state = int(_env._randomised_state_indices[i % _env._num_physics_states])
+		if not hasattr(_env, 'env'):
+			return state, video, color
+		_env = _env.env
+
+
 class ColorWrapper(gym.Wrapper):
 	"""Wrapper for the color experiments"""
-	def __init__(self, env, colors, seed=None):
+	def __init__(self, env, colors, seed=None, reuse_gl_context=True):
 		assert isinstance(env, FrameStack), 'wrapped env must be a framestack'
 		gym.Wrapper.__init__(self, env)
 		assert isinstance(self._get_video_wrapper(), VideoWrapper), 'wrapped env must be a VideoWrapper'
@@ -61,6 +105,10 @@ class ColorWrapper(gym.Wrapper):
 		self._max_episode_steps = env._max_episode_steps
 		self._colors = colors
 		self._num_colors = len(colors)
+		self._recolor_disabled = False
+		self._recolor_ids = None
+		self._recolor_cache = {}
+		self._reuse_gl_context = reuse_gl_context
 		self.time_step = 0
 
 		if self._num_colors > 0:
@@ -117,13 +165,93 @@ class ColorWrapper(gym.Wrapper):
 		if state is None:
 			state = self._get_state()
 		
-
-		self._reload_physics(
-			*common.settings.get_model_and_assets_from_setting_kwargs(
-				domain_name+'.xml', self._get_dmc_wrapper()._task_name, setting_kwargs
+		if not self._recolor_physics(setting_kwargs):
+			# fall back to recompiling the model from XML, keeping the rendering contexts where possible
+			self._get_physics().reuse_rendering_contexts = self._reuse_gl_context
+			self._reload_physics(
+				*common.settings.get_model_and_assets_from_setting_kwargs(
+					domain_name+'.xml', self._get_dmc_wrapper()._task_name, setting_kwargs
+				)
 			)
-		)
+			self._recolor_disabled = not set(setting_kwargs) <= common.settings.IN_PLACE_SETTING_KEYS
 		self._set_state(state)
+
+	def _find_recolor_ids(self):
+		"""Texture and material ids to recolour in place, None if recolouring would differ from recompiling the model
+
+		In-place textures are compiled from standalone texture XML. This is checked once against the model, which
+		is compiled with the default settings, so that textures the standalone compile does not reproduce, e.g.
+		random marks drawn from a different random state, fall back to recompiling the model.
+		"""
+		from dm_control.suite import common
+		from dm_control.mujoco import wrapper
+		model = self._get_physics().model
+		textures, materials = common.settings.get_textures_and_materials_from_setting_kwargs({})
+		try:
+			texture_ids = {name: model.name2id(name, 'texture') for name in textures}
+			material_ids = {name: model.name2id(name, 'material') for name in materials}
+		except wrapper.Error:
+			return None
+		for name, tex_id in texture_ids.items():
+			height, width, rgb = common.settings.get_texture_rgb(textures[name])
+			start = model.tex_adr[tex_id]
+			if (model.tex_height[tex_id], model.tex_width[tex_id]) != (height, width) or \
+					not np.array_equal(model.tex_rgb[start:start+rgb.size], rgb):
+				return None
+		return texture_ids, material_ids
+
+	def _recolor_values(self, setting_kwargs):
+		"""Texture XML and material values of setting_kwargs by id, cached per context so that the XML is parsed once"""
+		from dm_control.suite import common
+		key = tuple(sorted((k, tuple(np.ravel(v).tolist())) for k, v in setting_kwargs.items()))
+		if key not in self._recolor_cache:
+			texture_ids, material_ids = self._recolor_ids
+			textures, materials = common.settings.get_textures_and_materials_from_setting_kwargs(setting_kwargs)
+			self._recolor_cache[key] = (
+				{texture_ids[name]: texture_xml for name, texture_xml in textures.items()},
+				[('mat_'+k, material_ids[name], v) for name, attributes in materials.items() for k, v in attributes.items()]
+			)
+		return self._recolor_cache[key]
+
+	def _recolor_physics(self, setting_kwargs):
+		"""Writes material colours and textures directly into the compiled model, returns False if not possible"""
+		from dm_control.suite import common
+		from dm_control.mujoco.wrapper import mjbindings
+		if self._recolor_disabled or not set(setting_kwargs) <= common.settings.IN_PLACE_SETTING_KEYS:
+			return False
+		if self._recolor_ids is None:
+			# an empty tuple marks a model that cannot be recoloured in place
+			self._recolor_ids = self._find_recolor_ids() or ()
+		if not self._recolor_ids:
+			return False
+		physics = self._get_physics()
+		model = physics.model
+		textures, material_values = self._recolor_values(setting_kwargs)
+
+		# check that the compiled model has matching textures before changing anything
+		texture_rgbs = {}
+		for tex_id, texture_xml in textures.items():
+			height, width, rgb = common.settings.get_texture_rgb(texture_xml)
+			if (model.tex_height[tex_id], model.tex_width[tex_id]) != (height, width):
+				return False
+			texture_rgbs[tex_id] = rgb
+
+		for field, mat_id, value in material_values:
+			getattr(model, field)[mat_id] = value
+		for tex_id, rgb in texture_rgbs.items():
+			start = model.tex_adr[tex_id]
+			if np.array_equal(model.tex_rgb[start:start+rgb.size], rgb):
+				continue
+			model.tex_rgb[start:start+rgb.size] = rgb
+			# upload the new texture to the GPU with the OpenGL context of this physics instance
+			with physics.contexts.gl.make_current() as ctx:
+				ctx.call(
+					mjbindings.mjlib.mjr_uploadTexture,
+					model.ptr,
+					physics.contexts.mujoco.ptr,
+					tex_id
+				)
+		return True
 	
 	def get_state(self):
 		return self._get_state()
@@ -178,12 +306,21 @@ class ColorWrapper(gym.Wrapper):
 
 
 class FrameStack(gym.Wrapper):
-	"""Stack frames as observation"""
-	def __init__(self, env, k):
+	"""Stack frames as observation
+
+	With ring_size, frames are rendered directly into a preallocated ring of ring_size frames,
+	so an observation stays valid for ring_size - k steps after it is returned.
+	"""
+	def __init__(self, env, k, ring_size=None):
 		gym.Wrapper.__init__(self, env)
 		self._k = k
 		self._frames = deque([], maxlen=k)
 		shp = env.observation_space.shape
+		self._ring = None
+		if ring_size is not None:
+			assert ring_size > k, 'frame ring must hold more frames than are stacked'
+			self._ring = np.empty((ring_size, *shp), dtype=env.observation_space.dtype)
+			self._slot = 0
 		self.observation_space = gym.spaces.Box(
 			low=0,
 			high=1,
@@ -192,13 +329,29 @@ class FrameStack(gym.Wrapper):
 		)
 		self._max_episode_steps = env._max_episode_steps
 
+	def _get_dmc_wrapper(self):
+		_env = self.env
+		while not isinstance(_env, dmc2gym.wrappers.DMCWrapper) and hasattr(_env, 'env'):
+			_env = _env.env
+		assert isinstance(_env, dmc2gym.wrappers.DMCWrapper), 'environment is not dmc2gym-wrapped'
+
+		return _env
+
+	def _next_slot(self):
+		if self._ring is not None:
+			# looked up every time, as the DMC environment is remade on reset unless it is reused
+			self._get_dmc_wrapper().frame_out = self._ring[self._slot]
+			self._slot = (self._slot + 1) % len(self._ring)
+
 	def reset(self):
+		self._next_slot()
 		obs = self.env.reset()
 		for _ in range(self._k):
 			self._frames.append(obs)
 		return self._get_obs()
 
 	def step(self, action):
+		self._next_slot()
 		obs, reward, done, info = self.env.step(action)
 		self._frames.append(obs)
 		return self._get_obs(), reward, done, info
@@ -229,35 +382,97 @@ def rgb_to_hsv(r, g, b):
 	return h, s, v
 
 
-def do_green_screen(x, bg):
-	"""Removes green background from observation and replaces with bg; not optimized for speed"""
-	assert isinstance(x, np.ndarray) and isinstance(bg, np.ndarray), 'inputs must be numpy arrays'
-	assert x.dtype == np.uint8 and bg.dtype == np.uint8, 'inputs must be uint8 arrays'
-	
-	# Get image sizes
-	x_h, x_w = x.shape[1:]
+def green_screen_mask(x):
+	"""Vectorized HSV chroma-key mask, x: uint8 (...,3,H,W); returns bool (...,H,W)"""
+	x = x.astype(np.float64) / 255.
+	r, g, b = x[..., 0, :, :], x[..., 1, :, :], x[..., 2, :, :]
+	maxc = np.maximum(np.maximum(r, g), b)
+	minc = np.minimum(np.minimum(r, g), b)
+	delta = maxc - minc
+	chromatic = delta > 0
 
-	# Convert to RGBA images
-	im = TF.to_pil_image(torch.ByteTensor(x))
-	im = im.convert('RGBA')
-	pix = im.load()
-	bg = TF.to_pil_image(torch.ByteTensor(bg))
-	bg = bg.convert('RGBA')
-	bg = bg.load()
+	# Same arithmetic as rgb_to_hsv, evaluated for all pixels at once
+	with np.errstate(divide='ignore', invalid='ignore'):
+		s = delta / maxc
+		rc = (maxc-r) / delta
+		gc = (maxc-g) / delta
+		bc = (maxc-b) / delta
+		h = np.where(r == maxc, bc-gc, np.where(g == maxc, 2.0+rc-bc, 4.0+gc-rc))
+		h = (h/6.0) % 1.0
+	h, s, v = h * 360, s * 255, maxc * 255
 
-	# Replace pixels
-	for x in range(x_w):
-		for y in range(x_h):
-			r, g, b, a = pix[x, y]
-			h_ratio, s_ratio, v_ratio = rgb_to_hsv(r / 255., g / 255., b / 255.)
-			h, s, v = (h_ratio * 360, s_ratio * 255, v_ratio * 255)
+	min_h, min_s, min_v = (100, 80, 70)
+	max_h, max_s, max_v = (185, 255, 255)
+	return chromatic & (min_h <= h) & (h <= max_h) & (min_s <= s) & (s <= max_s) & (min_v <= v) & (v <= max_v)
 
-			min_h, min_s, min_v = (100, 80, 70)
-			max_h, max_s, max_v = (185, 255, 255)
-			if min_h <= h <= max_h and min_s <= s <= max_s and min_v <= v <= max_v:
-				pix[x, y] = bg[x, y]
 
-	return np.moveaxis(np.array(im).astype(np.uint8), -1, 0)[:3]
+def do_green_screen(x, bg, out=None):
+	"""Removes green background from observation(s) and replaces with bg, x and bg: uint8 (...,3,H,W)
+
+	The result is written to out if specified, which may be x itself.
+	"""
+	assert isinstance(x, np.ndarray) and isinstance(bg, np.ndarray), 'inputs must be numpy arrays'
+	assert x.dtype == np.uint8 and bg.dtype == np.uint8, 'inputs must be uint8 arrays'
+	assert x.shape[-3] == 3 and x.shape[-2:] == bg.shape[-2:], 'inputs must be RGB images of the same size'
+
+	mask = np.expand_dims(green_screen_mask(x), axis=-3)
+	if out is None:
+		return np.where(mask, bg, x)
+	if out is not x:
+		np.copyto(out, x)
+	np.copyto(out, np.broadcast_to(bg, out.shape), where=mask)
+	return out
+
+
+class VideoCache(object):
+	"""Process-wide LRU cache of decoded video frames, keyed by video path and target resolution"""
+	def __init__(self, max_bytes=2*1024**3):
+		self.max_bytes = max_bytes
+		self._entries = OrderedDict()
+		self._nbytes = 0
+		self.hits = 0
+		self.misses = 0
+
+	def configure(self, max_bytes):
+		self.max_bytes = max_bytes
+		self._evict()
+
+	def get(self, path, size, load_fn):
+		"""Returns cached frames for (path, size), calling load_fn to decode them on a miss"""
+		key = (path, size)
+		if key in self._entries:
+			self.hits += 1
+			self._entries.move_to_end(key)
+			return self._entries[key]
+
+		self.misses += 1
+		frames = load_fn()
+		if frames.nbytes <= self.max_bytes:
+			frames.setflags(write=False) # cached frames are shared between environments
+			self._entries[key] = frames
+			self._nbytes += frames.nbytes
+			self._evict()
+		return frames
+
+	def _evict(self):
+		while self._nbytes > self.max_bytes:
+			_, frames = self._entries.popitem(last=False)
+			self._nbytes -= frames.nbytes
+
+	def clear(self):
+		self._entries.clear()
+		self._nbytes = 0
+
+	def stats(self):
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'entries': len(self._entries),
+			'mbytes': self._nbytes / 1024**2
+		}
+
+
+video_cache = VideoCache()
 
 
 class VideoWrapper(gym.Wrapper):
@@ -298,8 +513,8 @@ class VideoWrapper(gym.Wrapper):
 
 		return _env
 
-	def _load_video(self, video):
-		"""Load video from provided filepath and return as numpy array"""
+	def _load_video(self, video, size=None):
+		"""Load video from provided filepath and return as numpy array, optionally resized to size"""
 		import cv2
 		cap = cv2.VideoCapture(video)
 		assert cap.get(cv2.CAP_PROP_FRAME_WIDTH) >= 100, 'width must be at least 100 pixels'
@@ -313,11 +528,29 @@ class VideoWrapper(gym.Wrapper):
 			buf[i] = frame
 			i += 1
 		cap.release()
-		return np.moveaxis(buf, -1, 1)
+		buf = np.moveaxis(buf, -1, 1)
+		if size is not None:
+			buf = self._interpolate_bg(buf, size)
+		return buf
+
+	def _interpolate_bg(self, bg, size:tuple, chunk_size=128):
+		"""Interpolate background frames (T,3,h,w) to size of observation, returns contiguous (T,3,H,W) uint8"""
+		out = np.empty((len(bg), 3, *size), dtype=np.uint8)
+		for i in range(0, len(bg), chunk_size):
+			chunk = torch.from_numpy(np.ascontiguousarray(bg[i:i+chunk_size])).float()/255.
+			chunk = F.interpolate(chunk, size=size, mode='bilinear', align_corners=False)
+			out[i:i+chunk_size] = (chunk*255.).byte().numpy()
+		return out
+
+	def _get_video(self, video, size=None):
+		"""Returns decoded frames of video, shared between all environments in this process"""
+		return video_cache.get(video, size, lambda: self._load_video(video, size))
 
 	def _reset_video(self):
 		self._get_contextual_dmc_wrapper().before_reset()
-		self._data = self._load_video(self._video_paths[self._randomised_video_indices[self._i]])
+		self._video_path = self._video_paths[self._randomised_video_indices[self._i]]
+		size = tuple(self.observation_space.shape[1:])
+		self._data = {size: self._get_video(self._video_path, size)}
 		self._i = (self._i + 1) % self._num_videos
 
 	def reset(self):
@@ -330,19 +563,19 @@ class VideoWrapper(gym.Wrapper):
 		self._current_frame += 1
 		obs, reward, done, info = self.env.step(action)
 		return self._greenscreen(obs), reward, done, info
-	
-	def _interpolate_bg(self, bg, size:tuple):
-		"""Interpolate background to size of observation"""
-		bg = torch.from_numpy(bg).float().unsqueeze(0)/255.
-		bg = F.interpolate(bg, size=size, mode='bilinear', align_corners=False)
-		return (bg*255.).byte().squeeze(0).numpy()
+
+	def _get_frames(self, size:tuple):
+		"""Returns background frames pre-resized to size, e.g. the observation or video recorder resolution"""
+		if size not in self._data:
+			self._data[size] = self._get_video(self._video_path, size)
+		return self._data[size]
 
 	def _greenscreen(self, obs):
 		"""Applies greenscreen if video is selected, otherwise does nothing"""
 		if self._num_videos > 0:
-			bg = self._data[self._current_frame % len(self._data)] # select frame
-			bg = self._interpolate_bg(bg, obs.shape[1:]) # scale bg to observation size
-			return do_green_screen(obs, bg) # apply greenscreen
+			data = self._get_frames(tuple(obs.shape[1:]))
+			bg = data[self._current_frame % len(data)] # select frame
+			return do_green_screen(obs, bg, out=obs) # apply greenscreen in place, obs is a new frame
 		return obs
 
 	def apply_to(self, obs):
@@ -0,0 +1,296 @@
+"""Tests of the environment wrappers."""
+
+import os
+import json
+import tempfile
+from absl.testing import absltest
+from absl.testing import parameterized
+import mock
+import numpy as np
+import torch
+import torchvision.transforms.functional as TF
+from cdmc.env import wrappers
+from dm_control.suite.common import settings
+
+_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+_VIDEO_PATH = os.path.join(_DATA_DIR, 'video_hard', 'video0.mp4')
+
+
+def _green_screen_inputs(shape, seed=0):
+	"""Random uint8 images of shape (...,3,H,W) with a block of green pixels, and a random background"""
+	rng = np.random.RandomState(seed)
+	x = rng.randint(0, 256, size=shape, dtype=np.uint8)
+	x[..., :, :shape[-2]//2, :shape[-1]//2] = np.array([20, 200, 40], dtype=np.uint8)[:, None, None]
+	bg = rng.randint(0, 256, size=shape[-3:], dtype=np.uint8)
+	return x, bg
+
+
+def _do_green_screen_loop(x, bg):
+	"""do_green_screen as it was before it was vectorized, a per-pixel loop over PIL images"""
+	x_h, x_w = x.shape[1:]
+	im = TF.to_pil_image(torch.ByteTensor(x))
+	im = im.convert('RGBA')
+	pix = im.load()
+	bg = TF.to_pil_image(torch.ByteTensor(bg))
+	bg = bg.convert('RGBA')
+	bg = bg.load()
+	for x in range(x_w):
+		for y in range(x_h):
+			r, g, b, a = pix[x, y]
+			h_ratio, s_ratio, v_ratio = wrappers.rgb_to_hsv(r / 255., g / 255., b / 255.)
+			h, s, v = (h_ratio * 360, s_ratio * 255, v_ratio * 255)
+			min_h, min_s, min_v = (100, 80, 70)
+			max_h, max_s, max_v = (185, 255, 255)
+			if min_h <= h <= max_h and min_s <= s <= max_s and min_v <= v <= max_v:
+				pix[x, y] = bg[x, y]
+	return np.moveaxis(np.array(im).astype(np.uint8), -1, 0)[:3]
+
+
+def _edge_case_pixels():
+	"""RGB pixels on the edges of the chroma key, (N,3) uint8"""
+	pixels = []
+	# gray pixels, including black and white, have zero saturation
+	pixels += [(v, v, v) for v in range(256)]
+	# hues near 0 and 1, where the hue wraps around
+	pixels += [(255, g, g + d) for g in range(0, 250, 10) for d in (-1, 0, 1) if g + d >= 0]
+	pixels += [(r, g, g + d) for r in (70, 128, 200) for g in range(0, 60, 7) for d in (-1, 1) if g + d >= 0]
+	# hue of exactly 100 degrees, g max and b min with r - b = (g - b) / 3, and its neighbours
+	pixels += [(b + d//3 + e, b + d, b) for b in range(0, 256, 15) for d in range(3, 256 - b, 9) for e in (-1, 0, 1)]
+	# hue of exactly 185 degrees, b max and r min with g - r = 11 (b - r) / 12, and its neighbours
+	pixels += [(r, r + 11*d//12 + e, r + d) for r in range(0, 256, 15) for d in range(12, 256 - r, 12) for e in (-1, 0, 1)]
+	# saturation of exactly 80, (max - min) * 255 = 80 max, and its neighbours
+	pixels += [(m - 16*m//51 + e, m, (m - 16*m//51 + m) // 2) for m in range(51, 256, 51) for e in (-1, 0, 1)]
+	# values of 69 to 71 around the minimum value of 70
+	pixels += [(r, v, b) for v in (69, 70, 71) for r in range(0, v + 1, 5) for b in range(0, v + 1, 5)]
+	pixels = np.clip(np.array(pixels), 0, 255).astype(np.uint8)
+	return pixels
+
+
+class GreenScreenTest(parameterized.TestCase):
+
+	@parameterized.parameters(0, 1, 2)
+	def testMatchesPerPixelLoopOnRandomFrames(self, seed):
+		x, bg = _green_screen_inputs((3, 32, 48), seed=seed)
+		np.testing.assert_array_equal(wrappers.do_green_screen(x, bg), _do_green_screen_loop(x, bg))
+
+	def testMatchesPerPixelLoopOnEdgeCases(self):
+		pixels = _edge_case_pixels()
+		width = 64
+		height = -(-len(pixels) // width)
+		x = np.zeros((height*width, 3), dtype=np.uint8)
+		x[:len(pixels)] = pixels
+		x = np.ascontiguousarray(x.reshape(height, width, 3).transpose(2, 0, 1))
+		bg = np.random.RandomState(0).randint(0, 256, size=x.shape, dtype=np.uint8)
+		expected = _do_green_screen_loop(x, bg)
+		# both sides of the thresholds are covered
+		mask = wrappers.green_screen_mask(x)
+		self.assertTrue(mask.any())
+		self.assertFalse(mask.all())
+		np.testing.assert_array_equal(wrappers.do_green_screen(x, bg), expected)
+
+	def testFrameStackMatchesPerFrameLoop(self):
+		x, bg = _green_screen_inputs((2, 3, 32, 48))
+		out = wrappers.do_green_screen(x, bg)
+		for i in range(len(x)):
+			np.testing.assert_array_equal(out[i], _do_green_screen_loop(x[i], bg))
+
+	@parameterized.parameters((3, 32, 48), (2, 3, 32, 48))
+	def testInPlaceMatchesAllocating(self, *shape):
+		x, bg = _green_screen_inputs(shape)
+		expected = wrappers.do_green_screen(x, bg)
+		self.assertTrue(wrappers.green_screen_mask(x).any())
+		self.assertFalse(np.array_equal(expected, x))
+
+		out = np.zeros_like(x)
+		self.assertIs(wrappers.do_green_screen(x, bg, out=out), out)
+		np.testing.assert_array_equal(out, expected)
+
+		y = x.copy()
+		self.assertIs(wrappers.do_green_screen(y, bg, out=y), y)
+		np.testing.assert_array_equal(y, expected)
+
+
+def _write_contexts(path, num_contexts, bounded_states=True, seed=0):
+	"""Writes a walker_walk context file as generate_contexts.py does, with colours from color_hard.pt and hard videos
+
+	With bounded_states, the contexts hold physics states of new episodes, otherwise their number, as in test files.
+	"""
+	rng = np.random.RandomState(seed)
+	all_colors = torch.load(os.path.join(_DATA_DIR, 'color_hard.pt'))
+	colors = [dict([(k, np.asarray(v).tolist()) for k, v in all_colors[i].items()]) for i in rng.choice(len(all_colors), num_contexts, replace=False)]
+	video_paths = [os.path.join(_DATA_DIR, 'video_hard', f'video{i}.mp4') for i in rng.choice(10, num_contexts, replace=False)]
+	states = num_contexts
+	if bounded_states:
+		states = []
+		for i in range(num_contexts):
+			env = wrappers.make_env('walker', 'walk', seed=seed+i, episode_length=20, action_repeat=2, from_pixels=False)
+			env.reset()
+			states.append((seed+i, env._get_dmc_wrapper()._env.physics.get_state().tolist()))
+	with open(path, 'w') as f:
+		json.dump({'states': states, 'colors': colors, 'video_paths': video_paths}, f)
+
+
+class ContextualDMCWrapperTest(parameterized.TestCase):
+
+	def _rollout(self, contexts, reuse_env):
+		"""Physics states, observations and dones of an episode per context and one more, reset between them"""
+		env = wrappers.make_env(
+			'walker', 'walk', seed=1, episode_length=20, action_repeat=2, image_size=64,
+			states=contexts['states'], video_paths=contexts['video_paths'],
+			colors=[dict([(k, np.array(v)) for k, v in color.items()]) for color in contexts['colors']],
+			reuse_env=reuse_env, frame_ring_size=4
+		)
+		rng = np.random.RandomState(0)
+		trajectory = []
+		# episodes of varying length, one for every context and a first one again
+		for num_steps in [10, 3, 10, 0, 5, 10][:len(contexts['colors']) + 1]:
+			obs = env.reset()
+			trajectory.append((env._get_dmc_wrapper()._env.physics.get_state(), np.array(obs), False))
+			for _ in range(num_steps):
+				obs, _, done, _ = env.step(rng.uniform(-1, 1, size=env.action_space.shape))
+				trajectory.append((env._get_dmc_wrapper()._env.physics.get_state(), np.array(obs), done))
+		return trajectory
+
+	@parameterized.named_parameters(('train_contexts', True), ('test_contexts', False))
+	def testReseedingMatchesRemakingForAllContexts(self, bounded_states):
+		with tempfile.TemporaryDirectory() as tempdir:
+			path = os.path.join(tempdir, 'contexts.json')
+			_write_contexts(path, 5, bounded_states)
+			with open(path) as f:
+				contexts = json.load(f)
+		expected = self._rollout(contexts, reuse_env=False)
+		actual = self._rollout(contexts, reuse_env=True)
+		self.assertLen(actual, len(expected))
+		for (a, a_obs, a_done), (b, b_obs, b_done) in zip(expected, actual):
+			np.testing.assert_array_equal(a, b)
+			np.testing.assert_array_equal(a_obs, b_obs)
+			self.assertEqual(a_done, b_done)
+
+	def testFrameRingFollowsRemadeEnvironment(self):
+		env = wrappers.make_env('walker', 'walk', seed=0, episode_length=20, action_repeat=2, image_size=64, states=3, reuse_env=False, frame_ring_size=4)
+		frame_stack = env.env
+		for _ in range(3):
+			obs = env.reset()
+			self.assertTrue(np.shares_memory(obs.frames[-1], frame_stack._ring))
+			obs, _, _, _ = env.step(np.zeros(env.action_space.shape))
+			self.assertTrue(np.shares_memory(obs.frames[-1], frame_stack._ring))
+
+
+def _colors(num_colors, seed=0):
+	"""Colour contexts that set all in-place settings, including the skybox with its random marks"""
+	rng = np.random.RandomState(seed)
+	keys = ['grid_rgb1', 'grid_rgb2', 'grid_markrgb', 'self_rgb', 'skybox_rgb', 'skybox_rgb2', 'skybox_markrgb']
+	colors = []
+	for _ in range(num_colors):
+		color = {k: rng.uniform(0, 1, size=3).round(3) for k in keys}
+		color['grid_texrepeat'] = rng.randint(1, 5, size=2)
+		colors.append(color)
+	return colors
+
+
+class ColorWrapperTest(absltest.TestCase):
+
+	def _make_env(self, colors, recolor, reuse_gl_context=True):
+		env = wrappers.make_env(
+			'walker', 'walk', seed=0, episode_length=20, action_repeat=2, image_size=64,
+			colors=colors, reuse_gl_context=reuse_gl_context
+		)
+		if not recolor:
+			# always recompile the model from XML
+			env._recolor_physics = lambda setting_kwargs: False
+		return env
+
+	def _observations(self, env, num_resets):
+		return [np.array(env.reset()) for _ in range(num_resets)]
+
+	def testInPlaceRecolorMatchesReload(self):
+		colors = _colors(3)
+		env = self._make_env(colors, recolor=True)
+		with mock.patch.object(env, '_reload_physics', wraps=env._reload_physics) as reload_physics:
+			observations = self._observations(env, 2*len(colors))
+		reload_physics.assert_not_called()
+		expected = self._observations(self._make_env(colors, recolor=False), 2*len(colors))
+		for obs, expected_obs in zip(observations, expected):
+			np.testing.assert_array_equal(obs, expected_obs)
+
+	def testKeptRenderingContextsMatchFreshContexts(self):
+		colors = _colors(3)
+		observations = self._observations(self._make_env(colors, recolor=False, reuse_gl_context=True), 2*len(colors))
+		expected = self._observations(self._make_env(colors, recolor=False, reuse_gl_context=False), 2*len(colors))
+		for obs, expected_obs in zip(observations, expected):
+			np.testing.assert_array_equal(obs, expected_obs)
+
+	def testSettingsAreParsedOncePerContext(self):
+		colors = _colors(3)
+		env = self._make_env(colors, recolor=True)
+		parse = settings.get_textures_and_materials_from_setting_kwargs
+		with mock.patch.object(settings, 'get_textures_and_materials_from_setting_kwargs', wraps=parse) as mock_parse:
+			self._observations(env, 3*len(colors))
+		# once for the default settings the model is checked against, then once per context
+		self.assertEqual(mock_parse.call_count, 1 + len(colors))
+
+	def testFallsBackToReloadIfTexturesDiffer(self):
+		colors = _colors(2)
+		env = self._make_env(colors, recolor=True)
+		get_texture_rgb = settings.get_texture_rgb
+		def perturbed_texture_rgb(texture_xml):
+			# a standalone texture compile that does not reproduce the texture of the model
+			height, width, rgb = get_texture_rgb(texture_xml)
+			return height, width, 255 - rgb
+		with mock.patch.object(settings, 'get_texture_rgb', side_effect=perturbed_texture_rgb):
+			with mock.patch.object(env, '_reload_physics', wraps=env._reload_physics) as reload_physics:
+				observations = self._observations(env, len(colors))
+		self.assertEqual(env._recolor_ids, ())
+		self.assertEqual(reload_physics.call_count, len(colors))
+		expected = self._observations(self._make_env(colors, recolor=False), len(colors))
+		for obs, expected_obs in zip(observations, expected):
+			np.testing.assert_array_equal(obs, expected_obs)
+
+
+class VideoCacheTest(absltest.TestCase):
+
+	def _frames(self, nbytes, value=0):
+		return np.full((nbytes // 3, 3, 1, 1), value, dtype=np.uint8)
+
+	def testHitsAndMisses(self):
+		cache = wrappers.VideoCache(max_bytes=300)
+		load_fn = mock.Mock(side_effect=lambda: self._frames(99, value=7))
+		a = cache.get('a.mp4', (8, 8), load_fn)
+		b = cache.get('a.mp4', (8, 8), load_fn)
+		cache.get('a.mp4', (4, 4), lambda: self._frames(99))
+		self.assertIs(a, b)
+		self.assertEqual(load_fn.call_count, 1)
+		self.assertFalse(a.flags.writeable)
+		self.assertEqual(cache.stats(), {'hits': 1, 'misses': 2, 'entries': 2, 'mbytes': 198 / 1024**2})
+
+	def testEvictsLeastRecentlyUsed(self):
+		cache = wrappers.VideoCache(max_bytes=300)
+		for path in ['a', 'b', 'c']:
+			cache.get(path, None, lambda: self._frames(99))
+		cache.get('a', None, lambda: self._frames(99))
+		cache.get('d', None, lambda: self._frames(99))
+		self.assertEqual(list(cache._entries), [('c', None), ('a', None), ('d', None)])
+
+		cache.configure(max_bytes=200)
+		self.assertEqual(list(cache._entries), [('a', None), ('d', None)])
+		self.assertLessEqual(cache.stats()['mbytes'] * 1024**2, 200)
+
+	def testFramesLargerThanLimitAreNotCached(self):
+		cache = wrappers.VideoCache(max_bytes=100)
+		frames = cache.get('a', None, lambda: self._frames(300))
+		self.assertTrue(frames.flags.writeable)
+		self.assertEqual(cache.stats()['entries'], 0)
+
+	def testCachedVideoMatchesDecoding(self):
+		env = wrappers.make_env('walker', 'walk', image_size=64, video_paths=[_VIDEO_PATH])
+		video_env = env.env.env
+		self.assertIsInstance(video_env, wrappers.VideoWrapper)
+		wrappers.video_cache.clear()
+		cached = video_env._get_video(_VIDEO_PATH, (64, 64))
+		self.assertIs(video_env._get_video(_VIDEO_PATH, (64, 64)), cached)
+		np.testing.assert_array_equal(cached, video_env._load_video(_VIDEO_PATH, (64, 64)))
+		wrappers.video_cache.clear()
+
+
+if __name__ == '__main__':
+	absltest.main()
@@ -7,11 +7,10 @@ import cdmc.utils as utils
 from copy import deepcopy
 from tqdm import tqdm
 from cdmc.arguments import parse_args
-from cdmc.env.wrappers import make_env
+import cdmc.env.rendering as rendering
 from cdmc.algorithms.factory import make_agent
 from cdmc.video import VideoRecorder
 import cdmc.augmentations as augmentations
-from pyvirtualdisplay import Display
 import json
 
 
@@ -34,7 +33,7 @@ def evaluate(env, agent, video, num_episodes, video_mode, adapt=False):
 			video.record(env, video_mode)
 			episode_reward += reward
 			if adapt:
-				ep_agent.update_inverse_dynamics(*augmentations.prepare_pad_batch(obs, next_obs, action))
+				ep_agent.update_inverse_dynamics(*augmentations.prepare_pad_batch(obs, next_obs, action, device=ep_agent.device))
 			obs = next_obs
 
 		video.save(f'eval_{i}.mp4')
@@ -44,15 +43,21 @@ def evaluate(env, agent, video, num_episodes, video_mode, adapt=False):
 
 
 def main(args):
+	# dm_control sets up the rendering backend when it is first imported
+	rendering.select_backend(args.render_backend)
+	from cdmc.env.wrappers import make_env, video_cache
+	from cdmc.evaluation import evaluate_batch
+
 	# Set seed
 	utils.set_seed_everywhere(args.seed)
 
 	# Initialize environments
 	gym.logger.set_level(40)
+	video_cache.configure(max_bytes=args.video_cache_mb * 1024**2)
 	with open(args.test_context_file, 'r') as file:
 		contexts = json.load(file)
 	video_mode = len(contexts['video_paths'])>0
-	env = make_env(
+	envs = [make_env(
 		domain_name=args.domain_name,
 		task_name=args.task_name,
 		seed=args.seed+42,
@@ -63,7 +68,9 @@ def main(args):
 		states=contexts['states'],
 		video_paths=contexts['video_paths'],
 		colors=[dict([(k, np.array(v)) for k,v in color_dict.items()]) for color_dict in contexts['colors']],
-	)
+		render_backend=args.render_backend,
+	) for _ in range(max(1, args.eval_envs))]
+	env = envs[0]
 
 	# Set working directory
 	work_dir = os.path.join(args.log_dir, args.domain_name+'_'+args.task_name, args.algorithm, args.context_file[:-5], str(args.seed))
@@ -78,7 +85,7 @@ def main(args):
 	assert not os.path.exists(results_fp), f'results already exist for {work_dir}'
 
 	# Prepare agent
-	assert torch.cuda.is_available(), 'must have cuda enabled'
+	assert torch.device(args.device).type != 'cuda' or torch.cuda.is_available(), 'must have cuda enabled'
 	cropped_obs_shape = (3*args.frame_stack, args.image_crop_size, args.image_crop_size)
 	print('Observations:', env.observation_space.shape)
 	print('Cropped observations:', cropped_obs_shape)
@@ -87,12 +94,16 @@ def main(args):
 		action_shape=env.action_space.shape,
 		args=args
 	)
-	agent = torch.load(os.path.join(model_dir, str(args.train_steps)+'.pt'))
+	agent = torch.load(os.path.join(model_dir, str(args.train_steps)+'.pt'), map_location=args.device)
+	agent.device = torch.device(args.device) # checkpoints may have been saved on another device
 	agent.train(False)
 
 	print(f'\nEvaluating {work_dir} for {args.eval_episodes} episodes')
-	reward = evaluate(env, agent, video, args.eval_episodes, video_mode)
+	episode_rewards, context_rewards = evaluate_batch(envs, agent, args.eval_episodes, video, video_prefix='eval_0')
+	reward = np.mean(episode_rewards)
 	print('Reward:', int(reward))
+	for context, context_reward in sorted(context_rewards.items(), key=lambda item: str(item[0])):
+		print(f'Reward for context (state, video, color) {context}:', int(context_reward))
 
 	adapt_reward = None
 	if args.algorithm == 'pad':
@@ -102,6 +113,7 @@ def main(args):
 			seed=args.seed+42,
 			episode_length=args.episode_length,
 			action_repeat=args.action_repeat,
+			render_backend=args.render_backend,
 		)
 		adapt_reward = evaluate(env, agent, video, args.eval_episodes, video_mode, adapt=True)
 		print('Adapt reward:', int(adapt_reward))
@@ -110,6 +122,8 @@ def main(args):
 	torch.save({
 		'args': args,
 		'reward': reward,
+		'episode_rewards': episode_rewards,
+		'context_rewards': context_rewards,
 		'adapt_reward': adapt_reward
 	}, results_fp)
 	print('Saved results to', results_fp)
@@ -117,5 +131,5 @@ def main(args):
 
 if __name__ == '__main__':
 	args = parse_args()
-	with Display() as disp:
+	with rendering.display(rendering.select_backend(args.render_backend)) as disp:
 		main(args)
@@ -0,0 +1,158 @@
+import json
+import queue
+import numpy as np
+import torch.multiprocessing as mp
+from collections import defaultdict
+import cdmc.utils as utils
+from cdmc.env.wrappers import make_env, set_context_index, episode_context
+from cdmc.algorithms.factory import make_agent
+from cdmc.video import VideoRecorder
+
+
+def evaluate_batch(envs, agent, num_episodes, video=None, video_prefix=''):
+	"""Plays num_episodes evaluation episodes on envs in lockstep, with one batched actor forward per step
+
+	Episode i runs on envs[i % len(envs)], set to the contexts of the i-th episode of a fresh
+	environment, so all envs must be made with the same arguments. Episodes that finish early are
+	dropped from the batch. If the physics state of each episode is set by its context, rewards
+	match evaluating the episodes one at a time on a fresh environment, up to floating point
+	differences between batched and single actor forwards. The first episode of envs[0] is recorded
+	to video if given. Returns per-episode rewards and the mean reward of each context, keyed
+	by the (state, video, color) indices of episode_context.
+	"""
+	episode_rewards = np.zeros(num_episodes)
+	next_episode = 0
+	running = {} # env index -> (episode, obs)
+	while next_episode < num_episodes or running:
+		# start new episodes on idle environments
+		for j, env in enumerate(envs):
+			if j not in running and next_episode < num_episodes:
+				set_context_index(env, next_episode)
+				running[j] = (next_episode, env.reset())
+				if j == 0 and video is not None:
+					video.init(enabled=(next_episode==0))
+				next_episode += 1
+
+		slots = sorted(running)
+		with utils.eval_mode(agent):
+			actions = agent.select_actions([running[j][1] for j in slots])
+		for j, action in zip(slots, actions):
+			episode, _ = running[j]
+			obs, reward, done, _ = envs[j].step(action)
+			episode_rewards[episode] += reward
+			if j == 0 and video is not None:
+				video.record(envs[j])
+			if done:
+				del running[j]
+				if j == 0 and video is not None:
+					video.save(f'{video_prefix}.mp4')
+			else:
+				running[j] = (episode, obs)
+
+	context_rewards = defaultdict(list)
+	for i, reward in enumerate(episode_rewards):
+		context_rewards[episode_context(envs[0], i)].append(reward)
+	return episode_rewards, {context: np.mean(rewards) for context, rewards in context_rewards.items()}
+
+
+def _eval_worker(args, obs_shape, action_shape, video_dir, requests, results):
+	"""Evaluates actor snapshots from requests on its own train and test environments until it receives None"""
+	utils.set_seed_everywhere(args.seed)
+	def make_context_envs(context_file, seed):
+		with open(context_file, 'r') as file:
+			contexts = json.load(file)
+		return [make_env(
+			domain_name=args.domain_name,
+			task_name=args.task_name,
+			seed=seed,
+			episode_length=args.episode_length,
+			action_repeat=args.action_repeat,
+			image_size=args.image_size,
+			states=contexts['states'],
+			video_paths=contexts['video_paths'],
+			colors=[dict([(k, np.array(v)) for k,v in color_dict.items()]) for color_dict in contexts['colors']],
+			render_backend=args.render_backend,
+		) for _ in range(max(1, args.eval_envs))]
+	eval_envs = make_context_envs(args.train_context_file, args.seed)
+	test_envs = make_context_envs(args.test_context_file, args.seed+42)
+	video = VideoRecorder(video_dir, height=448, width=448)
+	agent = make_agent(obs_shape=obs_shape, action_shape=action_shape, args=args)
+
+	while True:
+		request = requests.get()
+		if request is None:
+			break
+		step, episode, actor_state_dict = request
+		agent.actor.load_state_dict(actor_state_dict)
+		del actor_state_dict
+		episode_rewards, _ = evaluate_batch(eval_envs, agent, args.eval_episodes, video, video_prefix=f'{step}')
+		test_episode_rewards, _ = evaluate_batch(test_envs, agent, args.eval_episodes, video, video_prefix=f'{step}_test_env')
+		results.put((step, {
+			'eval/episode': [episode],
+			'eval/episode_reward': episode_rewards.tolist(),
+			'eval/episode_reward_test_env': test_episode_rewards.tolist()
+		}))
+
+
+class AsyncEvaluator(object):
+	"""Runs periodic evaluation in a separate process, so that training continues while it plays episodes
+
+	submit sends a snapshot of the actor weights through shared memory and blocks only while
+	max_in_flight evaluations are already running. Finished evaluations are returned by submit,
+	poll and close as (step, {key: values}) pairs, where step is the step of the snapshot.
+	"""
+	def __init__(self, args, obs_shape, action_shape, video_dir=None, max_in_flight=1):
+		assert max_in_flight > 0, 'must allow at least one evaluation in flight'
+		self.max_in_flight = max_in_flight
+		self.in_flight = 0
+		ctx = mp.get_context('spawn')
+		self._requests = ctx.Queue()
+		self._results = ctx.Queue()
+		self._process = ctx.Process(
+			target=_eval_worker,
+			args=(args, obs_shape, action_shape, video_dir, self._requests, self._results),
+			daemon=True
+		)
+		self._process.start()
+
+	def _get(self, block):
+		while True:
+			try:
+				result = self._results.get(timeout=1.0) if block else self._results.get_nowait()
+			except queue.Empty:
+				if not self._process.is_alive():
+					raise RuntimeError(f'evaluation worker exited with code {self._process.exitcode}')
+				if not block:
+					return None
+				continue
+			self.in_flight -= 1
+			return result
+
+	def poll(self):
+		"""Returns the evaluations that have finished since the last call, without blocking"""
+		finished = []
+		while self.in_flight > 0:
+			result = self._get(block=False)
+			if result is None:
+				break
+			finished.append(result)
+		return finished
+
+	def submit(self, step, episode, agent):
+		"""Queues an evaluation of the current actor weights, returns the evaluations that finished meanwhile"""
+		finished = self.poll()
+		while self.in_flight >= self.max_in_flight:
+			finished.append(self._get(block=True))
+		actor_state_dict = {k: v.detach().to('cpu', copy=True).share_memory_() for k, v in agent.actor.state_dict().items()}
+		self._requests.put((step, episode, actor_state_dict))
+		self.in_flight += 1
+		return finished
+
+	def close(self):
+		"""Waits for the evaluations in flight and stops the worker, returns their results"""
+		finished = []
+		while self.in_flight > 0:
+			finished.append(self._get(block=True))
+		self._requests.put(None)
+		self._process.join()
+		return finished
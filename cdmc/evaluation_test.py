@@ -0,0 +1,75 @@
+"""Tests of batched evaluation."""
+
+from absl.testing import absltest
+from absl.testing import parameterized
+import numpy as np
+import cdmc.utils as utils
+from cdmc.env.wrappers import make_env
+from cdmc.evaluation import evaluate_batch
+
+
+def _make_env(states):
+	return make_env('walker', 'walk', seed=0, episode_length=40, action_repeat=4, image_size=32, states=states)
+
+
+class _ScriptedAgent(object):
+	"""Deterministic policy of a fixed random projection of the observation, computed row by row
+
+	Batched and single actions are bit for bit identical, unlike those of a network, so rewards of
+	batched and sequential evaluation can be compared exactly.
+	"""
+	def __init__(self, obs_shape, action_dim, seed=0):
+		rng = np.random.RandomState(seed)
+		self._W = rng.randn(action_dim, int(np.prod(obs_shape))) / 255.
+
+	def train(self, training=True):
+		pass
+
+	def select_action(self, obs):
+		x = np.asarray(obs, dtype=np.float64).reshape(-1)
+		return np.tanh(self._W @ (x - 127.5) / 16.).astype(np.float32)
+
+	def select_actions(self, obses):
+		return np.stack([self.select_action(obs) for obs in obses])
+
+
+def _evaluate_sequential(env, agent, num_episodes):
+	"""Evaluation before batching: episodes played one after another on a single environment"""
+	episode_rewards = []
+	for _ in range(num_episodes):
+		obs = env.reset()
+		done = False
+		episode_reward = 0
+		while not done:
+			with utils.eval_mode(agent):
+				action = agent.select_action(obs)
+			obs, reward, done, _ = env.step(action)
+			episode_reward += reward
+		episode_rewards.append(episode_reward)
+	return np.array(episode_rewards)
+
+
+class EvaluateBatchTest(parameterized.TestCase):
+
+	@parameterized.parameters(1, 2, 3)
+	def testMatchesSequentialEvaluation(self, num_envs):
+		num_episodes = 5
+		env = _make_env(states=num_episodes)
+		agent = _ScriptedAgent(env.observation_space.shape, env.action_space.shape[0])
+		expected = _evaluate_sequential(env, agent, num_episodes)
+
+		envs = [_make_env(states=num_episodes) for _ in range(num_envs)]
+		episode_rewards, context_rewards = evaluate_batch(envs, agent, num_episodes)
+		np.testing.assert_array_equal(episode_rewards, expected)
+		self.assertEqual(sorted(context_rewards), [(i, None, None) for i in range(num_episodes)])
+
+	def testEvaluationsReplaySameEpisodes(self):
+		envs = [_make_env(states=3) for _ in range(2)]
+		agent = _ScriptedAgent(envs[0].observation_space.shape, envs[0].action_space.shape[0])
+		first, _ = evaluate_batch(envs, agent, 3)
+		second, _ = evaluate_batch(envs, agent, 3)
+		np.testing.assert_array_equal(first, second)
+
+
+if __name__ == '__main__':
+	absltest.main()
@@ -1,6 +1,6 @@
 from cdmc.arguments import parse_args
+import cdmc.env.rendering as rendering
 import json
-from pyvirtualdisplay import Display
 import torch
 from inspect import getsourcefile
 from os.path import abspath
@@ -8,7 +8,7 @@ import os
 import numpy as np
 import copy
 
-with Display() as disp:
+with rendering.display(rendering.select_backend(rendering.parse_backend())) as disp:
 	from env.wrappers import make_env
 	args = parse_args()
 	
@@ -52,6 +52,7 @@ with Display() as disp:
 			episode_length=args.episode_length,
 			action_repeat=args.action_repeat,
 			image_size=args.image_size,
+			render_backend=args.render_backend,
 		)
 		env.reset()
 		physics_states.append((current_seed, env.get_state().tolist()))
@@ -78,6 +78,10 @@ class MetersGroup(object):
 
     def _dump_to_wandb(self, data, step, prefix):
         data = {prefix + '/' + key: val for key, val in data.items()}
+        # wandb drops steps older than the current one, e.g. from asynchronous evaluation,
+        # these are logged at the current step and keep their own step in prefix/step
+        if wandb.run is not None and step < getattr(wandb.run, 'step', step):
+            step = None
         wandb.log(data, step)
 
     def dump(self, step, prefix):
@@ -124,3 +128,6 @@ class Logger(object):
     def dump(self, step):
         self._train_mg.dump(step, 'train')
         self._eval_mg.dump(step, 'eval')
+
+    def dump_eval(self, step):
+        self._eval_mg.dump(step, 'eval')
@@ -0,0 +1,55 @@
+import argparse
+import os
+import json
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+import torchvision.datasets as datasets
+
+
+def parse_args():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--data_dir', required=True, type=str)
+	parser.add_argument('--partition', default='train', choices=['train', 'val'])
+	parser.add_argument('--image_size', default=128, type=int)
+	parser.add_argument('--max_images', default=None, type=int)
+	parser.add_argument('--seed', default=0, type=int)
+	return parser.parse_args()
+
+
+def _load_image(path, image_size):
+	"""Center crop to a square and resize to image_size"""
+	img = Image.open(path).convert('RGB')
+	w, h = img.size
+	s = min(w, h)
+	img = img.crop(((w-s)//2, (h-s)//2, (w-s)//2 + s, (h-s)//2 + s)).resize((image_size, image_size), Image.BILINEAR)
+	return np.asarray(img).transpose(2, 0, 1)
+
+
+def main(args):
+	"""Packs places365_standard/<partition> into data_dir/places365_packed/<partition>.npy for PlacesBank"""
+	src = os.path.join(args.data_dir, 'places365_standard', args.partition)
+	out_dir = os.path.join(args.data_dir, 'places365_packed')
+	os.makedirs(out_dir, exist_ok=True)
+
+	samples = datasets.ImageFolder(src).samples
+	if args.max_images is not None and args.max_images < len(samples):
+		rng = np.random.RandomState(args.seed)
+		samples = [samples[i] for i in sorted(rng.choice(len(samples), size=args.max_images, replace=False))]
+
+	fp = os.path.join(out_dir, f'{args.partition}.npy')
+	images = np.lib.format.open_memmap(fp, mode='w+', dtype=np.uint8, shape=(len(samples), 3, args.image_size, args.image_size))
+	for i, (path, _) in enumerate(tqdm(samples)):
+		images[i] = _load_image(path, args.image_size)
+	images.flush()
+
+	with open(os.path.join(out_dir, f'{args.partition}.json'), 'w') as f:
+		json.dump({
+			'image_size': args.image_size,
+			'samples': [(os.path.relpath(path, src), label) for path, label in samples]
+		}, f)
+	print(f'Packed {len(samples)} images at {args.image_size}px to', fp)
+
+
+if __name__ == '__main__':
+	main(parse_args())
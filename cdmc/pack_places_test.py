@@ -0,0 +1,106 @@
+"""Tests of the packed Places bank."""
+
+import os
+import json
+import argparse
+import tempfile
+from absl.testing import absltest
+import mock
+import numpy as np
+import torch
+import torchvision.datasets as datasets
+from PIL import Image
+import cdmc.utils as utils
+import cdmc.augmentations as augmentations
+from cdmc import pack_places
+
+_IMAGE_SIZE = 96
+
+
+def _write_images(src, seed=0):
+	"""Random JPEG and PNG images of varying aspect ratios in two class folders of an ImageFolder"""
+	rng = np.random.RandomState(seed)
+	for label, sizes in enumerate([[(120, 100), (100, 160)], [(128, 128), (200, 110), (97, 97)]]):
+		class_dir = os.path.join(src, f'class{label}')
+		os.makedirs(class_dir)
+		for i, (w, h) in enumerate(sizes):
+			img = Image.fromarray(rng.randint(0, 256, size=(h, w, 3), dtype=np.uint8))
+			img.save(os.path.join(class_dir, f'{i}.png' if i % 2 else f'{i}.jpg'))
+
+
+class PackPlacesTest(absltest.TestCase):
+
+	def setUp(self):
+		super().setUp()
+		tempdir = tempfile.TemporaryDirectory()
+		self.addCleanup(tempdir.cleanup)
+		self._data_dir = tempdir.name
+		self._src = os.path.join(self._data_dir, 'places365_standard', 'train')
+		_write_images(self._src)
+		pack_places.main(argparse.Namespace(data_dir=self._data_dir, partition='train', image_size=_IMAGE_SIZE, max_images=None, seed=0))
+		self._out_dir = os.path.join(self._data_dir, 'places365_packed')
+		# the bank is loaded from data_dir and not kept after the test
+		for patch in [
+			mock.patch.object(utils, 'load_config', return_value=[self._data_dir]),
+			mock.patch.object(augmentations, 'places_bank', None)
+		]:
+			patch.start()
+			self.addCleanup(patch.stop)
+
+	def testPackedImagesMatchIndex(self):
+		images = np.load(os.path.join(self._out_dir, 'train.npy'), mmap_mode='r')
+		with open(os.path.join(self._out_dir, 'train.json')) as f:
+			index = json.load(f)
+		samples = datasets.ImageFolder(self._src).samples
+		self.assertEqual(images.shape, (len(samples), 3, _IMAGE_SIZE, _IMAGE_SIZE))
+		self.assertEqual(images.dtype, np.uint8)
+		self.assertEqual(index['image_size'], _IMAGE_SIZE)
+		self.assertEqual([tuple(s) for s in index['samples']], [(os.path.relpath(path, self._src), label) for path, label in samples])
+		for i, (path, _) in enumerate(samples):
+			np.testing.assert_array_equal(images[i], pack_places._load_image(path, _IMAGE_SIZE))
+
+	def testMaxImagesSamplesSubset(self):
+		pack_places.main(argparse.Namespace(data_dir=self._data_dir, partition='train', image_size=32, max_images=3, seed=0))
+		images = np.load(os.path.join(self._out_dir, 'train.npy'), mmap_mode='r')
+		with open(os.path.join(self._out_dir, 'train.json')) as f:
+			index = json.load(f)
+		self.assertEqual(images.shape, (3, 3, 32, 32))
+		paths = [os.path.join(self._src, path) for path, _ in index['samples']]
+		self.assertEqual(paths, sorted(paths))
+		for i, path in enumerate(paths):
+			np.testing.assert_array_equal(images[i], pack_places._load_image(path, 32))
+
+	def testBankIsMemoryMapped(self):
+		augmentations._load_places_bank()
+		bank = augmentations.places_bank
+		self.assertIsInstance(bank.images, np.memmap)
+		self.assertEqual(bank.path, os.path.join(self._out_dir, 'train.npy'))
+		self.assertEqual(len(bank.images), 5)
+
+	def testBankSamples(self):
+		augmentations._load_places_bank()
+		imgs = augmentations.places_bank.sample(8, 84, torch.device('cpu'))
+		self.assertEqual(imgs.shape, (8, 3, 84, 84))
+		self.assertEqual(imgs.dtype, torch.float32)
+		self.assertGreaterEqual(imgs.min().item(), 0)
+		self.assertLessEqual(imgs.max().item(), 1)
+		with self.assertRaises(AssertionError):
+			augmentations.places_bank.sample(8, _IMAGE_SIZE + 1, torch.device('cpu'))
+
+	def testRandomOverlayWithPackedBank(self):
+		x = torch.randint(0, 256, (4, 9, 84, 84)).float()
+		out = augmentations.random_overlay(x, dataset='places365_packed')
+		self.assertIsNotNone(augmentations.places_bank)
+		self.assertEqual(out.shape, x.shape)
+		self.assertEqual(out.dtype, x.dtype)
+		self.assertGreaterEqual(out.min().item(), 0)
+		self.assertLessEqual(out.max().item(), 255)
+
+	def testMissingBankRaises(self):
+		with mock.patch.object(utils, 'load_config', return_value=[os.path.join(self._data_dir, 'missing')]):
+			with self.assertRaises(FileNotFoundError):
+				augmentations._load_places_bank()
+
+
+if __name__ == '__main__':
+	absltest.main()
@@ -6,75 +6,112 @@ import cdmc.utils as utils
 import time
 import json
 from cdmc.arguments import parse_args
-from cdmc.env.wrappers import make_env
+import cdmc.env.rendering as rendering
 from cdmc.algorithms.factory import make_agent
 from cdmc.logger import Logger
 from cdmc.video import VideoRecorder
-from pyvirtualdisplay import Display
 import wandb
 
 
-def evaluate(env, agent, video, num_episodes, L, step, test_env=False):
-	episode_rewards = []
-	for i in range(num_episodes):
-		obs = env.reset()
-		video.init(enabled=(i==0))
-		done = False
-		episode_reward = 0
-		while not done:
-			with utils.eval_mode(agent):
-				action = agent.select_action(obs)
-			obs, reward, done, _ = env.step(action)
-			video.record(env)
-			episode_reward += reward
-
-		if L is not None:
-			_test_env = '_test_env' if test_env else ''
-			video.save(f'{step}{_test_env}.mp4')
+def evaluate(envs, agent, video, num_episodes, L, step, test_env=False):
+	from cdmc.evaluation import evaluate_batch
+	_test_env = '_test_env' if test_env else ''
+	episode_rewards, _ = evaluate_batch(envs, agent, num_episodes, video, video_prefix=f'{step}{_test_env}')
+	if L is not None:
+		for episode_reward in episode_rewards:
 			L.log(f'eval/episode_reward{_test_env}', episode_reward, step)
-		episode_rewards.append(episode_reward)
 	
 	return np.mean(episode_rewards)
 
 
+def log_evaluations(L, evaluations):
+	"""Logs finished evaluations at their own steps, leaving train metrics of the current step to be dumped with it"""
+	for step, results in evaluations:
+		for key, values in results.items():
+			for value in values:
+				L.log(key, value, step)
+		L.dump_eval(step)
+
+
+def save_checkpoint(model_dir, agent, step, episode):
+	torch.save(agent, os.path.join(model_dir, f'{step}.pt'))
+	torch.save(utils.get_rng_state(), os.path.join(model_dir, f'{step}_rng.pt'))
+	with open(os.path.join(model_dir, f'{step}.json'), 'w') as f:
+		json.dump({'step': step, 'episode': episode}, f)
+
+
+def load_checkpoint(model_dir, args):
+	"""Latest agent saved in model_dir, with the step and episode counters it was saved at
+
+	The random number generators are restored to their state at the checkpoint, so that a resumed run
+	does not replay the random streams from step 0.
+	"""
+	steps = [int(f[:-len('.pt')]) for f in os.listdir(model_dir) if f.endswith('.pt') and f[:-len('.pt')].isdigit()]
+	assert len(steps) > 0, f'no checkpoint to resume from in {model_dir}'
+	step = max(steps)
+	agent = torch.load(os.path.join(model_dir, f'{step}.pt'), map_location=args.device)
+	agent.device = torch.device(args.device)
+	counters_fp = os.path.join(model_dir, f'{step}.json')
+	if os.path.exists(counters_fp):
+		with open(counters_fp) as f:
+			episode = json.load(f)['episode']
+	else:
+		# checkpoints without counters are from runs with fixed-length episodes
+		episode = step // (args.episode_length // args.action_repeat)
+	rng_fp = os.path.join(model_dir, f'{step}_rng.pt')
+	if os.path.exists(rng_fp):
+		utils.set_rng_state(torch.load(rng_fp))
+	else:
+		# checkpoints without generator states continue from a seed of their own
+		utils.set_seed_everywhere(args.seed + step)
+	return agent, step, episode
+
+
 def main(args):
+	launch_time = time.time()
+
+	# dm_control sets up the rendering backend when it is first imported
+	rendering.select_backend(args.render_backend)
+	from cdmc.env.wrappers import make_env, video_cache
+	from cdmc.evaluation import AsyncEvaluator
+
 	# Set seed
 	utils.set_seed_everywhere(args.seed)
 
 	# Initialize environments
 	gym.logger.set_level(40)
+	video_cache.configure(max_bytes=args.video_cache_mb * 1024**2)
 	print("before making envs")
 	with open(args.train_context_file, 'r') as file:
 		train_contexts = json.load(file)
 	with open(args.test_context_file, 'r') as file:
 		test_contexts = json.load(file)
-	env = make_env(
-		domain_name=args.domain_name,
-		task_name=args.task_name,
-		seed=args.seed,
-		episode_length=args.episode_length,
-		action_repeat=args.action_repeat,
-		image_size=args.image_size,
-		states=train_contexts['states'],
-		video_paths=train_contexts['video_paths'],
-		colors=[dict([(k, np.array(v)) for k,v in color_dict.items()]) for color_dict in train_contexts['colors']],
-	)
-	test_env = make_env(
-		domain_name=args.domain_name,
-		task_name=args.task_name,
-		seed=args.seed+42,
-		episode_length=args.episode_length,
-		action_repeat=args.action_repeat,
-		image_size=args.image_size,
-		states=test_contexts['states'],
-		video_paths=test_contexts['video_paths'],
-		colors=[dict([(k, np.array(v)) for k,v in color_dict.items()]) for color_dict in test_contexts['colors']],
-	)
+	def make_context_env(contexts, seed, **kwargs):
+		return make_env(
+			domain_name=args.domain_name,
+			task_name=args.task_name,
+			seed=seed,
+			episode_length=args.episode_length,
+			action_repeat=args.action_repeat,
+			image_size=args.image_size,
+			states=contexts['states'],
+			video_paths=contexts['video_paths'],
+			colors=[dict([(k, np.array(v)) for k,v in color_dict.items()]) for color_dict in contexts['colors']],
+			render_backend=args.render_backend,
+			**kwargs
+		)
+	# frames are rendered into a ring that keeps obs and next_obs valid until they are added to the replay buffer
+	env = make_context_env(train_contexts, args.seed, frame_ring_size=args.frame_stack+1)
+	# evaluation runs on separate environments, which play the same episodes at every evaluation
+	if args.eval_in_flight == 0:
+		eval_envs = [make_context_env(train_contexts, args.seed) for _ in range(max(1, args.eval_envs))]
+		test_envs = [make_context_env(test_contexts, args.seed+42) for _ in range(max(1, args.eval_envs))]
 	print("after making envs")
 	# Create working directory
 	work_dir = os.path.join(args.log_dir, args.domain_name+'_'+args.task_name, args.algorithm, args.train_context_file[:-5], str(args.seed))
 	print('Working directory:', work_dir)
-	assert not os.path.exists(os.path.join(work_dir, 'train.log')), 'specified working directory already exists'
+	assert args.resume or not os.path.exists(os.path.join(work_dir, 'train.log')), 'specified working directory already exists'
+	assert not args.resume or args.replay_storage == 'disk', 'resuming requires the replay buffer of the run to be stored on disk'
 	utils.make_dir(work_dir)
 	model_dir = utils.make_dir(os.path.join(work_dir, 'model'))
 	video_dir = utils.make_dir(os.path.join(work_dir, 'video'))
@@ -82,13 +119,21 @@ def main(args):
 	utils.write_info(args, os.path.join(work_dir, 'info.log'))
 
 	# Prepare agent
-	assert torch.cuda.is_available(), 'must have cuda enabled'
+	assert torch.device(args.device).type != 'cuda' or torch.cuda.is_available(), 'must have cuda enabled'
+	replay_capacity = args.replay_capacity
+	if args.replay_memory_gb is not None:
+		replay_capacity = min(replay_capacity, utils.ReplayBuffer.capacity_from_budget(
+			env.observation_space.shape, env.action_space.shape, args.replay_memory_gb * 1024**3
+		))
 	replay_buffer = utils.ReplayBuffer(
 		obs_shape=env.observation_space.shape,
 		action_shape=env.action_space.shape,
-		capacity=args.train_steps,
-		batch_size=args.batch_size
+		capacity=replay_capacity,
+		batch_size=args.batch_size,
+		storage_dir=utils.make_dir(os.path.join(work_dir, 'replay')) if args.replay_storage == 'disk' else None,
+		device=args.device
 	)
+	print('Replay capacity:', replay_capacity)
 	cropped_obs_shape = (3*args.frame_stack, args.image_crop_size, args.image_crop_size)
 	print('Observations:', env.observation_space.shape)
 	print('Cropped observations:', cropped_obs_shape)
@@ -97,29 +142,55 @@ def main(args):
 		action_shape=env.action_space.shape,
 		args=args
 	)
-
-	start_step, episode, episode_reward, done = 0, 0, 0, True
+	start_step, episode = 0, 0
+	if args.resume:
+		# the replay buffer reopens the transitions stored in work_dir/replay
+		agent, start_step, episode = load_checkpoint(model_dir, args)
+		print(f'Resuming from step {start_step}')
+	if args.prefetch_batches > 0:
+		# a resumed run draws the seed of the sampler from the restored generators
+		replay_buffer = utils.PrefetchSampler(replay_buffer, num_batches=args.prefetch_batches, seed=None if args.resume else args.seed)
+	evaluator = None
+	if args.eval_in_flight > 0:
+		evaluator = AsyncEvaluator(
+			args, cropped_obs_shape, env.action_space.shape,
+			video_dir=video_dir if args.save_video else None,
+			max_in_flight=args.eval_in_flight
+		)
+	print(f'Startup time: {time.time() - launch_time:.1f} s, peak RSS: {utils.peak_rss_mb():.0f} MB')
+
+	episode_reward, done = 0, True
 	L = Logger(work_dir)
 	start_time = time.time()
 	for step in range(start_step, args.train_steps+1):
 		if done:
 			if step > start_step:
 				L.log('train/duration', time.time() - start_time, step)
+				for k, v in video_cache.stats().items():
+					L.log(f'train/video_cache_{k}', v, step)
+				if isinstance(replay_buffer, utils.PrefetchSampler):
+					for k, v in replay_buffer.stats().items():
+						L.log(f'train/prefetch_{k}', v, step)
 				start_time = time.time()
 				L.dump(step)
+				if evaluator is not None:
+					log_evaluations(L, evaluator.poll())
 
-			# Evaluate agent periodically
-			if step % args.eval_freq == 0:
+			# Evaluate agent periodically, a resumed run was evaluated at its first step before saving
+			if step % args.eval_freq == 0 and not (args.resume and step == start_step):
 				print('Evaluating:', work_dir)
-				L.log('eval/episode', episode, step)
-				evaluate(env, agent, video, args.eval_episodes, L, step)
-				if test_env is not None:
-					evaluate(test_env, agent, video, args.eval_episodes, L, step, test_env=True)
-				L.dump(step)
+				if evaluator is not None:
+					log_evaluations(L, evaluator.submit(step, episode, agent))
+				else:
+					L.log('eval/episode', episode, step)
+					evaluate(eval_envs, agent, video, args.eval_episodes, L, step)
+					evaluate(test_envs, agent, video, args.eval_episodes, L, step, test_env=True)
+					L.dump(step)
 
 			# Save agent periodically
 			if step > start_step and step % args.save_freq == 0:
-				torch.save(agent, os.path.join(model_dir, f'{step}.pt'))
+				save_checkpoint(model_dir, agent, step, episode)
+				replay_buffer.flush()
 
 			L.log('train/episode_reward', episode_reward, step)
 
@@ -154,6 +225,10 @@ def main(args):
 
 		episode_step += 1
 
+	if evaluator is not None:
+		log_evaluations(L, evaluator.close())
+	if isinstance(replay_buffer, utils.PrefetchSampler):
+		replay_buffer.close()
 	print('Completed training for', work_dir)
 
 
@@ -172,5 +247,5 @@ if __name__ == '__main__':
 		train_context_name_short = os.path.split(args.train_context_file)[-1]
 		args_dict['train_context_name_short'] = '_'.join(train_context_name_short.split('_')[:-1])
 	with wandb.init(project=wandb_project, entity=lines[1], config=args_dict, tags=[args.algorithm, args.domain_name, args.task_name]):
-		with Display() as disp:
+		with rendering.display(rendering.select_backend(args.render_backend)) as disp:
 			main(args)
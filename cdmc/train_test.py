@@ -0,0 +1,129 @@
+"""Smoke tests of the training loop."""
+
+import os
+import json
+import random
+import tempfile
+from absl.testing import absltest
+from absl.testing import parameterized
+import numpy as np
+import torch
+import wandb
+import cdmc.utils as utils
+from cdmc.arguments import parse_args
+from cdmc.logger import Logger
+from cdmc import train
+
+# train.py names working directories after the context file path, relative to the repository root
+_REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _small_args(log_dir, *argv):
+	"""Arguments of a short training run on the default task with a small agent"""
+	return parse_args([
+		'--algorithm', 'sac', '--seed', '0',
+		'--train_context_file', 'empty.json', '--test_context_file', 'empty.json',
+		'--log_dir', log_dir, '--device', 'cpu',
+		'--episode_length', '40', '--action_repeat', '4',
+		'--train_steps', '40', '--init_steps', '10',
+		'--eval_freq', '20', '--eval_episodes', '2', '--eval_envs', '2', '--save_freq', '20',
+		'--batch_size', '8', '--hidden_dim', '32', '--num_shared_layers', '2',
+		'--num_filters', '8', '--projection_dim', '16', '--prefetch_batches', '0',
+		*argv
+	])
+
+
+def _read_log(path):
+	with open(path) as f:
+		return [json.loads(line) for line in f]
+
+
+class TrainTest(parameterized.TestCase):
+
+	def setUp(self):
+		super().setUp()
+		self._cwd = os.getcwd()
+		os.chdir(_REPO_DIR)
+		wandb.init(mode='disabled')
+
+	def tearDown(self):
+		wandb.finish()
+		os.chdir(self._cwd)
+		super().tearDown()
+
+	def _make_tempdir(self):
+		tempdir = tempfile.TemporaryDirectory()
+		self.addCleanup(tempdir.cleanup)
+		return tempdir.name
+
+	@parameterized.named_parameters(('synchronous', 0), ('asynchronous', 1))
+	def testEvaluatesAtEvalFreq(self, eval_in_flight):
+		args = _small_args(self._make_tempdir(), '--eval_in_flight', str(eval_in_flight))
+		train.main(args)
+
+		work_dir = os.path.join(args.log_dir, 'walker_walk', 'sac', 'empty', '0')
+		evals = _read_log(os.path.join(work_dir, 'eval.log'))
+		self.assertEqual(sorted(e['step'] for e in evals), [0, 20, 40])
+		for e in evals:
+			self.assertIn('episode_reward', e)
+			self.assertIn('episode_reward_test_env', e)
+		train_steps = [t['step'] for t in _read_log(os.path.join(work_dir, 'train.log'))]
+		self.assertNotEmpty(train_steps)
+		# train metrics are never logged at the older step of an evaluation
+		self.assertEqual(train_steps, sorted(train_steps))
+
+	def testResumesFromLatestCheckpoint(self):
+		log_dir = self._make_tempdir()
+		train.main(_small_args(log_dir, '--replay_storage', 'disk'))
+		work_dir = os.path.join(log_dir, 'walker_walk', 'sac', 'empty', '0')
+		self.assertTrue(os.path.exists(os.path.join(work_dir, 'model', '40.pt')))
+
+		train.main(_small_args(log_dir, '--replay_storage', 'disk', '--resume', '--train_steps', '60'))
+		evals = _read_log(os.path.join(work_dir, 'eval.log'))
+		self.assertEqual(sorted(e['step'] for e in evals), [0, 20, 40, 60])
+		with open(os.path.join(work_dir, 'model', '60.json')) as f:
+			self.assertEqual(json.load(f), {'step': 60, 'episode': 6})
+
+	def testCheckpointRestoresRandomState(self):
+		model_dir = self._make_tempdir()
+		args = _small_args(self._make_tempdir())
+		utils.set_seed_everywhere(0)
+		train.save_checkpoint(model_dir, torch.nn.Linear(2, 2), 20, 2)
+		expected = (torch.rand(3), np.random.rand(3), random.random())
+
+		utils.set_seed_everywhere(1)
+		_, step, episode = train.load_checkpoint(model_dir, args)
+		self.assertEqual((step, episode), (20, 2))
+		torch.testing.assert_close(torch.rand(3), expected[0], rtol=0, atol=0)
+		np.testing.assert_array_equal(np.random.rand(3), expected[1])
+		self.assertEqual(random.random(), expected[2])
+
+	def testResumeRequiresDiskReplayStorage(self):
+		with self.assertRaises(AssertionError):
+			train.main(_small_args(self._make_tempdir(), '--resume'))
+
+
+class LogEvaluationsTest(absltest.TestCase):
+
+	def setUp(self):
+		super().setUp()
+		wandb.init(mode='disabled')
+
+	def tearDown(self):
+		wandb.finish()
+		super().tearDown()
+
+	def testTrainMetricsAreNotDumpedWithEvaluations(self):
+		with tempfile.TemporaryDirectory() as log_dir:
+			L = Logger(log_dir)
+			L.log('train/episode_reward', 1., 30)
+			train.log_evaluations(L, [(20, {'eval/episode_reward': [2., 4.]})])
+			self.assertEqual(_read_log(os.path.join(log_dir, 'eval.log')), [{'episode_reward': 3., 'step': 20}])
+			self.assertFalse(os.path.exists(os.path.join(log_dir, 'train.log')))
+
+			L.dump(30)
+			self.assertEqual(_read_log(os.path.join(log_dir, 'train.log')), [{'episode_reward': 1., 'step': 30}])
+
+
+if __name__ == '__main__':
+	absltest.main()
@@ -6,6 +6,10 @@ import json
 import random
 import cdmc.augmentations as augmentations
 import subprocess
+import resource
+import threading
+import queue
+import time
 from datetime import datetime
 
 
@@ -25,11 +29,39 @@ class eval_mode(object):
         return False
 
 
+def _foreach_ema_(targets, sources, tau):
+    """targets <- tau * sources + (1 - tau) * targets, fused over all tensors and in place"""
+    if hasattr(torch, '_foreach_lerp_'):
+        torch._foreach_lerp_(targets, sources, tau)
+    else:
+        torch._foreach_mul_(targets, 1 - tau)
+        torch._foreach_add_(targets, sources, alpha=tau)
+
+
 def soft_update_params(net, target_net, tau):
-    for param, target_param in zip(net.parameters(), target_net.parameters()):
-        target_param.data.copy_(
-            tau * param.data + (1 - tau) * target_param.data
-        )
+    with torch.no_grad():
+        _foreach_ema_(list(target_net.parameters()), list(net.parameters()), tau)
+
+
+class SoftUpdate(object):
+    """Fused soft update of several (net, target_net, tau) pairs
+
+    Parameter lists are collected once and grouped by tau, so each call is one multi-tensor update
+    per distinct tau without Python loops over parameters or temporary tensors.
+    """
+
+    def __init__(self, *pairs):
+        groups = {}
+        for net, target_net, tau in pairs:
+            targets, sources = groups.setdefault(tau, ([], []))
+            targets.extend(target_net.parameters())
+            sources.extend(net.parameters())
+        self._groups = [(tau, targets, sources) for tau, (targets, sources) in groups.items()]
+
+    def __call__(self):
+        with torch.no_grad():
+            for tau, targets, sources in self._groups:
+                _foreach_ema_(targets, sources, tau)
 
 
 def cat(x, y, axis=0):
@@ -44,6 +76,23 @@ def set_seed_everywhere(seed):
     random.seed(seed)
 
 
+def get_rng_state():
+    return {
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+        'numpy': np.random.get_state(),
+        'random': random.getstate()
+    }
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+
+
 def write_info(args, fp):
     data = {
         'timestamp': str(datetime.now()),
@@ -79,25 +128,395 @@ def listdir(dir_path, filetype='jpg', sort=True):
     return fpaths
 
 
-def prefill_memory(obses, capacity, obs_shape):
-    """Reserves memory for replay buffer"""
-    c, h, w = obs_shape
-    for _ in range(capacity):
-        frame = np.ones((3, h, w), dtype=np.uint8)
-        obses.append(frame)
-    return obses
+def prefill_memory(frames):
+    """Reserves memory for replay buffer by touching all pages of the frame storage"""
+    frames.fill(1)
+    return frames
+
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
 
 
 class ReplayBuffer(object):
-    """Buffer to store environment transitions"""
+    """Buffer to store environment transitions
+
+    Every frame is stored once in a uint8 ring of frame slots. Slot g holds the newest frame of
+    next_obs for a transition; obs and next_obs are the k+1 frames ending at g, with frames from
+    before the start of the episode replaced by its first frame. Indices are global frame counts.
+
+    Storage is allocated with np.empty and only becomes resident as frames are written, unless
+    prefill is set, which commits all memory up front. If storage_dir is set, all arrays are
+    memory-mapped .npy files in that directory instead, and a buffer created on the files of a
+    previous run with the same shapes continues from the transitions stored there.
+    """
+
+    def __init__(self, obs_shape, action_shape, capacity, batch_size, prefill=False, storage_dir=None, device='cuda'):
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.device = torch.device(device)
+        self.frame_stack = obs_shape[0] // 3
+        self.frame_shape = (3, *obs_shape[1:])
+        self.storage_dir = storage_dir
+
+        self._frames, reopened = self._make_array('frames', (capacity, *self.frame_shape), np.uint8)
+        if prefill and not reopened:
+            self._frames = prefill_memory(self._frames)
+        self._episode_starts, reopened = self._make_array('episode_starts', (capacity,), np.int64, reopened)
+        self._is_transition, reopened = self._make_array('is_transition', (capacity,), bool, reopened)
+        self.actions, reopened = self._make_array('actions', (capacity, *action_shape), np.float32, reopened)
+        self.rewards, reopened = self._make_array('rewards', (capacity, 1), np.float32, reopened)
+        self.not_dones, reopened = self._make_array('not_dones', (capacity, 1), np.float32, reopened)
+        self._counters, reopened = self._make_array('counters', (2,), np.int64, reopened)
+        if not reopened:
+            self._is_transition[:] = False
+            self._counters[:] = 0
+
+        self._t, self._episode_start = (int(c) for c in self._counters)
+        self._last_next_obs = None
+        self.idx = self._t % self.capacity
+        self.full = self._t >= self.capacity
+
+    def _make_array(self, name, shape, dtype, reopen=True):
+        """Allocates an array in memory, or as a memory-mapped .npy file in storage_dir if specified
+
+        Existing files with the same shape and dtype are reopened if reopen is set, which lets
+        a buffer be restored from the files of a previous run. Returns the array and whether it
+        was reopened.
+        """
+        if self.storage_dir is None:
+            return np.empty(shape, dtype=dtype), False
+        path = os.path.join(self.storage_dir, f'{name}.npy')
+        if reopen and os.path.exists(path):
+            array = np.lib.format.open_memmap(path, mode='r+')
+            if array.shape == shape and array.dtype == dtype:
+                return array, True
+            del array
+        return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape), False
+
+    def flush(self):
+        """Writes memory-mapped storage to disk"""
+        for array in [self._frames, self._episode_starts, self._is_transition, self.actions, self.rewards, self.not_dones, self._counters]:
+            if isinstance(array, np.memmap):
+                array.flush()
+
+    @staticmethod
+    def bytes_per_slot(obs_shape, action_shape):
+        """Memory used per frame slot"""
+        frame_bytes = 3 * int(np.prod(obs_shape[1:]))
+        action_bytes = 4 * int(np.prod(action_shape))
+        return frame_bytes + action_bytes + 4 + 4 + 8 + 1
+
+    @classmethod
+    def capacity_from_budget(cls, obs_shape, action_shape, max_bytes):
+        """Largest capacity whose storage fits in max_bytes"""
+        return int(max_bytes // cls.bytes_per_slot(obs_shape, action_shape))
+
+    def _split_frames(self, obs):
+        if isinstance(obs, LazyFrames) and obs.frames is not None:
+            return obs.frames
+        return np.asarray(obs).reshape(self.frame_stack, *self.frame_shape)
+
+    def _add_frame(self, frame, is_transition):
+        np.copyto(self._frames[self.idx], frame)
+        self._episode_starts[self.idx] = self._episode_start
+        self._is_transition[self.idx] = is_transition
+        self._t += 1
+        self.idx = self._t % self.capacity
+        self.full = self.full or self._t >= self.capacity
+        self._counters[0] = self._t
+        self._counters[1] = self._episode_start
+
+    def add(self, obs, action, reward, next_obs, done):
+        if obs is not self._last_next_obs:
+            # new episode: store the frames of obs, repeats of its first frame are implied
+            frames = self._split_frames(obs)
+            first = 0
+            while first+1 < len(frames) and (frames[first+1] is frames[0] or np.array_equal(frames[first+1], frames[0])):
+                first += 1
+            self._episode_start = self._t
+            for frame in frames[first:]:
+                self._add_frame(frame, is_transition=False)
+
+        np.copyto(self.actions[self.idx], action)
+        np.copyto(self.rewards[self.idx], reward)
+        np.copyto(self.not_dones[self.idx], not done)
+        self._add_frame(self._split_frames(next_obs)[-1], is_transition=True)
+        self._last_next_obs = next_obs
+
+    def _get_idxs(self, n=None, rng=np.random):
+        """Global indices of n transitions drawn uniformly with rng, the global np.random by default"""
+        if n is None:
+            n = self.batch_size
+        # oldest transition whose frame stack has not been overwritten
+        low = max(0, self._t - self.capacity + self.frame_stack)
+        idxs = rng.randint(low, self._t, size=n)
+        invalid = ~self._is_transition[idxs % self.capacity]
+        if invalid.any():
+            # slots outside [low, t) may hold stale transitions, e.g. of a reopened buffer
+            assert self._is_transition[np.arange(low, self._t) % self.capacity].any(), 'replay buffer does not contain any transitions'
+        while invalid.any():
+            idxs[invalid] = rng.randint(low, self._t, size=invalid.sum())
+            invalid = ~self._is_transition[idxs % self.capacity]
+        return idxs
+
+    def _stack_idxs(self, idxs, num_frames):
+        """Frame slots of the last num_frames frames up to and including global indices idxs"""
+        stack = idxs[:, None] + np.arange(1-num_frames, 1)
+        stack = np.maximum(stack, self._episode_starts[idxs % self.capacity][:, None])
+        return stack % self.capacity
+
+    def _encode_obses(self, idxs, out=None):
+        """Stacked obs and next_obs of transitions idxs, gathered into the uint8 arrays of out if specified"""
+        n, k = len(idxs), self.frame_stack
+        stack = self._stack_idxs(idxs, k+1)
+        if out is None:
+            frames = self._frames[stack]
+            return frames[:, :k].reshape(n, -1, *self.frame_shape[1:]), frames[:, 1:].reshape(n, -1, *self.frame_shape[1:])
+        obs, next_obs = out
+        np.take(self._frames, stack[:, :k], axis=0, out=obs.reshape(n, k, *self.frame_shape))
+        np.take(self._frames, stack[:, 1:], axis=0, out=next_obs.reshape(n, k, *self.frame_shape))
+        return obs, next_obs
+
+    def _encode_soda(self, idxs, out=None):
+        """Stacked obs of transitions idxs, gathered into the uint8 array out if specified"""
+        n, k = len(idxs), self.frame_stack
+        stack = self._stack_idxs(idxs, k+1)[:, :-1]
+        if out is None:
+            return self._frames[stack].reshape(n, -1, *self.frame_shape[1:])
+        np.take(self._frames, stack, axis=0, out=out.reshape(n, k, *self.frame_shape))
+        return out
+
+    def _sample_frames(self, n=None):
+        """Samples transitions, with obs and next_obs stacked as one (2n, C, H, W) uint8 tensor on the device"""
+        idxs = self._get_idxs(n)
+        slots = idxs % self.capacity
+        obses = np.empty((2, len(idxs), 3*self.frame_stack, *self.frame_shape[1:]), dtype=np.uint8)
+        self._encode_obses(idxs, out=(obses[0], obses[1]))
+        obses = torch.as_tensor(obses.reshape(-1, *obses.shape[2:])).to(self.device)
+        actions = torch.as_tensor(self.actions[slots]).to(self.device)
+        rewards = torch.as_tensor(self.rewards[slots]).to(self.device)
+        not_dones = torch.as_tensor(self.not_dones[slots]).to(self.device)
+
+        return obses, actions, rewards, not_dones
+
+    def _sample_soda_frames(self, n=None):
+        idxs = self._get_idxs(n)
+        return torch.as_tensor(self._encode_soda(idxs)).to(self.device)
+
+    def sample_soda(self, n=None, pipeline=None):
+        obs = self._sample_soda_frames(n)
+        if pipeline is None:
+            return obs.float()
+        return pipeline(obs)
+
+    def __sample__(self, n=None):
+        obses, actions, rewards, not_dones = self._sample_frames(n)
+        obs, next_obs = obses.float().chunk(2)
+
+        return obs, actions, rewards, next_obs, not_dones
+
+    def sample_pipeline(self, pipeline, n=None):
+        """Samples transitions with obs and next_obs augmented by pipeline, followed by positives if it makes them
+
+        With multiple views, obs and next_obs hold all views of the batch, stacked view-major.
+        """
+        obses, actions, rewards, not_dones = self._sample_frames(n)
+        out = pipeline(obses, num_obs=len(actions))
+        obses, pos = out if pipeline.positives else (out, None)
+        obs, next_obs = obses.split([pipeline.obs_views*len(actions), pipeline.next_obs_views*len(actions)])
+
+        if pos is not None:
+            return obs, actions, rewards, next_obs, not_dones, pos
+        return obs, actions, rewards, next_obs, not_dones
+
+    def sample_curl(self, n=None):
+        return self.sample_pipeline(augmentations.Pipeline(crop=84, positives=True), n=n)
+
+    def sample_drq(self, n=None, pad=4):
+        return self.sample_pipeline(augmentations.Pipeline(shift=pad), n=n)
+
+    def sample_svea(self, n=None, pad=4):
+        return self.sample_drq(n=n, pad=pad)
+
+    def sample(self, n=None):
+        return self.sample_pipeline(augmentations.Pipeline(crop=84), n=n)
+
+
+class _PrefetchQueue(object):
+    """Ring of pinned staging batches filled by a worker thread"""
+
+    def __init__(self, make_batch, gather, num_batches, device):
+        self._gather = gather
+        self._device = device
+        self._free = queue.Queue()
+        self._ready = queue.Queue()
+        for _ in range(num_batches):
+            self._free.put((make_batch(), None))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                # wakes up periodically to check whether the queue was closed
+                batch, copied = self._free.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if copied is not None:
+                # staging memory is reused only once its previous copy to the GPU has completed
+                copied.synchronize()
+            try:
+                self._gather(batch)
+            except Exception as e:
+                self._ready.put(e)
+                return
+            self._ready.put(batch)
+
+    def get(self):
+        """Returns the next batch on the device, the number of batches that were ready and the seconds spent waiting"""
+        depth = self._ready.qsize()
+        start = time.time()
+        batch = self._ready.get()
+        stall = time.time() - start
+        if isinstance(batch, Exception):
+            raise batch
+        if self._device.type == 'cuda':
+            out = tuple(x.to(self._device, non_blocking=True) for x in batch)
+            copied = torch.cuda.Event()
+            copied.record()
+        else:
+            out, copied = tuple(x.clone() for x in batch), None
+        self._free.put((batch, copied))
+        return out, depth, stall
+
+    def close(self):
+        """Stops the worker thread, waiting for the batch it is gathering"""
+        self._stop.set()
+        self._thread.join()
+
+
+class PrefetchSampler(object):
+    """Samples batches from a ReplayBuffer ahead of time, overlapping sampling with agent updates
+
+    For every batch size requested, a worker thread gathers up to num_batches batches into reused
+    uint8 staging tensors, which are pinned and copied to the GPU without blocking when sampling
+    on CUDA. Augmentations are applied on the device as in ReplayBuffer, whose sample methods
+    are shared on top of _sample_frames.
+    Transitions must be added through the sampler so that writes are serialized with sampling.
+    Call close() once done sampling to stop the worker threads.
+
+    Each worker draws transitions with its own RandomState rather than the global np.random,
+    seeded with seed plus the number of queues created before it. If seed is None, it is drawn
+    from np.random, so sampling is reproducible under set_seed_everywhere. With a fixed buffer,
+    the batches of the first queue are those sample() returns after np.random.seed(seed).
+    """
+
+    def __init__(self, replay_buffer, num_batches=2, seed=None):
+        self.replay_buffer = replay_buffer
+        self.batch_size = replay_buffer.batch_size
+        self.num_batches = num_batches
+        self.seed = np.random.randint(2**31) if seed is None else seed
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._requests = 0
+        self._depth = 0
+        self._stall = 0.
+
+    def __getattr__(self, name):
+        return getattr(self.replay_buffer, name)
 
-    def __init__(self, obs_shape, action_shape, capacity, batch_size, prefill=True):
+    def add(self, obs, action, reward, next_obs, done):
+        with self._lock:
+            self.replay_buffer.add(obs, action, reward, next_obs, done)
+
+    def _staging(self, shape, dtype):
+        x = torch.empty(shape, dtype=dtype)
+        return x.pin_memory() if self.replay_buffer.device.type == 'cuda' else x
+
+    def _make_queue(self, kind, n):
+        rb = self.replay_buffer
+        rng = np.random.RandomState(self.seed + len(self._queues))
+        obs_shape = (n, 3*rb.frame_stack, *rb.frame_shape[1:])
+        if kind == 'soda':
+            def make_batch():
+                return (self._staging(obs_shape, torch.uint8),)
+
+            def gather(batch):
+                with self._lock:
+                    rb._encode_soda(rb._get_idxs(n, rng), out=batch[0].numpy())
+        else:
+            # obs and next_obs share one staging tensor, as returned by ReplayBuffer._sample_frames
+            def make_batch():
+                return (
+                    self._staging((2*n, *obs_shape[1:]), torch.uint8),
+                    self._staging((n, *rb.actions.shape[1:]), torch.float32),
+                    self._staging((n, 1), torch.float32),
+                    self._staging((n, 1), torch.float32)
+                )
+
+            def gather(batch):
+                obses, actions, rewards, not_dones = [x.numpy() for x in batch]
+                with self._lock:
+                    idxs = rb._get_idxs(n, rng)
+                    slots = idxs % rb.capacity
+                    rb._encode_obses(idxs, out=(obses[:n], obses[n:]))
+                    np.take(rb.actions, slots, axis=0, out=actions)
+                    np.take(rb.rewards, slots, axis=0, out=rewards)
+                    np.take(rb.not_dones, slots, axis=0, out=not_dones)
+        return _PrefetchQueue(make_batch, gather, self.num_batches, rb.device)
+
+    def _next(self, kind, n=None):
+        key = (kind, n or self.batch_size)
+        if key not in self._queues:
+            self._queues[key] = self._make_queue(*key)
+        batch, depth, stall = self._queues[key].get()
+        self._requests += 1
+        self._depth += depth
+        self._stall += stall
+        return batch
+
+    def close(self):
+        """Stops the worker threads of all queues"""
+        for q in self._queues.values():
+            q.close()
+        self._queues = {}
+
+    def stats(self):
+        """Mean number of ready batches and total seconds spent waiting for a batch since the last call"""
+        stats = {
+            'queue_depth': self._depth / max(1, self._requests),
+            'stall_time': self._stall
+        }
+        self._requests, self._depth, self._stall = 0, 0, 0.
+        return stats
+
+    def _sample_frames(self, n=None):
+        return self._next('transitions', n)
+
+    def _sample_soda_frames(self, n=None):
+        obs, = self._next('soda', n)
+        return obs
+
+    sample_soda = ReplayBuffer.sample_soda
+    __sample__ = ReplayBuffer.__sample__
+    sample_pipeline = ReplayBuffer.sample_pipeline
+    sample_curl = ReplayBuffer.sample_curl
+    sample_drq = ReplayBuffer.sample_drq
+    sample_svea = ReplayBuffer.sample_svea
+    sample = ReplayBuffer.sample
+
+
+class LazyFrameReplayBuffer(object):
+    """Buffer storing an (obs, next_obs) tuple of LazyFrames per transition, used as a baseline in benchmarks"""
+
+    def __init__(self, obs_shape, action_shape, capacity, batch_size):
         self.capacity = capacity
         self.batch_size = batch_size
 
         self._obses = []
-        if prefill:
-            self._obses = prefill_memory(self._obses, capacity, obs_shape)
         self.actions = np.empty((capacity, *action_shape), dtype=np.float32)
         self.rewards = np.empty((capacity, 1), dtype=np.float32)
         self.not_dones = np.empty((capacity, 1), dtype=np.float32)
@@ -133,48 +552,6 @@ class ReplayBuffer(object):
             next_obses.append(np.array(next_obs, copy=False))
         return np.array(obses), np.array(next_obses)
 
-    def sample_soda(self, n=None):
-        idxs = self._get_idxs(n)
-        obs, _ = self._encode_obses(idxs)
-        return torch.as_tensor(obs).cuda().float()
-
-    def __sample__(self, n=None):
-        idxs = self._get_idxs(n)
-
-        obs, next_obs = self._encode_obses(idxs)
-        obs = torch.as_tensor(obs).cuda().float()
-        next_obs = torch.as_tensor(next_obs).cuda().float()
-        actions = torch.as_tensor(self.actions[idxs]).cuda()
-        rewards = torch.as_tensor(self.rewards[idxs]).cuda()
-        not_dones = torch.as_tensor(self.not_dones[idxs]).cuda()
-
-        return obs, actions, rewards, next_obs, not_dones
-
-    def sample_curl(self, n=None):
-        obs, actions, rewards, next_obs, not_dones = self.__sample__(n=n)
-        pos = augmentations.random_crop(obs.clone())
-        obs = augmentations.random_crop(obs)
-        next_obs = augmentations.random_crop(next_obs)
-
-        return obs, actions, rewards, next_obs, not_dones, pos
-
-    def sample_drq(self, n=None, pad=4):
-        obs, actions, rewards, next_obs, not_dones = self.__sample__(n=n)
-        obs = augmentations.random_shift(obs, pad)
-        next_obs = augmentations.random_shift(next_obs, pad)
-
-        return obs, actions, rewards, next_obs, not_dones
-
-    def sample_svea(self, n=None, pad=4):
-        return self.sample_drq(n=n, pad=pad)
-
-    def sample(self, n=None):
-        obs, actions, rewards, next_obs, not_dones = self.__sample__(n=n)
-        obs = augmentations.random_crop(obs)
-        next_obs = augmentations.random_crop(next_obs)
-
-        return obs, actions, rewards, next_obs, not_dones
-
 
 class LazyFrames(object):
     def __init__(self, frames, extremely_lazy=True):
@@ -0,0 +1,244 @@
+"""Tests of the replay buffers and soft updates."""
+
+from collections import deque
+from copy import deepcopy
+import tempfile
+from absl.testing import absltest
+from absl.testing import parameterized
+import numpy as np
+import torch
+import torch.nn as nn
+import cdmc.utils as utils
+import cdmc.augmentations as augmentations
+
+_OBS_SHAPE = (9, 100, 100)
+_ACTION_SHAPE = (6,)
+
+
+def _fill(buffer, num_transitions, episode_length=25, seed=0):
+	"""Adds transitions of random episodes, stacking frames like the FrameStack wrapper"""
+	rng = np.random.RandomState(seed)
+	frame_stack = _OBS_SHAPE[0] // 3
+	frames = deque([], maxlen=frame_stack)
+	for t in range(num_transitions):
+		if t % episode_length == 0:
+			frame = rng.randint(0, 256, size=(3, *_OBS_SHAPE[1:]), dtype=np.uint8)
+			for _ in range(frame_stack):
+				frames.append(frame)
+			obs = utils.LazyFrames(list(frames))
+		frames.append(rng.randint(0, 256, size=(3, *_OBS_SHAPE[1:]), dtype=np.uint8))
+		next_obs = utils.LazyFrames(list(frames))
+		buffer.add(obs, rng.uniform(-1, 1, size=_ACTION_SHAPE), rng.rand(), next_obs, (t+1) % episode_length == 0)
+		obs = next_obs
+
+
+def _sample(buffer, seed):
+	np.random.seed(seed)
+	torch.manual_seed(seed)
+	return buffer.sample()
+
+
+class ReplayBufferTest(absltest.TestCase):
+
+	def _make_tempdir(self):
+		tempdir = tempfile.TemporaryDirectory()
+		self.addCleanup(tempdir.cleanup)
+		return tempdir.name
+
+	def _make_buffer(self, capacity=200, **kwargs):
+		return utils.ReplayBuffer(_OBS_SHAPE, _ACTION_SHAPE, capacity, batch_size=16, device='cpu', **kwargs)
+
+	def testReopenedBufferSamplesSameBatches(self):
+		storage_dir = self._make_tempdir()
+		buffer = self._make_buffer(storage_dir=storage_dir)
+		_fill(buffer, 120)
+		buffer.flush()
+		expected = _sample(buffer, 0)
+		del buffer
+
+		reopened = self._make_buffer(storage_dir=storage_dir)
+		self.assertEqual(reopened._t, 120 + 120 // 25 + 1)
+		for x, y in zip(expected, _sample(reopened, 0)):
+			np.testing.assert_array_equal(x.numpy(), y.numpy())
+
+	def testBufferWithDifferentShapesIsNotReopened(self):
+		storage_dir = self._make_tempdir()
+		buffer = self._make_buffer(storage_dir=storage_dir)
+		_fill(buffer, 30)
+		buffer.flush()
+		del buffer
+		self.assertEqual(self._make_buffer(capacity=100, storage_dir=storage_dir)._t, 0)
+
+	def testSamplePipelineMatchesCroppedSample(self):
+		buffer = self._make_buffer()
+		_fill(buffer, 120)
+		np.random.seed(0)
+		torch.manual_seed(0)
+		batch = buffer.sample_pipeline(augmentations.Pipeline(crop=84))
+
+		# the sample method before pipelines, random_crop of obs and next_obs with the offsets of the pipeline
+		np.random.seed(0)
+		expected = list(buffer.__sample__())
+		torch.manual_seed(0)
+		rows = torch.randint(0, 16, (32, 1))[:, 0]
+		cols = torch.randint(0, 16, (32, 1))[:, 0]
+		expected[0] = augmentations.random_crop(expected[0], 84, w1=rows[:16], h1=cols[:16])
+		expected[3] = augmentations.random_crop(expected[3], 84, w1=rows[16:], h1=cols[16:])
+		for x, y in zip(batch, expected):
+			np.testing.assert_array_equal(x.numpy(), y.numpy())
+
+	def testSamplingWithoutTransitionsInWindowRaises(self):
+		buffer = self._make_buffer(capacity=10)
+		# a stale transition outside the window [0, t) of the frames written so far
+		buffer._is_transition[:] = False
+		buffer._is_transition[5] = True
+		for _ in range(3):
+			buffer._add_frame(np.zeros((3, *_OBS_SHAPE[1:]), dtype=np.uint8), is_transition=False)
+		with self.assertRaises(AssertionError):
+			buffer._get_idxs()
+
+
+def _fill_both(buffer, baseline, episode_lengths, as_arrays=False, seed=0):
+	"""Adds the same random episodes to buffer and baseline, returns the global indices of the transitions in buffer
+
+	If as_arrays is set, obs and next_obs are added as new arrays rather than the LazyFrames of FrameStack.
+	"""
+	rng = np.random.RandomState(seed)
+	frame_stack, frame_shape = buffer.frame_stack, buffer.frame_shape
+	idxs = []
+	for length in episode_lengths:
+		frames = deque([rng.randint(0, 256, size=frame_shape, dtype=np.uint8)]*frame_stack, maxlen=frame_stack)
+		obs = utils.LazyFrames(list(frames))
+		for i in range(length):
+			frames.append(rng.randint(0, 256, size=frame_shape, dtype=np.uint8))
+			next_obs = utils.LazyFrames(list(frames))
+			action, reward, done = rng.uniform(-1, 1, size=_ACTION_SHAPE), rng.rand(), i == length-1
+			for b in [buffer, baseline]:
+				if as_arrays:
+					b.add(np.array(obs), action, reward, np.array(next_obs), done)
+				else:
+					b.add(obs, action, reward, next_obs, done)
+			idxs.append(buffer._t - 1)
+			obs = next_obs
+	return np.array(idxs)
+
+
+class ReplayBufferEquivalenceTest(parameterized.TestCase):
+	"""The frame ring of ReplayBuffer against the LazyFrameReplayBuffer it replaces"""
+
+	@parameterized.named_parameters(('lazy_frames', False), ('arrays', True))
+	def testStacksMatchLazyFrameBuffer(self, as_arrays):
+		obs_shape, capacity = (9, 8, 8), 40
+		# episodes of one step, shorter and longer than the frame stack, each ending with done
+		episode_lengths = [1, 2, 5, 13, 3, 8, 1, 20, 4] * 3
+		buffer = utils.ReplayBuffer(obs_shape, _ACTION_SHAPE, capacity, batch_size=16, device='cpu')
+		baseline = utils.LazyFrameReplayBuffer(obs_shape, _ACTION_SHAPE, sum(episode_lengths), batch_size=16)
+		idxs = _fill_both(buffer, baseline, episode_lengths, as_arrays)
+		# the ring has wrapped around several times
+		self.assertGreater(buffer._t, 2*capacity)
+
+		# transitions whose frames have not been overwritten, including episode starts and ends
+		valid = np.flatnonzero(idxs >= buffer._t - capacity + buffer.frame_stack)
+		episode_ends = np.cumsum(episode_lengths) - 1
+		self.assertTrue(np.isin(episode_ends, valid).any())
+		self.assertTrue(np.isin(episode_ends + 1, valid).any())
+		obs, next_obs = buffer._encode_obses(idxs[valid])
+		expected_obs, expected_next_obs = baseline._encode_obses(valid)
+		np.testing.assert_array_equal(obs, expected_obs)
+		np.testing.assert_array_equal(next_obs, expected_next_obs)
+		slots = idxs[valid] % capacity
+		np.testing.assert_array_equal(buffer.actions[slots], baseline.actions[valid])
+		np.testing.assert_array_equal(buffer.rewards[slots], baseline.rewards[valid])
+		np.testing.assert_array_equal(buffer.not_dones[slots], baseline.not_dones[valid])
+
+		# only these transitions are sampled
+		np.random.seed(0)
+		self.assertTrue(np.isin(buffer._get_idxs(500), idxs[valid]).all())
+
+
+class PrefetchSamplerTest(absltest.TestCase):
+
+	def testPrefetchedBatchesMatchSample(self):
+		buffer = utils.ReplayBuffer(_OBS_SHAPE, _ACTION_SHAPE, 200, batch_size=16, device='cpu')
+		_fill(buffer, 120)
+		np.random.seed(3)
+		torch.manual_seed(0)
+		expected = [buffer.sample() for _ in range(5)]
+
+		np.random.seed(4)
+		sampler = utils.PrefetchSampler(buffer, num_batches=2, seed=3)
+		self.addCleanup(sampler.close)
+		torch.manual_seed(0)
+		for batch in expected:
+			for x, y in zip(batch, sampler.sample()):
+				np.testing.assert_array_equal(x.numpy(), y.numpy())
+
+	def testWorkersDoNotAdvanceGlobalRandomState(self):
+		buffer = utils.ReplayBuffer(_OBS_SHAPE, _ACTION_SHAPE, 200, batch_size=16, device='cpu')
+		_fill(buffer, 120)
+		sampler = utils.PrefetchSampler(buffer, num_batches=2, seed=0)
+		self.addCleanup(sampler.close)
+		np.random.seed(0)
+		state = np.random.get_state()[1].copy()
+		first, second = sampler._sample_frames(), sampler._sample_frames(8)
+		# workers do not advance the global np.random
+		np.testing.assert_array_equal(np.random.get_state()[1], state)
+		self.assertEqual(len(first[1]), 16)
+		self.assertEqual(len(second[1]), 8)
+
+	def testCloseStopsWorkers(self):
+		buffer = utils.ReplayBuffer(_OBS_SHAPE, _ACTION_SHAPE, 200, batch_size=16, device='cpu')
+		_fill(buffer, 120)
+		sampler = utils.PrefetchSampler(buffer, num_batches=2, seed=0)
+		sampler.sample()
+		sampler.sample_soda(8)
+		threads = [q._thread for q in sampler._queues.values()]
+		self.assertLen(threads, 2)
+		self.assertTrue(all(thread.is_alive() for thread in threads))
+		sampler.close()
+		self.assertFalse(any(thread.is_alive() for thread in threads))
+		# closing again is a no-op
+		sampler.close()
+
+
+def _soft_update_loop(net, target_net, tau):
+	"""Per-parameter soft update the fused updates replace"""
+	for param, target_param in zip(net.parameters(), target_net.parameters()):
+		target_param.data.copy_(
+			tau * param.data + (1 - tau) * target_param.data
+		)
+
+
+class SoftUpdateTest(absltest.TestCase):
+
+	def _make_nets(self):
+		torch.manual_seed(0)
+		net, target_net = (nn.Sequential(nn.Linear(8, 16), nn.ReLU(), nn.Linear(16, 4)) for _ in range(2))
+		return net, target_net
+
+	def _assert_params_close(self, expected, actual):
+		for (name, a), b in zip(expected.named_parameters(), actual.parameters()):
+			self.assertTrue(torch.allclose(a, b, atol=1e-6), f'soft update differs for {name}')
+
+	def testSoftUpdateParamsMatchesLoop(self):
+		net, target_net = self._make_nets()
+		expected = deepcopy(target_net)
+		for _ in range(3):
+			_soft_update_loop(net, expected, 0.05)
+			utils.soft_update_params(net, target_net, 0.05)
+		self._assert_params_close(expected, target_net)
+
+	def testSoftUpdateMatchesLoopPerPair(self):
+		(net, target_net), (encoder, target_encoder) = self._make_nets(), self._make_nets()
+		expected, expected_encoder = deepcopy(target_net), deepcopy(target_encoder)
+		update = utils.SoftUpdate((net, target_net, 0.01), (encoder, target_encoder, 0.05))
+		for _ in range(3):
+			_soft_update_loop(net, expected, 0.01)
+			_soft_update_loop(encoder, expected_encoder, 0.05)
+			update()
+		self._assert_params_close(expected, target_net)
+		self._assert_params_close(expected_encoder, target_encoder)
+
+
+if __name__ == '__main__':
+	absltest.main()